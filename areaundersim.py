@@ -1,12 +1,32 @@
 import os
 import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Figures are only saved, often from worker processes
 import matplotlib.pyplot as plt
-from tqdm import tqdm
 from scipy.integrate import trapezoid
 
+from baseline import daily_baselines
+from checkpoints import checkpoint_path, new_checkpoint, plan_run, save_checkpoint, truncate_output, write_csv_parts
+from compactcolumns import day_numbers
+from instrumentation import note, stage, stage_log_path, start_log, write_summary
+from outputwriters import write_outputs
+from parallelrunner import WORKERS, list_csv_files, run_files
+from plotting import plot_decimated, scatter_decimated
+from relayevents import relay_on_array
+from sensorcache import load_sensor_csv
+
 AREA_THRESHOLD = 500  # Threshold for turning on the relay
-relay_state = 'OFF'  # Initialize the relay state globally
+SEASON_MONTHS = [10, 11, 12, 1, 2, 3]  # Months the simulation runs on (October-March)
+AREA_MODE = 'vectorized'  # 'vectorized' cumulative-sum mode, or 'incremental' per-reading accumulator
+DEFAULT_BASELINE = 10  # Baseline used when a day has no 5am-6am data or its baseline is rejected
+BASELINE_THRESHOLD_MULTIPLIER = 1.5  # A day's baseline above this multiple of the recent average is rejected
+BASELINE_HISTORY_DAYS = 20  # Previous daily baselines averaged for that check
+CHECKPOINTS = True  # Skip unchanged files and resume appended ones from their checkpoint
+# Formats each processed file is written in (see outputwriters): 'csv', 'columnar', 'sidecar', 'intervals'.
+# Checkpoints resume by appending to the CSV, so they are only used when it is the only output.
+OUTPUT_FORMATS = ['csv']
+DERIVED_COLUMNS = ['baseline_pm25', 'relay_on']  # The columns the simulation adds, kept in the sidecar
 PROCESSED_FOLDER = '/mnt/purpleair/areaunder'
 CSV_DIRECTORY = '/mnt/purpleair'
 
@@ -16,7 +36,19 @@ def was_relay_on_between_4am_and_5am(df, date):
 
 
 def get_baseline_pm25(baseline_dict, date, previous_baselines):
-    return np.mean(previous_baselines) if previous_baselines else 0
+    """Daily 5am-6am baseline for date, falling back to DEFAULT_BASELINE like historicalsimulation.
+
+    A missing or low baseline, or one more than BASELINE_THRESHOLD_MULTIPLIER
+    times the average of the previous days' baselines, is replaced by
+    DEFAULT_BASELINE.
+    """
+    current_baseline = baseline_dict.get(date, DEFAULT_BASELINE)
+    average_previous_baseline = np.mean(previous_baselines) if len(previous_baselines) else DEFAULT_BASELINE
+    if not current_baseline >= DEFAULT_BASELINE:
+        return DEFAULT_BASELINE
+    if current_baseline > BASELINE_THRESHOLD_MULTIPLIER * average_previous_baseline:
+        return DEFAULT_BASELINE
+    return current_baseline
 
 
 def calculate_area_under_curve(data, baseline):
@@ -25,70 +57,248 @@ def calculate_area_under_curve(data, baseline):
     return trapezoid(data_above_baseline)
 
 
-def process_entire_csv(df, baseline_dict, previous_baselines):
-    global relay_state
-
-    print("Converting 'created_at' to datetime...")
-    df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce')
-    print(f"Total rows after datetime conversion: {len(df)}")
+def excess_above_baseline(pm25, baseline):
+    """PM2.5 above the baseline, clipped at zero. NaN readings count as zero."""
+    return np.fmax(np.asarray(pm25, dtype=float) - np.asarray(baseline, dtype=float), 0)
+
+
+class AreaState:
+    """Everything the area simulations need to pick up where an earlier part of a file left off."""
+
+    def __init__(self):
+        self.total_area = 0.0  # Running total of the area since the first reading
+        self.area_at_reset = 0.0  # Running total when the relay last turned OFF
+        self.relay_on = False
+        self.last_excess = None  # Excess of the last reading, for the trapezoid segment spanning the boundary
+        self.previous_baselines = []  # Baselines of the last BASELINE_HISTORY_DAYS days, for add_baseline_column
+
+    def to_dict(self):
+        """The state as plain JSON-able values, for a checkpoint."""
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, values):
+        state = cls()
+        vars(state).update(values)
+        return state
+
+
+def simulate_area_incremental(pm25, baseline, area_threshold=AREA_THRESHOLD, state=None):
+    """Run the area-under-curve relay one reading at a time.
+
+    The area grows by one trapezoid segment per reading and is reset when
+    the relay turns OFF, so each reading costs O(1). Returns a bool array of
+    relay states. Pass the same AreaState for consecutive parts of a file
+    to get the same result as one call on the whole file.
+    """
+    pm25 = np.asarray(pm25, dtype=float)
+    baseline = np.asarray(baseline, dtype=float)
+    excess = excess_above_baseline(pm25, baseline).tolist()
+    relay_on = np.zeros(len(pm25), dtype=bool)
+    if state is None:
+        state = AreaState()
+
+    # The area since the last reset is kept as a running total minus its value
+    # at the reset, which rounds exactly like the cumulative sums of the
+    # vectorized mode
+    state_on = state.relay_on
+    total_area = state.total_area
+    area_at_reset = state.area_at_reset
+    previous_excess = state.last_excess
+    for i, (pm25_value, baseline_pm25) in enumerate(zip(pm25.tolist(), baseline.tolist())):
+        if previous_excess is not None:
+            total_area += (previous_excess + excess[i]) / 2
+        previous_excess = excess[i]
+        if not state_on:
+            if total_area > area_at_reset + area_threshold:
+                state_on = True
+        elif pm25_value <= baseline_pm25:
+            # Turn relay OFF and start a new area from this reading
+            state_on = False
+            area_at_reset = total_area
+        relay_on[i] = state_on
+
+    state.relay_on = state_on
+    state.total_area = total_area
+    state.area_at_reset = area_at_reset
+    state.last_excess = previous_excess
+    return relay_on
+
+
+def simulate_area_vectorized(pm25, baseline, area_threshold=AREA_THRESHOLD, state=None):
+    """Same relay states as simulate_area_incremental, computed from cumulative sums.
+
+    Because the excess is never negative the cumulative area is sorted, so the
+    reading that crosses the threshold after each reset is a searchsorted
+    away. The Python loop runs once per relay event instead of once per reading.
+    """
+    pm25 = np.asarray(pm25, dtype=float)
+    baseline = np.asarray(baseline, dtype=float)
+    n = len(pm25)
+    if state is None:
+        state = AreaState()
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    excess = excess_above_baseline(pm25, baseline)
+    segments = (excess[1:] + excess[:-1]) / 2
+    if state.last_excess is None:
+        cumulative_area = np.concatenate(([0.0], np.cumsum(segments)))
+    else:
+        # np.cumsum adds in order, so carrying on from the previous total rounds like one call on the whole file
+        first_segment = (state.last_excess + excess[0]) / 2
+        cumulative_area = np.cumsum(np.concatenate(([state.total_area, first_segment], segments)))[1:]
+    below_baseline = np.flatnonzero(pm25 <= baseline)
+    relay_on = np.zeros(n, dtype=bool)
+
+    reset_area = state.area_at_reset  # Area the current event is measured from
+    check_from = 0  # First reading whose area is compared with the threshold
+    on_index = 0 if state.relay_on else None  # Set while the relay is ON
+    while check_from < n:
+        if on_index is None:
+            on_index = np.searchsorted(cumulative_area, reset_area + area_threshold, side='right')
+            on_index = max(on_index, check_from)
+            if on_index >= n:
+                break
+            off_from = on_index + 1
+        else:
+            # Already ON at the start: this reading can turn it OFF
+            off_from = on_index
+        position = np.searchsorted(below_baseline, off_from, side='left')
+        if position == len(below_baseline):
+            relay_on[on_index:] = True
+            break
+        off_index = below_baseline[position]
+        relay_on[on_index:off_index] = True
+        reset_area = cumulative_area[off_index]
+        check_from = off_index + 1
+        on_index = None
+
+    state.relay_on = bool(relay_on[-1])
+    state.total_area = float(cumulative_area[-1])
+    state.area_at_reset = float(reset_area)
+    state.last_excess = float(excess[-1])
+    return relay_on
+
+
+def filter_season(df):
+    """Parse 'created_at' and keep the October-March rows the simulation runs on."""
+    with stage('parse', rows=len(df)):
+        df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce')
 
     # Filter rows
-    print("Filtering rows for valid months...")
-    df = df.loc[df['created_at'].notna() & df['created_at'].dt.month.isin([10, 11, 12, 1, 2, 3])].copy()
-    print(f"Total rows after filtering: {len(df)}")
+    with stage('filter', rows=len(df)):
+        df = df.loc[df['created_at'].notna() & df['created_at'].dt.month.isin(SEASON_MONTHS)].copy()
+    return df
+
+
+def add_baseline_column(df, baseline_dict, previous_baselines):
+    """Add timestamp, day (int32 UTC day number) and baseline_pm25 columns.
+
+    The baseline is computed once per day. Days are taken in order and each
+    accepted baseline joins the last BASELINE_HISTORY_DAYS used for the next
+    day's check. previous_baselines seeds that history and is not modified.
+    """
+    df.loc[:, 'timestamp'] = pd.to_datetime(df['created_at']).dt.tz_convert('UTC')
+    df.loc[:, 'day'] = day_numbers(df['timestamp'])
+
+    history = list(previous_baselines)[-BASELINE_HISTORY_DAYS:]
+    days, day_index = np.unique(df['day'].to_numpy(), return_inverse=True)
+    baselines_by_day = np.empty(len(days))
+    for i, date in enumerate(days.astype('datetime64[D]').astype(object)):
+        baseline_pm25 = get_baseline_pm25(baseline_dict, date, history)
+        baselines_by_day[i] = baseline_pm25
+        history = (history + [baseline_pm25])[-BASELINE_HISTORY_DAYS:]
+    df.loc[:, 'baseline_pm25'] = baselines_by_day[day_index]
+    return df
+
+
+def baseline_history(df, end, previous_baselines):
+    """The previous-days history add_baseline_column has built up by row end of df."""
+    days, first_rows = np.unique(df['day'].to_numpy()[:end], return_index=True)
+    daily = df['baseline_pm25'].to_numpy()[first_rows].tolist()
+    return (list(previous_baselines) + daily)[-BASELINE_HISTORY_DAYS:]
+
+
+def process_entire_csv(df, baseline_dict, previous_baselines, mode=AREA_MODE, state=None, checkpoint=None):
+    """Filter, add the baseline and run the area simulation.
+
+    state carries the area and relay state over from an earlier part of the
+    file. With a checkpoint, the state just before the rows of
+    checkpoint['day'] is saved in checkpoint['state'] and their position in
+    the returned rows in checkpoint['split'].
+    """
+    df = filter_season(df)
 
     if df.empty:
         print("No rows to process after filtering.")
         return None
 
-    df.loc[:, 'timestamp'] = pd.to_datetime(df['created_at']).dt.tz_convert('UTC')
-    df.loc[:, 'date'] = df['timestamp'].dt.date
-    df.loc[:, 'baseline_pm25'] = np.nan
-    df.loc[:, 'relay_state'] = 'OFF'  # Default relay state
-
-    cumulative_area = 0  # Tracks the cumulative area under the curve
-    baseline_reached = True  # Whether PM2.5 is at or below baseline
-
-    print("Starting row-by-row processing...")
-    for i in range(len(df)):
-        row = df.iloc[i]
-        pm25_value = row['PM2.5_CF1_ug/m3']
-        date = row['date']
-
-        # Compute baseline PM2.5 value for the current date
-        baseline_pm25 = get_baseline_pm25(baseline_dict, date, previous_baselines)
-        df.loc[i, 'baseline_pm25'] = baseline_pm25
-
-        if relay_state == 'OFF':
-            # Calculate cumulative area only when relay is OFF
-            cumulative_area = calculate_area_under_curve(
-                df['PM2.5_CF1_ug/m3'][:i + 1], df['baseline_pm25'][:i + 1]
-            )
-            if cumulative_area > AREA_THRESHOLD:
-                relay_state = 'ON'  # Turn relay ON
-                baseline_reached = False  # Relay is ON, so stop resetting area
-
-        elif relay_state == 'ON':
-            # Turn relay OFF when PM2.5 drops back to or below the baseline
-            if pm25_value <= baseline_pm25:
-                relay_state = 'OFF'  # Turn relay OFF
-                cumulative_area = 0  # Reset cumulative area
-                baseline_reached = True  # Ready to start new cycle
-
-        # Assign the relay state
-        df.loc[i, 'relay_state'] = relay_state
-
-    print("Finished processing rows.")
+    with stage('baseline', rows=len(df)):
+        add_baseline_column(df, baseline_dict, previous_baselines)
+
+    with stage('simulate', rows=len(df)):
+        if mode == 'incremental':
+            simulate = simulate_area_incremental
+        elif mode == 'vectorized':
+            simulate = simulate_area_vectorized
+        else:
+            raise ValueError(f"Unknown mode: {mode}")
+        if state is None:
+            state = AreaState()
+        pm25 = df['PM2.5_CF1_ug/m3'].to_numpy()
+        baseline = df['baseline_pm25'].to_numpy()
+        split = len(df) if checkpoint is None else int(np.searchsorted(df['day'].to_numpy(), checkpoint['day']))
+        relay_on = simulate(pm25[:split], baseline[:split], state=state)
+        if checkpoint is not None:
+            state.previous_baselines = baseline_history(df, split, previous_baselines)
+            checkpoint['state'] = state.to_dict()
+            checkpoint['split'] = split
+            relay_on = np.concatenate([relay_on, simulate(pm25[split:], baseline[split:], state=state)])
+        df.loc[:, 'relay_on'] = relay_on
     return df
 
 
-def process_csv_file(filename, baseline_dict, previous_baselines):
-    """Process a single CSV file and return the processed DataFrame."""
+def checkpoint_settings():
+    """The area simulation's settings, saved with each checkpoint (see historicalsimulation.checkpoint_settings)."""
+    return {'area_threshold': AREA_THRESHOLD, 'season_months': list(SEASON_MONTHS),
+            'default_baseline': DEFAULT_BASELINE, 'baseline_multiplier': BASELINE_THRESHOLD_MULTIPLIER,
+            'baseline_history_days': BASELINE_HISTORY_DAYS}
+
+
+def process_csv_file(filename, baseline_dict=None, previous_baselines=()):
+    """Process a single CSV file and return the path of the processed file.
+
+    The daily baseline defaults to the file's shared cached one from baseline.daily_baselines.
+    With CHECKPOINTS (and the default baseline), a file that hasn't changed
+    since its last run is skipped, and one that has only had readings
+    appended is resumed from the start of its last day (see checkpoints):
+    only the new rows are read, simulated and appended to the output.
+    """
     file_path = os.path.join(CSV_DIRECTORY, filename)
-    print(f"Reading file: {file_path}")
+    processed_file_path = os.path.join(PROCESSED_FOLDER, f"processed_{filename}")
+
+    checkpoint = None
+    previous = None
+    if CHECKPOINTS and baseline_dict is None and not previous_baselines and OUTPUT_FORMATS == ['csv']:
+        checkpoint_file = checkpoint_path(PROCESSED_FOLDER, filename)
+        try:
+            with stage('plan'):
+                plan, previous = plan_run(file_path, checkpoint_file, processed_file_path, checkpoint_settings())
+                checkpoint = new_checkpoint(file_path)
+        except Exception as e:
+            print(f"Error reading file {file_path}: {e}")
+            return
+        if plan == 'skip':
+            note(f"Unchanged since the last run, skipping: {file_path}")
+            return processed_file_path
+        if plan == 'resume':
+            return resume_csv_file(file_path, processed_file_path, previous, checkpoint, checkpoint_file)
 
     try:
-        df = pd.read_csv(file_path)
+        # Only the season's rows are read from the columnar cache
+        with stage('read') as timer:
+            df = load_sensor_csv(file_path, months=SEASON_MONTHS)
+            timer.rows = len(df)
     except Exception as e:
         print(f"Error reading file {file_path}: {e}")
         return
@@ -97,38 +307,84 @@ def process_csv_file(filename, baseline_dict, previous_baselines):
         print(f"Skipping file {filename}: required columns are missing.")
         return
 
-    print(f"Processing file: {filename}, {len(df)} rows")
-    processed_df = process_entire_csv(df, baseline_dict, previous_baselines)
+    if baseline_dict is None:
+        with stage('baseline'):
+            baseline_dict = daily_baselines(file_path)
+    processed_df = process_entire_csv(df, baseline_dict, previous_baselines, checkpoint=checkpoint)
 
     if processed_df is not None:
-        processed_file_path = os.path.join(PROCESSED_FOLDER, f"processed_{filename}")
-        processed_df.to_csv(processed_file_path, index=False)
-        print(f"Saved processed file: {processed_file_path}")
-        plot_data(processed_df, processed_file_path)
+        with stage('write_output', rows=len(processed_df)):
+            if checkpoint is None:
+                written = write_outputs(processed_df, processed_file_path, OUTPUT_FORMATS, DERIVED_COLUMNS)
+            else:
+                write_csv_parts(processed_df, processed_file_path, checkpoint.pop('split'), header=True,
+                                checkpoint=checkpoint)
+                if 'output_bytes' not in checkpoint:
+                    # Nothing from the last day is in the season: the whole output comes before it
+                    checkpoint['output_bytes'] = os.path.getsize(processed_file_path)
+                save_checkpoint(checkpoint_file, checkpoint, file_path, processed_file_path, checkpoint_settings())
+                written = [processed_file_path]
+        note(f"Saved processed file: {', '.join(written)}")
+        with stage('plot', rows=len(processed_df)):
+            plot_data(processed_df, processed_file_path)
+        return processed_file_path
     else:
         print(f"No data to process in file: {filename}")
 
 
+def resume_csv_file(file_path, processed_file_path, previous, checkpoint, checkpoint_file):
+    """Redo a file's run from the start of the last day its previous checkpoint saw.
+
+    Only the season's rows from that day on are read and simulated, from the
+    saved state, and they replace that day's rows at the end of the output.
+    The plot is redrawn from the whole output.
+    """
+    with stage('read') as timer:
+        df = load_sensor_csv(file_path, months=SEASON_MONTHS, first_row=previous['row'])
+        timer.rows = len(df)
+    with stage('baseline'):
+        baseline_dict = daily_baselines(file_path)
+
+    state = AreaState.from_dict(previous['state'])
+    truncate_output(processed_file_path, previous['output_bytes'])
+    processed_df = process_entire_csv(df, baseline_dict, state.previous_baselines, state=state, checkpoint=checkpoint)
+    if processed_df is None:
+        # No new season rows: the output and state stay as they were
+        checkpoint['state'] = state.to_dict()
+        checkpoint['output_bytes'] = previous['output_bytes']
+    else:
+        with stage('write_output', rows=len(processed_df)):
+            write_csv_parts(processed_df, processed_file_path, checkpoint.pop('split'),
+                            header=previous['output_bytes'] == 0, checkpoint=checkpoint)
+        if 'output_bytes' not in checkpoint:
+            checkpoint['output_bytes'] = os.path.getsize(processed_file_path)
+    save_checkpoint(checkpoint_file, checkpoint, file_path, processed_file_path, checkpoint_settings())
+    note(f"Saved processed file: {processed_file_path}")
+    with stage('plot'):
+        plot_file(processed_file_path)
+    return processed_file_path
+
+
 def plot_data(df, file_path):
     """Generate plots for PM2.5 data and relay state."""
     base_filename = os.path.splitext(os.path.basename(file_path))[0]
 
-    # Calculate the percentage of time the relay is "ON"
-    relay_on_percentage = df['relay_state'].apply(lambda x: 1 if x == 'ON' else 0).mean() * 100
+    # Calculate the percentage of time the relay is "ON" (processed files read back have the legacy relay_state)
+    relay_on = df['relay_on'].to_numpy() if 'relay_on' in df else relay_on_array(df['relay_state'])[0]
+    relay_on_percentage = relay_on.mean() * 100
 
-    # Plot PM2.5 levels with baseline and relay state
+    # Plot PM2.5 levels with baseline and relay state, drawing only each pixel bucket's lowest and highest reading
     fig, ax1 = plt.subplots(figsize=(12, 6))
-    ax1.plot(df['created_at'], df['PM2.5_CF1_ug/m3'], label='PM2.5 Levels', alpha=0.6)
-    ax1.plot(df['created_at'], df['baseline_pm25'], label='Baseline PM2.5', linestyle='--')
+    plot_decimated(ax1, df['created_at'], df['PM2.5_CF1_ug/m3'], label='PM2.5 Levels', alpha=0.6)
+    plot_decimated(ax1, df['created_at'], df['baseline_pm25'], label='Baseline PM2.5', linestyle='--')
     ax1.set_xlabel('Date')
     ax1.set_ylabel('PM2.5 (ug/m3)')
     ax1.legend(loc='upper left')
     ax1.grid(True)
 
     # Highlight relay "ON" points
-    relay_on_dates = df[df['relay_state'] == 'ON']['created_at']
-    relay_on_values = df[df['relay_state'] == 'ON']['PM2.5_CF1_ug/m3']
-    ax1.scatter(relay_on_dates, relay_on_values, color='red', label='Relay State ON', s=10)
+    scatter_decimated(ax1, df['created_at'], df['PM2.5_CF1_ug/m3'], relay_on, color='red',
+                      label='Relay State ON', s=10)
 
     plt.title(f'PM2.5 Levels with Baseline and Relay State\nRelay ON {relay_on_percentage:.2f}% of the time')
     plt.legend(loc='upper right')
@@ -137,13 +393,25 @@ def plot_data(df, file_path):
     plt.close()
 
 
-def cycle_through_csv_files():
-    """Cycle through all CSV files in the specified directory."""
-    baseline_dict = {}  # Dictionary to store baseline PM2.5 data
-    previous_baselines = []  # List to track previous baseline values
+def plot_file(processed_file_path):
+    """Redraw the plot of one processed file."""
+    df = load_sensor_csv(processed_file_path, columns=['PM2.5_CF1_ug/m3', 'baseline_pm25', 'relay_state'],
+                         keep_categories=True)
+    plot_data(df, processed_file_path)
+    return processed_file_path
+
 
+def plot_folder(workers=WORKERS):
+    """Redraw the plots of every processed file in PROCESSED_FOLDER, one file per worker."""
+    processed_files = [file_path for file_path in list_csv_files(PROCESSED_FOLDER)
+                       if os.path.basename(file_path).startswith('processed_')]
+    return run_files(plot_file, processed_files, workers, desc="Plotting")
+
+
+def cycle_through_csv_files(workers=WORKERS):
+    """Cycle through all CSV files in the specified directory."""
     # List CSV files
-    csv_files = [f for f in os.listdir(CSV_DIRECTORY) if f.endswith('.csv')]
+    csv_files = [f for f in sorted(os.listdir(CSV_DIRECTORY)) if f.endswith('.csv')]
 
     if not csv_files:
         print("No CSV files found in the directory.")
@@ -152,16 +420,11 @@ def cycle_through_csv_files():
     print(f"Found {len(csv_files)} CSV files to process.")
     print("Files:", csv_files)
 
-    # Sequential processing with progress bar
-    with tqdm(total=len(csv_files), desc="Processing CSV files", unit="file") as progress_bar:
-        for filename in csv_files:
-            print(f"Processing file: {filename}")
-            try:
-                process_csv_file(filename, baseline_dict, previous_baselines)
-            except Exception as e:
-                print(f"Error processing file {filename}: {e}")
-            finally:
-                progress_bar.update(1)
+    # One file per worker process, reported in directory order; each file uses its own daily baselines
+    log_path = start_log(stage_log_path(PROCESSED_FOLDER, 'areaundersim'))
+    results = run_files(process_csv_file, csv_files, workers, log_path=log_path)
+    write_summary(log_path)
+    return results
 
 
 def main():
@@ -0,0 +1,117 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from fileutils import write_json
+from sensorcache import CHUNK_SIZE, appended_rows_since, iter_sensor_chunks, open_cache
+
+BASELINE_START_HOUR = 5  # The daily baseline is the average PM2.5 from 5am...
+BASELINE_END_HOUR = 6  # ...up to (not including) 6am
+PM25_COLUMN = 'PM2.5_CF1_ug/m3'
+
+# Baselines already computed in this process, keyed by (file path, source hash, hours)
+_memory_cache = {}
+
+
+def daily_baseline_totals(created_at, pm25, start_hour=BASELINE_START_HOUR, end_hour=BASELINE_END_HOUR):
+    """Sum and count of the readings between start_hour and end_hour, per day number.
+
+    Day numbers count days since 1970-01-01 in created_at's own timezone.
+    Totals from several chunks of a file can be concatenated and passed to
+    baselines_from_totals, so a baseline never needs the whole file at once.
+    """
+    created_at = pd.Series(pd.to_datetime(created_at))
+    if created_at.dt.tz is not None:
+        created_at = created_at.dt.tz_localize(None)
+    minutes = created_at.to_numpy(dtype='datetime64[m]').astype(np.int64)
+    hour = (minutes % (24 * 60)) // 60
+    in_slot = (hour >= start_hour) & (hour < end_hour) & created_at.notna().to_numpy()
+
+    values = pd.Series(np.asarray(pm25, dtype=float)[in_slot])
+    return values.groupby(minutes[in_slot] // (24 * 60)).agg(['sum', 'count'])
+
+
+def baselines_from_totals(totals):
+    """Daily average, keyed by datetime.date, from one or more daily_baseline_totals results."""
+    if isinstance(totals, list):
+        totals = pd.concat(totals) if totals else pd.DataFrame(columns=['sum', 'count'])
+    # A day split across two chunks appears twice
+    totals = totals.groupby(level=0).sum()
+    # Days whose readings are all NaN have count 0 and get a NaN baseline
+    daily_avg = (totals['sum'] / totals['count']).to_numpy(dtype=float)
+    dates = totals.index.to_numpy(dtype=np.int64).astype('datetime64[D]').astype(object)
+    return dict(zip(dates, daily_avg))
+
+
+def build_baseline_dict(df, start_hour=BASELINE_START_HOUR, end_hour=BASELINE_END_HOUR):
+    """Average PM2.5 between start_hour and end_hour for each day of a loaded file, keyed by date."""
+    return baselines_from_totals(daily_baseline_totals(df['created_at'], df[PM25_COLUMN], start_hour, end_hour))
+
+
+def compute_daily_baseline_totals(file_path, first_row=0, start_hour=BASELINE_START_HOUR,
+                                  end_hour=BASELINE_END_HOUR, chunksize=CHUNK_SIZE):
+    """Combined daily_baseline_totals of a sensor file's rows from first_row on, a chunk at a time."""
+    totals = [daily_baseline_totals(chunk['created_at'], chunk[PM25_COLUMN], start_hour, end_hour)
+              for chunk in iter_sensor_chunks(file_path, columns=[PM25_COLUMN], chunksize=chunksize,
+                                              first_row=first_row)]
+    if not totals:
+        return pd.DataFrame(columns=['sum', 'count'], dtype=float)
+    return pd.concat(totals).groupby(level=0).sum()
+
+
+def compute_daily_baselines(file_path, start=None, start_hour=BASELINE_START_HOUR, end_hour=BASELINE_END_HOUR,
+                            chunksize=CHUNK_SIZE):
+    """build_baseline_dict for a sensor file (or its readings from start on), a chunk at a time."""
+    totals = [daily_baseline_totals(chunk['created_at'], chunk[PM25_COLUMN], start_hour, end_hour)
+              for chunk in iter_sensor_chunks(file_path, columns=[PM25_COLUMN], start=start, chunksize=chunksize)]
+    return baselines_from_totals(totals)
+
+
+def baseline_cache_file(cache_folder, start_hour, end_hour):
+    return os.path.join(cache_folder, f'baseline_{start_hour}_{end_hour}.json')
+
+
+def daily_baselines(file_path, start_hour=BASELINE_START_HOUR, end_hour=BASELINE_END_HOUR):
+    """Daily baseline of a sensor file, keyed by date, computed at most once per file contents.
+
+    Results are kept in memory for this process and on disk next to the
+    file's columnar cache, both keyed on the source file's hash, so every
+    simulator (and every worker process) reuses the same computation until
+    the file changes. The per-day sums and counts are stored rather than the
+    averages, so when readings are only appended to the file just the new
+    rows are summed and merged in. The returned dict is shared; don't
+    modify it.
+    """
+    cache_folder, manifest, _ = open_cache(file_path)
+    key = (os.path.abspath(file_path), manifest['source_sha1'], start_hour, end_hour)
+    if key in _memory_cache:
+        return _memory_cache[key]
+
+    cache_file = baseline_cache_file(cache_folder, start_hour, end_hour)
+    try:
+        with open(cache_file) as f:
+            stored = json.load(f)
+        stored_rows = appended_rows_since(manifest, stored['source_sha1'])
+        totals = pd.DataFrame.from_dict(stored['totals'], orient='index', columns=['sum', 'count'], dtype=float)
+        totals.index = totals.index.astype(np.int64)
+    except (OSError, ValueError, KeyError):
+        # Missing, unreadable or written by an older version
+        stored_rows = None
+
+    if stored_rows is None:
+        totals = compute_daily_baseline_totals(file_path, start_hour=start_hour, end_hour=end_hour)
+    elif stored_rows < manifest['rows']:
+        new_totals = compute_daily_baseline_totals(file_path, stored_rows, start_hour, end_hour)
+        totals = pd.concat([totals, new_totals]).groupby(level=0).sum()
+    if stored_rows is None or stored['source_sha1'] != manifest['source_sha1']:
+        stored = {
+            'source_sha1': manifest['source_sha1'],
+            'rows': manifest['rows'],
+            'totals': {str(day): [float(row['sum']), float(row['count'])] for day, row in totals.iterrows()},
+        }
+        write_json(cache_file, stored)
+
+    baselines = baselines_from_totals(totals)
+    _memory_cache[key] = baselines
+    return baselines
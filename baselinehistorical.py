@@ -1,46 +1,99 @@
-import pandas as pd
+import os
 import sqlite3
+from contextlib import closing
+from functools import partial
+import pandas as pd
+
+from baseline import compute_daily_baselines, daily_baselines
+from parallelrunner import WORKERS, list_csv_files, run_files
+
+# Folder of sensor CSVs and the database every sensor's daily baselines are kept in
+folder_path = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/New files'
+db_path = 'Bucking housenew2.db'
+
+
+def sensor_name(file_path):
+    """Key a sensor's rows are stored under: its file name without the extension."""
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+
+def open_store(db_path=db_path):
+    """Connect to the baseline database, creating the table if needed.
+
+    Rows are keyed by (sensor, date), which is also the table's index. A
+    table left by the old one-sensor layout (keyed by date alone) is
+    replaced, since it was rebuilt on every run anyway.
+    """
+    conn = sqlite3.connect(db_path)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(daily_averages)')]
+    if columns and 'sensor' not in columns:
+        conn.execute('DROP TABLE daily_averages')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS daily_averages (
+        sensor TEXT NOT NULL,
+        date TEXT NOT NULL,
+        average_PM2_5_CF1_ug_m3 REAL,
+        PRIMARY KEY (sensor, date)
+    )
+    ''')
+    conn.commit()
+    return conn
+
+
+def last_stored_date(conn, sensor):
+    """Latest date stored for a sensor, or None if it has no rows yet."""
+    return conn.execute('SELECT MAX(date) FROM daily_averages WHERE sensor = ?', (sensor,)).fetchone()[0]
+
+
+def write_baselines(conn, sensor, baseline_dict):
+    """Upsert a sensor's daily averages in one transaction and return the number of rows written.
+
+    Dates that are already stored with the same value are left alone.
+    """
+    rows = [(sensor, str(date), None if average != average else float(average))
+            for date, average in baseline_dict.items()]
+    changes_before = conn.total_changes
+    with conn:
+        conn.executemany('''
+        INSERT INTO daily_averages (sensor, date, average_PM2_5_CF1_ug_m3)
+        VALUES (?, ?, ?)
+        ON CONFLICT (sensor, date) DO UPDATE SET average_PM2_5_CF1_ug_m3 = excluded.average_PM2_5_CF1_ug_m3
+        WHERE average_PM2_5_CF1_ug_m3 IS NOT excluded.average_PM2_5_CF1_ug_m3
+        ''', rows)
+    return conn.total_changes - changes_before
+
+
+def compute_baselines(file_path, since_by_file=None):
+    """Daily 5am-6am averages of one sensor file, from its date in since_by_file on if it has one."""
+    since = (since_by_file or {}).get(file_path)
+    if since is None:
+        # Whole file: the shared cached baseline
+        return daily_baselines(file_path)
+    return compute_daily_baselines(file_path, start=since)
+
+
+def update_folder(folder_path=folder_path, db_path=db_path, full=False, workers=WORKERS):
+    """Bring the stored baselines of every sensor in a folder up to date.
+
+    Only the days from each sensor's last stored date on are recomputed
+    (that day may have been partial), unless full is set. The averages are
+    computed one file per worker and written here, one transaction per
+    sensor. Returns the number of rows written for each sensor.
+    """
+    with closing(open_store(db_path)) as conn:
+        file_paths = list_csv_files(folder_path)
+        since = {file_path: None if full else last_stored_date(conn, sensor_name(file_path))
+                 for file_path in file_paths}
+
+        baselines, failures = run_files(partial(compute_baselines, since_by_file=since),
+                                        file_paths, workers, desc="Computing baselines")
+
+        written = {}
+        for file_path, baseline_dict in baselines.items():
+            written[sensor_name(file_path)] = write_baselines(conn, sensor_name(file_path), baseline_dict)
+            print(f"{sensor_name(file_path)}: {written[sensor_name(file_path)]} rows written")
+    return written
+
 
-# Load the CSV file
-file_path = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/New files/Bucking House (outside) (40.555024 -105.035172) Primary Real Time 1_1_2015 7_1_2022.csv'
-df = pd.read_csv(file_path)
-
-# Parse the 'created_at' column as datetime
-df['created_at'] = pd.to_datetime(df['created_at'])
-
-# Extract date and hour from the 'created_at' column
-df['date'] = df['created_at'].dt.date
-df['hour'] = df['created_at'].dt.hour
-
-# Filter for readings between 5am and 6am
-df_filtered = df[(df['hour'] >= 5) & (df['hour'] < 6)]
-
-# Calculate the average PM2.5_CF1_ug/m3 for each day
-daily_avg = df_filtered.groupby('date')['PM2.5_CF1_ug/m3'].mean().reset_index()
-daily_avg.rename(columns={'PM2.5_CF1_ug/m3': 'average_PM2_5_CF1_ug_m3'}, inplace=True)
-
-# Connect to SQLite database (or create it)
-conn = sqlite3.connect('Bucking housenew2.db')
-cursor = conn.cursor()
-
-# Drop the existing table if it exists
-cursor.execute('DROP TABLE IF EXISTS daily_averages')
-
-# Create a new table for storing daily averages
-cursor.execute('''
-CREATE TABLE daily_averages (
-    date TEXT PRIMARY KEY,
-    average_PM2_5_CF1_ug_m3 REAL
-)
-''')
-
-# Insert data into the table
-for index, row in daily_avg.iterrows():
-    cursor.execute('''
-    INSERT OR REPLACE INTO daily_averages (date, average_PM2_5_CF1_ug_m3)
-    VALUES (?, ?)
-    ''', (row['date'], row['average_PM2_5_CF1_ug_m3']))
-
-# Commit the changes and close the connection
-conn.commit()
-conn.close()
\ No newline at end of file
+if __name__ == '__main__':
+    update_folder()
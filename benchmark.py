@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Plots are rendered to files only
+import matplotlib.pyplot as plt
+
+import areaundersim
+import historicalsimulation
+import mixing
+from baseline import build_baseline_dict, compute_daily_baselines
+from compactcolumns import relay_state_labels
+from plotting import plot_decimated, scatter_decimated
+from relayevents import extract_relay_events
+from sensorcache import build_cache, load_sensor_csv
+from streamingdetector import WindowDetector, decisions, to_epoch_seconds
+
+BENCHMARK_SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+BENCHMARK_OUTPUT = 'benchmark_results.json'
+CHECK_ROWS = 5_000  # Rows the row-by-row reference loops are checked on
+READING_INTERVAL_S = 120  # Real-time PurpleAir exports report every 2 minutes
+GAP_PROBABILITY = 2e-4  # Chance that a reading is followed by an outage
+GAP_HOURS_RANGE = (1, 120)  # Outage length
+SMOKE_EPISODES_PER_YEAR = 8
+SMOKE_PEAK_RANGE = (30, 300)  # Extra PM2.5 at the peak of an episode (µg/m³)
+SMOKE_DAYS_RANGE = (0.5, 10)
+DROPOUT_FRACTION = 0.005  # Single readings with a blank PM2.5
+MIXING_TOLERANCE = 1e-2  # Largest allowed difference (µg/m³) between solve_exact and a tight RK45 run
+PM25_COLUMN = 'PM2.5_CF1_ug/m3'
+
+
+def synthetic_sensor(n_rows, seed=0, start='2019-01-01'):
+    """A PurpleAir-style export with n_rows readings.
+
+    Readings come every READING_INTERVAL_S seconds with occasional outages.
+    PM2.5 follows a daily cycle (morning and evening peaks), is higher in
+    winter, has log-normal noise, and has smoke episodes that build up and
+    decay over days. A few single readings are blank, as in real exports.
+    """
+    rng = np.random.default_rng(seed)
+
+    steps = np.full(n_rows, READING_INTERVAL_S, dtype=np.int64)
+    steps[0] = 0
+    gaps = np.flatnonzero(rng.random(n_rows) < GAP_PROBABILITY)
+    steps[gaps] += (rng.uniform(*GAP_HOURS_RANGE, len(gaps)) * 3600).astype(np.int64)
+    seconds = np.cumsum(steps)
+    times = np.datetime64(pd.Timestamp(start).to_datetime64(), 's') + seconds
+
+    hours = (seconds % (24 * 3600)) / 3600
+    day_of_year = (seconds / (24 * 3600)) % 365.25
+    pm25 = (4
+            + 2 * np.exp(-((hours - 8) ** 2) / 4)
+            + 3 * np.exp(-((hours - 20) ** 2) / 8)
+            + 2 * np.cos(2 * np.pi * day_of_year / 365.25))
+    pm25 = pm25 * rng.lognormal(0, 0.3, n_rows)
+
+    years = seconds[-1] / (365.25 * 24 * 3600)
+    for _ in range(rng.poisson(SMOKE_EPISODES_PER_YEAR * max(years, 0.1))):
+        onset = rng.uniform(0, seconds[-1])
+        length = rng.uniform(*SMOKE_DAYS_RANGE) * 24 * 3600
+        first, last = np.searchsorted(seconds, [onset, onset + length])
+        phase = (seconds[first:last] - onset) / length
+        # Fast build-up, slow decay
+        pm25[first:last] += rng.uniform(*SMOKE_PEAK_RANGE) * np.minimum(phase * 10, 1) * np.exp(-3 * phase)
+
+    pm25 = np.maximum(pm25, 0).round(2)
+    pm25[rng.random(n_rows) < DROPOUT_FRACTION] = np.nan
+
+    created_at = pd.Series(np.datetime_as_string(times, unit='s')).str.replace('T', ' ') + ' UTC'
+    return pd.DataFrame({
+        'created_at': created_at,
+        'entry_id': np.arange(1, n_rows + 1),
+        'PM1.0_CF1_ug/m3': (pm25 * 0.7).round(2),
+        PM25_COLUMN: pm25,
+        'PM10.0_CF1_ug/m3': (pm25 * 1.2).round(2),
+        'UptimeMinutes': seconds // 60,
+        'RSSI_dbm': rng.integers(-90, -40, n_rows),
+        'Temperature_F': (55 + 20 * np.sin(2 * np.pi * (hours - 9) / 24) + rng.normal(0, 2, n_rows)).round(),
+        'Humidity_%': rng.integers(10, 90, n_rows),
+    })
+
+
+def write_synthetic_csv(file_path, n_rows, seed=0):
+    synthetic_sensor(n_rows, seed).to_csv(file_path, index=False)
+    return file_path
+
+
+def timed(function, *args, **kwargs):
+    """(result, seconds) of one call."""
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def events_row_loop(created_at, relay_state):
+    """The original iterrows ON -> OFF event loop, for checking extract_relay_events."""
+    on_times = []
+    off_times = []
+    current_event_start = None
+    for i, row in pd.DataFrame({'created_at': created_at, 'relay_state': relay_state}).iterrows():
+        if row['relay_state'] == 'ON' and current_event_start is None:
+            current_event_start = row['created_at']
+        elif row['relay_state'] == 'OFF' and current_event_start is not None:
+            on_times.append(current_event_start)
+            off_times.append(row['created_at'])
+            current_event_start = None
+    return [(off - on).total_seconds() for on, off in zip(on_times, off_times)]
+
+
+def run_stages(file_path):
+    """Time each pipeline stage on one sensor file. Returns {stage: seconds}."""
+    seconds = {}
+    _, seconds['csv_read'] = timed(pd.read_csv, file_path)
+    _, seconds['cache_build'] = timed(build_cache, file_path)
+    df, seconds['cache_load'] = timed(load_sensor_csv, file_path, columns=[PM25_COLUMN])
+    baseline_dict, seconds['baseline'] = timed(compute_daily_baselines, file_path)
+
+    (_, relay_on), seconds['relay_simulation'] = timed(
+        historicalsimulation.simulate_relay, df['created_at'], df[PM25_COLUMN], baseline_dict)
+
+    def area_simulation():
+        season = areaundersim.filter_season(df.copy())
+        areaundersim.add_baseline_column(season, baseline_dict, [])
+        return areaundersim.simulate_area_vectorized(season[PM25_COLUMN], season['baseline_pm25'])
+    _, seconds['area_simulation'] = timed(area_simulation)
+
+    _, seconds['events'] = timed(extract_relay_events, df['created_at'], relay_on)
+
+    time_points = (df['created_at'] - df['created_at'].iloc[0]).dt.total_seconds().to_numpy() / 3600
+    indoor, seconds['mixing'] = timed(mixing.estimate_indoor, time_points, df[PM25_COLUMN].to_numpy(dtype=float))
+
+    def plot():
+        fig, ax = plt.subplots(figsize=(12, 6))
+        plot_decimated(ax, df['created_at'], df[PM25_COLUMN], label='Outdoor PM2.5', color='blue')
+        plot_decimated(ax, df['created_at'], indoor, label='Estimated Indoor PM2.5', color='green')
+        scatter_decimated(ax, df['created_at'], df[PM25_COLUMN], relay_on, color='red', label='Relay ON')
+        ax.legend()
+        fig.savefig(os.path.join(os.path.dirname(file_path), 'benchmark_plot.png'))
+        plt.close(fig)
+    _, seconds['plotting'] = timed(plot)
+    return seconds
+
+
+def run_checks(file_path):
+    """Compare each fast path with the row-by-row code it replaced, on one small file.
+
+    Returns a list of {check, rows, mismatches, passed}.
+    """
+    df = load_sensor_csv(file_path, columns=[PM25_COLUMN])
+    checks = []
+
+    def record(name, mismatches, passed=None):
+        checks.append({'check': name, 'rows': len(df), 'mismatches': mismatches,
+                       'passed': mismatches == 0 if passed is None else passed})
+
+    record('relay_vectorized_vs_reference', len(historicalsimulation.compare_engines(df.copy())))
+
+    relay_df = historicalsimulation.add_relay_columns(df.copy())
+    relay_on = relay_df['relay_on'].to_numpy()
+    readings = zip(to_epoch_seconds(df['created_at']).tolist(), df[PM25_COLUMN].astype(float).tolist())
+    streamed = np.fromiter(decisions(WindowDetector(build_baseline_dict(df)), readings), dtype=bool, count=len(df))
+    record('relay_streaming_vs_vectorized', int((streamed != relay_on).sum()))
+
+    season = areaundersim.filter_season(df.copy())
+    areaundersim.add_baseline_column(season, build_baseline_dict(df), [])
+    incremental = areaundersim.simulate_area_incremental(season[PM25_COLUMN], season['baseline_pm25'])
+    vectorized = areaundersim.simulate_area_vectorized(season[PM25_COLUMN], season['baseline_pm25'])
+    record('area_vectorized_vs_incremental', int((incremental != vectorized).sum()))
+
+    events = extract_relay_events(relay_df['created_at'], relay_on)
+    durations = events_row_loop(relay_df['created_at'], np.asarray(relay_state_labels(relay_on)))
+    if len(durations) == len(events):
+        record('events_vectorized_vs_row_loop', int(np.sum(np.asarray(durations) != events['duration_s'].to_numpy())))
+    else:
+        record('events_vectorized_vs_row_loop', abs(len(durations) - len(events)))
+
+    tight_difference, _ = mixing.compare_solvers(file_path)
+    record('mixing_exact_vs_tight_rk45', float(tight_difference), passed=bool(tight_difference < MIXING_TOLERANCE))
+    return checks
+
+
+def run_benchmark(sizes=BENCHMARK_SIZES, seed=0, work_directory=None):
+    """Generate a synthetic file per size, time every stage on it and run the checks.
+
+    Returns the results as a dict ready to be saved with save_results.
+    """
+    with tempfile.TemporaryDirectory(dir=work_directory) as directory:
+        stages = []
+        for n_rows in sizes:
+            file_path = os.path.join(directory, f'synthetic_{n_rows}.csv')
+            print(f"Generating {n_rows} rows...")
+            write_synthetic_csv(file_path, n_rows, seed)
+            for stage, seconds in run_stages(file_path).items():
+                stages.append({'rows': n_rows, 'stage': stage, 'seconds': seconds,
+                               'rows_per_second': n_rows / seconds if seconds else None})
+                print(f"{n_rows:>10} rows  {stage:<18} {seconds:8.3f}s")
+
+        print(f"Checking fast paths on {CHECK_ROWS} rows...")
+        check_path = write_synthetic_csv(os.path.join(directory, 'synthetic_check.csv'), CHECK_ROWS, seed)
+        checks = run_checks(check_path)
+        for check in checks:
+            print(f"{check['check']:<34} {'ok' if check['passed'] else 'FAILED'} ({check['mismatches']})")
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'seed': seed,
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'stages': stages,
+        'checks': checks,
+    }
+
+
+def save_results(results, output_path=BENCHMARK_OUTPUT):
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Benchmark results saved to {output_path}")
+
+
+def compare_results(previous, current):
+    """Seconds per (rows, stage) in both runs and current / previous, for spotting regressions."""
+    def table(results):
+        return pd.DataFrame(results['stages']).set_index(['rows', 'stage'])['seconds']
+    comparison = pd.concat({'previous': table(previous), 'current': table(current)}, axis=1).dropna()
+    comparison['ratio'] = comparison['current'] / comparison['previous']
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on synthetic PurpleAir data.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCHMARK_SIZES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=BENCHMARK_OUTPUT)
+    parser.add_argument('--work-dir', help="Where the synthetic files are written (a temporary folder inside it)")
+    parser.add_argument('--compare', help="Earlier results file to compare this run against")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.seed, args.work_dir)
+    save_results(results, args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare_results(json.load(f), results).to_string(float_format='{:.3f}'.format))
+    if not all(check['passed'] for check in results['checks']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
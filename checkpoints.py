@@ -0,0 +1,116 @@
+import os
+import json
+import numpy as np
+
+from compactcolumns import write_legacy_csv
+from fileutils import side_path, write_json
+from sensorcache import TIMESTAMP_COLUMN, appended_rows_since, column_values, open_cache
+
+# A checkpoint records, per input file, what a simulator's last run saw (the source's
+# size, mtime, hash and rows, from its columnar cache manifest) and the simulator state
+# at the start of the file's last day of readings, with the output's size at that row.
+# Readings appended later can still change that day's 5am-6am baseline, so a resumed
+# run redoes the last day and everything after it.
+CHECKPOINT_FOLDER = 'checkpoints'
+CHECKPOINT_VERSION = 1  # Bumped whenever the checkpoint layout changes
+DAY_NS = 24 * 3600 * 10 ** 9
+
+
+def checkpoint_path(output_folder, filename):
+    """Where the checkpoint of an input file's run writing to output_folder is kept."""
+    return side_path(output_folder, CHECKPOINT_FOLDER, f'{filename}.json')
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_checkpoint(path, checkpoint):
+    write_json(path, checkpoint)
+
+
+def remove_checkpoint(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def new_checkpoint(file_path):
+    """Start a checkpoint at the file's last day: {'row': its first cache row, 'day': its UTC day number}.
+
+    Returns None when the file's timestamps aren't sorted (or it has none):
+    appended readings could then belong to any day, so the run can't be
+    resumed and is always redone in full.
+    """
+    cache_folder, manifest, entries = open_cache(file_path)
+    if not manifest['sorted'] or manifest['last_timestamp'] is None:
+        return None
+    timestamps = column_values(cache_folder, manifest, entries[TIMESTAMP_COLUMN])
+    day = manifest['last_timestamp'] // DAY_NS
+    return {'row': int(np.searchsorted(timestamps, day * DAY_NS, side='left')), 'day': int(day)}
+
+
+def plan_run(file_path, checkpoint_file, output_path, settings):
+    """Decide how to process a file given its checkpoint. Returns (plan, checkpoint).
+
+    'skip' when the file hasn't changed since the checkpoint was written,
+    'resume' when readings were only appended to it, and 'full' otherwise:
+    no checkpoint, different settings, an output that isn't the one the
+    checkpoint was written for, or a file that was edited rather than
+    appended to. A checkpoint that can't be used is removed, so an
+    interrupted full run is never mistaken for a finished one.
+    """
+    checkpoint = read_checkpoint(checkpoint_file)
+    usable = (checkpoint is not None and checkpoint.get('version') == CHECKPOINT_VERSION
+              and checkpoint['settings'] == settings and os.path.exists(output_path)
+              and os.path.getsize(output_path) == checkpoint['output_size'])
+    if usable:
+        _, manifest, _ = open_cache(file_path)
+        usable = (manifest['sorted']
+                  and appended_rows_since(manifest, checkpoint['source_sha1']) == checkpoint['source_rows'])
+    if not usable:
+        remove_checkpoint(checkpoint_file)
+        return 'full', None
+    if checkpoint['source_sha1'] == manifest['source_sha1']:
+        return 'skip', checkpoint
+    return 'resume', checkpoint
+
+
+def save_checkpoint(checkpoint_file, checkpoint, file_path, output_path, settings):
+    """Complete a checkpoint filled in by a finished run with the source and output it was made from, and write it."""
+    _, manifest, _ = open_cache(file_path)
+    checkpoint.update({
+        'version': CHECKPOINT_VERSION,
+        'settings': settings,
+        'source_size': manifest['source_size'],
+        'source_mtime': manifest['source_mtime'],
+        'source_sha1': manifest['source_sha1'],
+        'source_rows': manifest['rows'],
+        'output_size': os.path.getsize(output_path),
+    })
+    write_checkpoint(checkpoint_file, checkpoint)
+
+
+def truncate_output(output_path, size):
+    """Cut an output back to size bytes (its size at a checkpoint), ready for the resumed rows to be appended."""
+    with open(output_path, 'r+b') as f:
+        f.truncate(size)
+
+
+def write_csv_parts(df, output_path, split, header, checkpoint=None):
+    """write_legacy_csv df to output_path, appending unless header is True.
+
+    With a checkpoint, the rows before split and from split on are written
+    separately and the output's size in between is recorded as
+    checkpoint['output_bytes']. Skipped when split is outside df.
+    """
+    mode = 'w' if header else 'a'
+    if checkpoint is None or not 0 <= split < len(df):
+        write_legacy_csv(df, output_path, mode=mode, header=header)
+        return
+    write_legacy_csv(df.iloc[:split], output_path, mode=mode, header=header)
+    checkpoint['output_bytes'] = os.path.getsize(output_path)
+    write_legacy_csv(df.iloc[split:], output_path, mode='a', header=False)
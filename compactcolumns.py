@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+# In memory the simulators keep compact columns: relay_on (bool), day (int32 days since
+# 1970-01-01), hour (int8) and float64 concentrations. The legacy 'ON'/'OFF' relay_state
+# and date columns are only produced by legacy_frame, when a CSV is written.
+RELAY_STATE_LABELS = ['OFF', 'ON']  # relay_on as int8 gives the category codes
+MISSING_DAY = np.iinfo(np.int32).min  # day of a missing timestamp
+MISSING_HOUR = -1
+
+
+def day_numbers(created_at):
+    """int32 day number of each timestamp, counted in the timestamps' own timezone."""
+    created_at = pd.Series(created_at)
+    if created_at.dt.tz is not None:
+        created_at = created_at.dt.tz_localize(None)
+    days = created_at.to_numpy(dtype='datetime64[D]').astype(np.int64)
+    days[created_at.isna().to_numpy()] = MISSING_DAY
+    return days.astype(np.int32)
+
+
+def hours(created_at):
+    """int8 hour of day of each timestamp, in the timestamps' own timezone."""
+    created_at = pd.Series(created_at)
+    if created_at.dt.tz is not None:
+        created_at = created_at.dt.tz_localize(None)
+    minutes = created_at.to_numpy(dtype='datetime64[m]').astype(np.int64)
+    hour = (minutes % (24 * 60)) // 60
+    hour[created_at.isna().to_numpy()] = MISSING_HOUR
+    return hour.astype(np.int8)
+
+
+def day_dates(days):
+    """Day numbers as 'YYYY-MM-DD' Categoricals (missing days become blank)."""
+    days = np.asarray(days)
+    unique_days, codes = np.unique(days, return_inverse=True)
+    present = unique_days != MISSING_DAY
+    categories = unique_days[present].astype('datetime64[D]').astype(str)
+    # Missing days sort first, so shifting the codes down by one leaves them at -1
+    codes = codes - (len(unique_days) - present.sum())
+    return pd.Categorical.from_codes(codes, categories)
+
+
+def relay_state_labels(relay_on):
+    """relay_on flags as an 'ON'/'OFF' Categorical, one byte per reading."""
+    return pd.Categorical.from_codes(np.asarray(relay_on, dtype=np.int8), RELAY_STATE_LABELS)
+
+
+def legacy_frame(df):
+    """df with day and relay_on replaced by the legacy date and relay_state columns in their place.
+
+    Both come back as Categoricals, which to_csv writes as the same text
+    as before; only a small array per column is built, not a string per row.
+    Missing hours are left blank again.
+    """
+    columns = {}
+    for name in df.columns:
+        if name == 'day':
+            columns['date'] = day_dates(df['day'])
+        elif name == 'hour':
+            hour = df['hour'].to_numpy(dtype=np.int8)
+            columns['hour'] = pd.arrays.IntegerArray(hour, hour == MISSING_HOUR)
+        elif name == 'relay_on':
+            columns['relay_state'] = relay_state_labels(df['relay_on'])
+        else:
+            columns[name] = df[name]
+    return pd.DataFrame(columns, index=df.index)
+
+
+def write_legacy_csv(df, path, **kwargs):
+    """Write df in the legacy CSV layout (see legacy_frame)."""
+    legacy_frame(df).to_csv(path, index=False, **kwargs)
@@ -0,0 +1,98 @@
+import sqlite3
+from contextlib import closing
+import pandas as pd
+
+TIMESTAMP_COLUMN = 'timestamp'  # Epoch seconds in every table the detector writes
+
+
+def to_epoch_seconds(value):
+    """Epoch seconds for a bound, read as UTC unless it carries its own timezone."""
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.timestamp()
+
+
+def ensure_timestamp_index(conn, table):
+    """Create the timestamp index on table if it isn't there yet.
+
+    Returns False if the database can't be written to (e.g. a read-only
+    copy), in which case queries still work, just without the index.
+    """
+    try:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_{TIMESTAMP_COLUMN}" '
+                     f'ON "{table}" ("{TIMESTAMP_COLUMN}")')
+        conn.commit()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def read_table(conn, table, columns, start=None, end=None, since=None, parse_dates=True, with_rowid=False):
+    """Rows of table between start and end (inclusive), with only the given columns.
+
+    The range is applied in SQL, so only matching rows leave the database
+    and the timestamp index is used. since keeps rows at or after a stored
+    epoch-seconds value, and with_rowid adds each row's rowid, for fetching
+    only what was added since the last read. The timestamp column comes
+    back sorted, as datetimes (naive UTC) unless parse_dates is False.
+    """
+    conditions = []
+    parameters = []
+    if start is not None:
+        conditions.append(f'"{TIMESTAMP_COLUMN}" >= ?')
+        parameters.append(to_epoch_seconds(start))
+    if end is not None:
+        conditions.append(f'"{TIMESTAMP_COLUMN}" <= ?')
+        parameters.append(to_epoch_seconds(end))
+    if since is not None:
+        conditions.append(f'"{TIMESTAMP_COLUMN}" >= ?')
+        parameters.append(since)
+
+    selected = [TIMESTAMP_COLUMN] + [column for column in columns if column != TIMESTAMP_COLUMN]
+    query = 'SELECT ' + ('rowid, ' if with_rowid else '') + '"' + '", "'.join(selected) + f'" FROM "{table}"'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += f' ORDER BY "{TIMESTAMP_COLUMN}"' + (', rowid' if with_rowid else '')
+
+    df = pd.read_sql(query, conn, params=parameters)
+    if parse_dates:
+        df[TIMESTAMP_COLUMN] = pd.to_datetime(df[TIMESTAMP_COLUMN], unit='s')
+    return df
+
+
+class TableTail:
+    """Keeps a table's rows since start in memory and fetches only the new ones on refresh."""
+
+    def __init__(self, db_path, table, columns, start=None):
+        self.db_path = db_path
+        self.table = table
+        self.columns = columns
+        self.start = start
+        self.last_seen = None  # Epoch seconds of the newest row read so far
+        self.seen_at_last = set()  # rowids of the rows read so far with that timestamp
+        self.data = None
+        with closing(sqlite3.connect(db_path)) as conn:
+            ensure_timestamp_index(conn, table)
+
+    def refresh(self):
+        """Read rows not seen yet, append them and return how many there were.
+
+        Rows committed later can have the same timestamp as the newest row
+        already read, so that timestamp is read again and the rows whose
+        rowid was already seen are dropped.
+        """
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            new_rows = read_table(conn, self.table, self.columns, start=self.start, since=self.last_seen,
+                                  parse_dates=False, with_rowid=True)
+        new_rows = new_rows[~new_rows['rowid'].isin(self.seen_at_last)].reset_index(drop=True)
+        if len(new_rows):
+            # Remember the raw stored value so the next query's >= comparison is exact
+            newest = new_rows[TIMESTAMP_COLUMN].iloc[-1]
+            at_newest = set(new_rows.loc[new_rows[TIMESTAMP_COLUMN] == newest, 'rowid'])
+            self.seen_at_last = self.seen_at_last | at_newest if newest == self.last_seen else at_newest
+            self.last_seen = newest
+        new_rows = new_rows.drop(columns='rowid')
+        new_rows[TIMESTAMP_COLUMN] = pd.to_datetime(new_rows[TIMESTAMP_COLUMN], unit='s')
+        self.data = new_rows if self.data is None else pd.concat([self.data, new_rows], ignore_index=True)
+        return len(new_rows)
@@ -0,0 +1,35 @@
+import os
+import json
+from contextlib import contextmanager
+
+
+def side_path(output_folder, subfolder, filename):
+    """Path of a file kept alongside a script's output CSVs, in a subfolder of output_folder.
+
+    Checkpoints, stage logs, interval files and the like go in subfolders,
+    so they never look like sensor CSVs to the next script listing the folder.
+    """
+    return os.path.join(output_folder, subfolder, filename)
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Open path for writing, through a temporary file that only replaces path once the block finishes.
+
+    A reader never sees half a file, and a failed write leaves the old one in place.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary_file = path + '.tmp'
+    try:
+        with open(temporary_file, mode) as f:
+            yield f
+        os.replace(temporary_file, path)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+
+def write_json(path, data, **kwargs):
+    """json.dump data to path with atomic_write."""
+    with atomic_write(path) as f:
+        json.dump(data, f, **kwargs)
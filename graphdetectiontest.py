@@ -1,69 +1,76 @@
-import sqlite3
 import pandas as pd
 import matplotlib.pyplot as plt
 from datetime import datetime
 
-# Connect to the SQLite database
+from detectiondb import TableTail
+from plotting import plot_decimated, scatter_decimated
+
+# SQLite database written by the field detector
 db_path = '/Users/carsenhobson/Downloadsw/detectiontest.db'
-conn = sqlite3.connect(db_path)
 
-# Load data from the relevant tables
-detectiontest_query = "SELECT * FROM detectiontestV2;"
-baseline_query = "SELECT * FROM BaselineData;"
-baseline_value_query = "SELECT * FROM BaselineValue;"
+# Set the date range for the x-axis
+start_date = pd.to_datetime("2024-07-15")
+
+# Seconds between redraws with only the newly added rows; None draws once
+refresh_interval = None
 
-detectiontest_df = pd.read_sql(detectiontest_query, conn)
-baseline_df = pd.read_sql(baseline_query, conn)
-baseline_value_df = pd.read_sql(baseline_value_query, conn)
+# Only the needed columns from start_date on are read, using an index on timestamp
+detectiontest_tail = TableTail(db_path, 'detectiontestV2', ['pm25', 'relaystate'], start=start_date)
+baseline_value_tail = TableTail(db_path, 'BaselineValue', ['baseline_pm2_5'], start=start_date)
 
-# Close the connection
-conn.close()
 
-# Convert timestamp to datetime
-detectiontest_df['timestamp'] = pd.to_datetime(detectiontest_df['timestamp'], unit='s')
-baseline_value_df['timestamp'] = pd.to_datetime(baseline_value_df['timestamp'], unit='s')
+def draw(ax):
+    detectiontest_df = detectiontest_tail.data
+    baseline_value_df = baseline_value_tail.data
 
-# Convert relaystate to boolean
-detectiontest_df['relay_on'] = detectiontest_df['relaystate'].apply(lambda x: 1 if x == 'ON' else 0)
+    # Convert relaystate to boolean
+    detectiontest_df['relay_on'] = (detectiontest_df['relaystate'] == 'ON').astype(int)
 
-# Drop rows with NaN values in the 'pm25' column
-cleaned_detectiontest_df = detectiontest_df.dropna(subset=['pm25'])
+    # Drop rows with NaN values in the 'pm25' column
+    cleaned_detectiontest_df = detectiontest_df.dropna(subset=['pm25']).copy()
 
-# Ensure the cleaned dataframe has the correct types
-cleaned_detectiontest_df['pm25'] = cleaned_detectiontest_df['pm25'].astype(float)
+    # Ensure the cleaned dataframe has the correct types
+    cleaned_detectiontest_df['pm25'] = cleaned_detectiontest_df['pm25'].astype(float)
 
-# Set the date range for the x-axis
-start_date = pd.to_datetime("2024-07-15")
-end_date = pd.to_datetime(datetime.now())
+    # Plot PM2.5 levels, drawing only each pixel bucket's lowest and highest reading
+    plot_decimated(ax, cleaned_detectiontest_df['timestamp'], cleaned_detectiontest_df['pm25'], label='PM2.5 Levels',
+                   color='blue')
 
-# Filter data within the specified date range
-cleaned_detectiontest_df = cleaned_detectiontest_df[(cleaned_detectiontest_df['timestamp'] >= start_date) &
-                                                    (cleaned_detectiontest_df['timestamp'] <= end_date)]
-baseline_value_df = baseline_value_df[(baseline_value_df['timestamp'] >= start_date) &
-                                      (baseline_value_df['timestamp'] <= end_date)]
+    # Plot Baseline PM2.5 levels
+    plot_decimated(ax, baseline_value_df['timestamp'], baseline_value_df['baseline_pm2_5'],
+                   label='Baseline PM2.5 Levels', color='green')
 
-# Plot PM2.5 levels and Baseline PM2.5 levels without using fill_between
-plt.figure(figsize=(14, 7))
+    # Plot relay state as dots
+    scatter_decimated(ax, cleaned_detectiontest_df['timestamp'], cleaned_detectiontest_df['pm25'],
+                      cleaned_detectiontest_df['relay_on'] == 1, color='red', label='Relay ON', alpha=0.5)
 
-# Plot PM2.5 levels
-plt.plot(cleaned_detectiontest_df['timestamp'], cleaned_detectiontest_df['pm25'], label='PM2.5 Levels', color='blue')
+    # Labels and title
+    ax.set_xlabel('Timestamp')
+    ax.set_ylabel('PM2.5 Levels')
+    ax.set_title('PM2.5 Levels, Baseline Levels, and Relay Status')
+    ax.legend()
+    ax.grid(True)
 
-# Plot Baseline PM2.5 levels
-plt.plot(baseline_value_df['timestamp'], baseline_value_df['baseline_pm2_5'], label='Baseline PM2.5 Levels', color='green')
+    # Set x-axis limits
+    end_date = pd.to_datetime(datetime.now())
+    ax.set_xlim(start_date, end_date)
 
-# Plot relay state as dots
-relay_on = cleaned_detectiontest_df[cleaned_detectiontest_df['relay_on'] == 1]
-plt.scatter(relay_on['timestamp'], relay_on['pm25'], color='red', label='Relay ON', alpha=0.5)
 
-# Labels and title
-plt.xlabel('Timestamp')
-plt.ylabel('PM2.5 Levels')
-plt.title('PM2.5 Levels, Baseline Levels, and Relay Status')
-plt.legend()
-plt.grid(True)
+if __name__ == '__main__':
+    detectiontest_tail.refresh()
+    baseline_value_tail.refresh()
 
-# Set x-axis limits
-plt.xlim(start_date, end_date)
+    # Plot PM2.5 levels and Baseline PM2.5 levels without using fill_between
+    fig, ax = plt.subplots(figsize=(14, 7))
+    draw(ax)
 
-# Show plot
-plt.show()
\ No newline at end of file
+    if refresh_interval is None:
+        # Show plot
+        plt.show()
+    else:
+        # Keep the window open, fetching only rows added since the last redraw
+        while plt.fignum_exists(fig.number):
+            plt.pause(refresh_interval)
+            if detectiontest_tail.refresh() + baseline_value_tail.refresh():
+                ax.clear()
+                draw(ax)
@@ -1,8 +1,18 @@
 import os
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Plots are only saved, from worker processes
 import matplotlib.pyplot as plt
 import numpy as np
 
+from fileutils import side_path
+from instrumentation import note, stage, stage_log_path, start_log, write_summary
+from parallelrunner import WORKERS, list_csv_files, run_files
+from plotting import plot_decimated
+from relayevents import relay_on_array
+from sensordataset import DATASET_FOLDER, read_dataset
+from sensorcache import load_sensor_csv
+
 # Define the folder containing the CSV files
 folder_path = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/Mixing files'
 
@@ -13,8 +23,18 @@ end_time = '2023-12-31 23:59:59'
 # Threshold for elevated indoor PM2.5 levels
 elevated_threshold = 50  # µg/m³
 
+# Thresholds of the exposure curves (µg/m³), all answered from one sort per relay state
+exposure_thresholds = list(range(0, 305, 5))
+
+# A reading stands for the time until the next one, up to this long (longer gaps are missing data)
+max_reading_minutes = 60
+
 # Output file for storing results
-output_csv = os.path.join(folder_path, "relay_elevated_percentages_by_file.csv")
+output_csv = side_path(folder_path, "relay_percentages", "relay_elevated_percentages_by_file.csv")
+
+# Output files for the exposure curves, per file and for all files together
+exposure_csv = side_path(folder_path, "exposure_curves", "exposure_curves_by_file.csv")
+fleet_exposure_csv = side_path(folder_path, "exposure_curves", "exposure_curves_fleet.csv")
 
 # Function to check if a file is empty
 def is_file_empty(file_path):
@@ -23,24 +43,31 @@ def is_file_empty(file_path):
     except OSError:
         return True
 
-# Function to process and save data
-def process_and_save(file_path, start_time, end_time, results):
-    print(f"Processing file: {file_path}")
+# Function to process and save data; returns the file's result row and exposure curve, or None if it was skipped
+def process_and_save(file_path, start_time=start_time, end_time=end_time, thresholds=exposure_thresholds):
+    note(f"Processing file: {file_path}")
 
     # Check if the file is empty
     if is_file_empty(file_path):
         print(f"Skipping file {file_path} because it is empty.")
         return
 
-    # Load the data
+    # Load only the required columns within the time frame
+    required_columns = ['created_at', 'PM2.5_CF1_ug/m3', 'Estimated_Indoor_PM2.5', 'relay_state']
     try:
-        data = pd.read_csv(file_path)
+        with stage('read') as timer:
+            data = load_sensor_csv(file_path, columns=required_columns, start=start_time, end=end_time,
+                                   keep_categories=True)
+            timer.rows = len(data)
     except pd.errors.EmptyDataError:
         print(f"Skipping file {file_path} because it contains no data.")
         return
+    except KeyError:
+        # Not a sensor file, e.g. a summary CSV: it has no timestamps to load
+        print(f"Skipping file {file_path} due to missing columns: created_at")
+        return
 
     # Check if required columns exist
-    required_columns = ['created_at', 'PM2.5_CF1_ug/m3', 'Estimated_Indoor_PM2.5', 'relay_state']
     missing_columns = [col for col in required_columns if col not in data.columns]
 
     if missing_columns:
@@ -48,74 +75,214 @@ def process_and_save(file_path, start_time, end_time, results):
         return
 
     # Clean the data
-    data['created_at'] = pd.to_datetime(data['created_at'], errors='coerce')
-    data = data.dropna(subset=['created_at', 'PM2.5_CF1_ug/m3', 'Estimated_Indoor_PM2.5', 'relay_state'])
+    with stage('parse', rows=len(data)):
+        data['created_at'] = pd.to_datetime(data['created_at'], errors='coerce')
 
     # Filter data based on the specified time frame
-    data = data[(data['created_at'] >= start_time) & (data['created_at'] <= end_time)]
+    with stage('filter', rows=len(data)):
+        data = data.dropna(subset=['created_at', 'PM2.5_CF1_ug/m3', 'Estimated_Indoor_PM2.5', 'relay_state'])
+        data = data[(data['created_at'] >= start_time) & (data['created_at'] <= end_time)]
 
     if data.empty:
         print(f"No data within the specified time frame for file: {file_path}")
         return
 
-    # Add a column to indicate if indoor PM2.5 is elevated
-    data['elevated'] = data['Estimated_Indoor_PM2.5'] > elevated_threshold
-
-    # Separate data where the relay is ON
-    relay_on_data = data[data['relay_state'] == "ON"]
-
-    # Calculate metrics
-    elevated_when_relay_on = relay_on_data['elevated'].sum()
-    total_elevated = data['elevated'].sum()
-    percentage_elevated_when_relay_on = (elevated_when_relay_on / total_elevated * 100) if total_elevated > 0 else 0
+    with stage('metrics', rows=len(data)):
+        # Relay ON flags from the Categorical's codes, not a string comparison per reading
+        relay_on = relay_on_array(data['relay_state'])[0]
+        percentage_elevated_when_relay_on = elevated_percentage_when_relay_on(data['Estimated_Indoor_PM2.5'], relay_on)
+        curve = exposure_curve(data['Estimated_Indoor_PM2.5'], relay_on, reading_hours(data['created_at']),
+                               thresholds)
 
-    # Add the result to the results list
-    results.append({
+    result = {
         'File': os.path.basename(file_path),
         'Percentage_Elevated_When_Relay_ON': percentage_elevated_when_relay_on
-    })
+    }
 
     # Print metrics
     print(f"File: {os.path.basename(file_path)} - Percentage of elevated indoor PM2.5 when relay ON: {percentage_elevated_when_relay_on:.2f}%")
 
+    with stage('plot', rows=len(data)):
+        plot_path = plot_indoor_relay(data['created_at'], data['PM2.5_CF1_ug/m3'], os.path.basename(file_path),
+                                      os.path.join(folder_path, "plots2"))
+
+    note(f"Plot saved to: {plot_path}")
+    return {'row': result, 'curve': curve}
+
+
+def elevated_percentage_when_relay_on(indoor, relay_on, threshold=elevated_threshold):
+    """Percentage of the readings with indoor PM2.5 above threshold that happened while the relay was ON."""
+    # Indicate if indoor PM2.5 is elevated
+    elevated = np.asarray(indoor) > threshold
+
+    # Calculate metrics
+    elevated_when_relay_on = np.count_nonzero(elevated & relay_on)
+    total_elevated = np.count_nonzero(elevated)
+    return (elevated_when_relay_on / total_elevated * 100) if total_elevated > 0 else 0
+
+
+def reading_hours(created_at, max_minutes=max_reading_minutes):
+    """Hours each reading (in time order) stands for: the time to the next one, at most max_minutes.
+
+    The last reading gets the file's median interval.
+    """
+    seconds = pd.to_datetime(pd.Series(created_at)).to_numpy(dtype='datetime64[ns]').astype(np.int64) / 1e9
+    intervals = np.minimum(np.diff(seconds), max_minutes * 60)
+    last = np.median(intervals) if len(intervals) else 0.0
+    return np.append(intervals, last) / 3600
+
+
+def exposure_curve(indoor, relay_on, hours, thresholds=exposure_thresholds):
+    """Exceedance curve of indoor PM2.5, one row per threshold.
+
+    The readings of each relay state are sorted once, then every threshold
+    is a binary search into them: the readings above it are the ones after
+    its position, and their hours a lookup in a reversed cumulative sum.
+    readings_above_* and hours_above_* count the readings above each
+    threshold with the relay ON and OFF; see add_curve_shares for the shares.
+    At elevated_threshold, share_relay_on is elevated_percentage_when_relay_on.
+    """
+    indoor = np.asarray(indoor, dtype=float)
+    relay_on = np.asarray(relay_on, dtype=bool)
+    hours = np.asarray(hours, dtype=float)
+    thresholds = np.asarray(thresholds, dtype=float)
+    curve = {'threshold': thresholds}
+    for state, name in ((True, 'relay_on'), (False, 'relay_off')):
+        selected = (relay_on == state) & ~np.isnan(indoor)
+        order = np.argsort(indoor[selected], kind='stable')
+        values = indoor[selected][order]
+        # Hours from each sorted position to the end, plus 0 for "none above"
+        hours_from = np.append(np.cumsum(hours[selected][order][::-1])[::-1], 0.0)
+        # Readings above a threshold (strictly, as in elevated_percentage_when_relay_on) start at its right insertion point
+        first_above = np.searchsorted(values, thresholds, side='right')
+        curve[f'readings_{name}'] = np.full(len(thresholds), len(values))
+        curve[f'readings_above_{name}'] = len(values) - first_above
+        curve[f'hours_above_{name}'] = hours_from[first_above]
+    return add_curve_shares(pd.DataFrame(curve))
+
+
+def add_curve_shares(curve):
+    """Add the totals and percentages of an exposure curve from its counts.
+
+    share_relay_on/off: percentage of the readings above the threshold that
+    happened with the relay ON/OFF. exceedance_relay_on/off: percentage of
+    the readings with the relay ON/OFF that were above it. Counts add up
+    across files, so a fleet curve is the summed counts passed through here.
+    """
+    curve['readings_above'] = curve['readings_above_relay_on'] + curve['readings_above_relay_off']
+    curve['hours_above'] = curve['hours_above_relay_on'] + curve['hours_above_relay_off']
+    above = curve['readings_above'].where(curve['readings_above'] > 0)
+    curve['share_relay_on'] = (curve['readings_above_relay_on'] / above * 100).fillna(0)
+    curve['share_relay_off'] = (curve['readings_above_relay_off'] / above * 100).fillna(0)
+    for name in ('relay_on', 'relay_off'):
+        readings = curve[f'readings_{name}'].where(curve[f'readings_{name}'] > 0)
+        curve[f'exceedance_{name}'] = (curve[f'readings_above_{name}'] / readings * 100).fillna(0)
+    return curve
+
+
+def fleet_curve(curves):
+    """One exposure curve for all the files in a frame of per-file curves."""
+    counts = ['readings_relay_on', 'readings_relay_off', 'readings_above_relay_on', 'readings_above_relay_off',
+              'hours_above_relay_on', 'hours_above_relay_off']
+    return add_curve_shares(curves.groupby('threshold', as_index=False)[counts].sum())
+
+
+def exposure_curves_by(data, by, thresholds=exposure_thresholds):
+    """Exposure curve of every group of a concatenated frame (e.g. sensordataset.read_dataset's), in one groupby.
+
+    data needs created_at (in time order within each group),
+    Estimated_Indoor_PM2.5 and relay_state columns. Readings without an
+    indoor value or relay state are left out.
+    """
+    relay_on, has_state = relay_on_array(data['relay_state'])
+    readings = data.loc[has_state, [by, 'created_at', 'Estimated_Indoor_PM2.5']].assign(relay_on=relay_on[has_state])
+    readings = readings.dropna(subset=['created_at', 'Estimated_Indoor_PM2.5'])
+
+    def group_curve(group):
+        return exposure_curve(group['Estimated_Indoor_PM2.5'], group['relay_on'], reading_hours(group['created_at']),
+                              thresholds)
+
+    curves = readings.groupby(by, observed=True, sort=False)[['created_at', 'Estimated_Indoor_PM2.5', 'relay_on']]
+    return curves.apply(group_curve).reset_index(level=1, drop=True).reset_index()
+
+
+def dataset_exposure_curves(dataset_folder=DATASET_FOLDER, start_time=start_time, end_time=end_time,
+                            thresholds=exposure_thresholds):
+    """Per-sensor and fleet exposure curves for every sensor of a sensordataset with indoor estimates.
+
+    Returns (per-sensor curves, fleet curve).
+    """
+    required_columns = ['PM2.5_CF1_ug/m3', 'Estimated_Indoor_PM2.5', 'relay_state']
+    data = read_dataset(dataset_folder, columns=required_columns, start=start_time, end=end_time,
+                        keep_categories=True)
+    if any(col not in data.columns for col in required_columns):
+        print(f"No indoor estimates in dataset: {dataset_folder}")
+        return None, None
+    # Same readings as process_and_save, which leaves out those without an outdoor value
+    data = data.dropna(subset=required_columns)
+    curves = exposure_curves_by(data, 'sensor_id', thresholds)
+    return curves, fleet_curve(curves)
+
+
+def write_exposure_curves(curves_by_file, curves_path=exposure_csv, fleet_path=fleet_exposure_csv):
+    """Save the exposure curves of every file ({file name: curve}) in one CSV, and their fleet curve in another."""
+    curves = pd.concat([curve.assign(File=file_name) for file_name, curve in curves_by_file.items()],
+                       ignore_index=True)
+    curves.insert(0, 'File', curves.pop('File'))
+    for path in (curves_path, fleet_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    curves.to_csv(curves_path, index=False)
+    fleet_curve(curves).to_csv(fleet_path, index=False)
+    print(f"Exposure curves saved to: {curves_path} and {fleet_path}")
+
+
+def plot_indoor_relay(created_at, outdoor, file_name, output_dir):
+    """Save the time series plot of one file to output_dir and return its path."""
     # Time Series Plot
-    plt.figure(figsize=(12, 6))
-    #plt.plot(data['created_at'], data['Estimated_Indoor_PM2.5'], label='Estimated Indoor PM2.5', color='green')
-    plt.plot(data['created_at'], data ['PM2.5_CF1_ug/m3'], label='Outdoor PM2.5', color='blue')
+    fig, ax = plt.subplots(figsize=(12, 6))
+    #plot_decimated(ax, data['created_at'], data['Estimated_Indoor_PM2.5'], label='Estimated Indoor PM2.5', color='green')
+    plot_decimated(ax, created_at, outdoor, label='Outdoor PM2.5', color='blue')
     plt.axhline(y=elevated_threshold, color='orange', linestyle='--', label='Elevated Threshold')
-    #plt.scatter(relay_on_data['created_at'], relay_on_data['Estimated_Indoor_PM2.5'],
+    #scatter_decimated(ax, data['created_at'], data['Estimated_Indoor_PM2.5'], data['relay_state'] == "ON",
                 #color='red', label='Relay ON', zorder=5)
 
     plt.xlabel('Time')
     plt.ylabel('PM2.5 Concentration (µg/m³)')
-    plt.title(f'Indoor PM2.5 Levels and Relay State\n{os.path.basename(file_path)}')
+    plt.title(f'Indoor PM2.5 Levels and Relay State\n{file_name}')
     plt.legend()
     plt.grid()
     plt.tight_layout()
 
     # Save the plot
-    output_dir = os.path.join(folder_path, "plots2")
     os.makedirs(output_dir, exist_ok=True)
-    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    base_name = os.path.splitext(file_name)[0]
     plot_path = os.path.join(output_dir, f"{base_name}_indoor_relay.png")
     plt.savefig(plot_path)
     plt.close()
+    return plot_path
+
+
+def main(workers=WORKERS):
+    # Process every CSV file in the folder, one file per worker
+    log_path = start_log(stage_log_path(folder_path, 'graphsimulations'))
+    processed, failures = run_files(process_and_save, list_csv_files(folder_path), workers, log_path=log_path)
+    write_summary(log_path)
 
-    print(f"Plot saved to: {plot_path}")
+    # Collect results in file order, leaving out skipped files
+    results = [result for result in processed.values() if result is not None]
 
+    # Save all results to the output CSV
+    results_df = pd.DataFrame([result['row'] for result in results])
+    os.makedirs(os.path.dirname(output_csv), exist_ok=True)
+    results_df.to_csv(output_csv, index=False)
 
-# List to store results
-results = []
+    # Notify user of output CSV location
+    print(f"Percentages by file saved to: {output_csv}")
 
-# Iterate through all CSV files in the folder
-for file_name in os.listdir(folder_path):
-    if file_name.endswith('.csv'):
-        file_path = os.path.join(folder_path, file_name)
-        process_and_save(file_path, start_time, end_time, results)
+    # Every file's exposure curve, and the curve of all files together
+    if results:
+        write_exposure_curves({result['row']['File']: result['curve'] for result in results})
 
-# Save all results to the output CSV
-results_df = pd.DataFrame(results)
-results_df.to_csv(output_csv, index=False)
 
-# Notify user of output CSV location
-print(f"Percentages by file saved to: {output_csv}")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
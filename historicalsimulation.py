@@ -1,14 +1,39 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 from tqdm import tqdm
 import os
+from collections import deque
 import matplotlib.pyplot as plt
 
+from parallelrunner import WORKERS, list_csv_files, run_files
+from baseline import build_baseline_dict, daily_baselines
+from checkpoints import (checkpoint_path, new_checkpoint, plan_run, save_checkpoint, truncate_output,
+                         write_csv_parts)
+from compactcolumns import day_numbers, hours
+from instrumentation import note, stage, stage_log_path, start_log, write_summary
+from outputwriters import OutputWriter, write_outputs
+from sensorcache import CHUNK_SIZE, iter_sensor_chunks, load_sensor_csv
+
 # Constants
 OUTPUT_FOLDER = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/New files'
 PROCESSED_FOLDER = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/Newestalgosim'  # Folder for saving processed CSV files
 WINDOW_SIZE = 20  # Number of readings to consider
+# 'readings' windows hold the last WINDOW_SIZE readings; 'duration' windows hold the readings of the
+# last WINDOW_DURATION_MINUTES, so the same setting fits 2-minute and averaged exports alike
+WINDOW_MODE = 'readings'
+WINDOW_DURATION_MINUTES = 40
+MAX_GAP_MINUTES = 30  # A longer gap between readings empties a duration window (None to never empty it)
 BASELINE_THRESHOLD_MULTIPLIER = 1.5  # Multiplier to determine if a new baseline is too high
+RISE_THRESHOLD = 1.25  # Every reading in the window must exceed this multiple of the baseline to turn the relay ON
+DEFAULT_BASELINE = 10  # Baseline used when a day has no 5am-6am data or its baseline is rejected
+ENGINE = 'vectorized'  # 'vectorized' array engine, or 'reference' for the original row-by-row loop
+STREAM_THRESHOLD_BYTES = 500 * 1024 * 1024  # Files bigger than this are processed chunk by chunk
+CHECKPOINTS = True  # Skip unchanged files and resume appended ones from their checkpoint (vectorized engine only)
+# Formats each processed file is written in (see outputwriters): 'csv', 'columnar', 'sidecar', 'intervals'.
+# Checkpoints resume by appending to the CSV, so they are only used when it is the only output.
+OUTPUT_FORMATS = ['csv']
+DERIVED_COLUMNS = ['baseline_pm25', 'relay_on']  # The columns the simulation adds, kept in the sidecar
 
 # Create the output folders if they don't exist
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
@@ -18,22 +43,76 @@ directory = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_colli
 
 # Global variables
 pm25_values = []
+pm25_times = []  # Epoch seconds of pm25_values, in 'duration' window mode
+window_start = None  # Epoch seconds of the first reading since the duration window was last emptied
 current_relay_state = 'OFF'  # Tracks the current relay state
 
-def cycle_through_csv_files():
+def output_path(filename):
+    return os.path.join(PROCESSED_FOLDER, filename.replace('.csv', '_processed.csv'))
+
+def checkpoint_settings():
+    """Settings a checkpoint is only valid for; changing any of them reprocesses every file in full."""
+    return {'window_size': WINDOW_SIZE, 'rise_threshold': RISE_THRESHOLD,
+            'baseline_multiplier': BASELINE_THRESHOLD_MULTIPLIER, 'default_baseline': DEFAULT_BASELINE,
+            'window_mode': WINDOW_MODE, 'window_duration_minutes': WINDOW_DURATION_MINUTES,
+            'max_gap_minutes': MAX_GAP_MINUTES}
+
+def process_file(file_path):
+    """Read one sensor file and process it. Used as the per-file worker by cycle_through_csv_files.
+
+    With CHECKPOINTS, a file that hasn't changed since its last run is
+    skipped, and one that has only had readings appended is resumed from
+    the checkpoint at the start of its last day (see checkpoints), so only
+    the new rows are simulated and appended to the output.
+    """
+    note(f"Processing file: {file_path}")
+    filename = os.path.basename(file_path)
+    checkpoint = None
+    if CHECKPOINTS and ENGINE == 'vectorized' and OUTPUT_FORMATS == ['csv']:
+        checkpoint_file = checkpoint_path(PROCESSED_FOLDER, filename)
+        with stage('plan'):
+            plan, previous = plan_run(file_path, checkpoint_file, output_path(filename), checkpoint_settings())
+        if plan == 'skip':
+            note(f"Unchanged since the last run, skipping: {file_path}")
+            return output_path(filename)
+        checkpoint = new_checkpoint(file_path)
+        if plan == 'resume':
+            result = stream_csv(file_path, filename, checkpoint=checkpoint, resume=previous)
+            save_checkpoint(checkpoint_file, checkpoint, file_path, result, checkpoint_settings())
+            return result
+
+    if os.path.getsize(file_path) > STREAM_THRESHOLD_BYTES:
+        # Multi-year files are streamed instead of loaded whole
+        result = stream_csv(file_path, filename, checkpoint=checkpoint)
+    else:
+        with stage('read') as timer:
+            df = load_sensor_csv(file_path)
+            timer.rows = len(df)
+        with stage('baseline'):
+            baseline_dict = daily_baselines(file_path)
+        # Perform the operations on each DataFrame, with the file's shared cached baseline
+        result = process_csv(df, filename, baseline_dict=baseline_dict, checkpoint=checkpoint)
+    if checkpoint is not None:
+        save_checkpoint(checkpoint_file, checkpoint, file_path, result, checkpoint_settings())
+    return result
+
+def cycle_through_csv_files(workers=WORKERS):
     print(f"Checking files in directory: {directory}")
-    for filename in os.listdir(directory):
-        if filename.endswith('.csv'):
-            file_path = os.path.join(directory, filename)
-            print(f"Processing file: {file_path}")
-            df = pd.read_csv(file_path)
-            # Perform the operations on each DataFrame
-            process_csv(df, filename)
-        else:
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.csv'):
             print(f"Skipping non-CSV file: {filename}")
+    # Time, throughput and memory of every stage of every file, summarized at the end
+    log_path = start_log(stage_log_path(PROCESSED_FOLDER, 'historicalsimulation'))
+    results = run_files(process_file, list_csv_files(directory), workers, log_path=log_path)
+    write_summary(log_path)
+    return results
 
 def was_relay_on_between_4am_and_5am(df, date):
-    """Check if the relay was ON between 4am and 5am on the given date."""
+    """Check if the relay was ON between 4am and 5am on the given date.
+
+    This scans the whole frame, so the simulators use a per-date index
+    (see record_relay_state_at_4am) instead. It is kept to validate that index.
+    """
     start_time = pd.to_datetime(f"{date} 04:00:00").tz_localize('UTC')
     end_time = pd.to_datetime(f"{date} 05:00:00").tz_localize('UTC')
     period = df[(df['created_at'] >= start_time) & (df['created_at'] < end_time)]
@@ -41,25 +120,51 @@ def was_relay_on_between_4am_and_5am(df, date):
 
 def get_baseline_pm25(baseline_dict, current_date, previous_baselines):
     """Determine the appropriate baseline PM2.5 value."""
-    current_baseline = baseline_dict.get(current_date, 10)
+    current_baseline = baseline_dict.get(current_date, DEFAULT_BASELINE)
 
     # Calculate the average of the previous baselines
     if previous_baselines:
         average_previous_baseline = sum(previous_baselines) / len(previous_baselines)
     else:
-        average_previous_baseline = 10
+        average_previous_baseline = DEFAULT_BASELINE
 
     # Ensure baseline is at least 10
-    if current_baseline < 10:
-        return 10
+    if current_baseline < DEFAULT_BASELINE:
+        return DEFAULT_BASELINE
 
     # Check if the new baseline is significantly higher than the average of previous baselines
     if current_baseline > BASELINE_THRESHOLD_MULTIPLIER * average_previous_baseline:
-        return 10
+        return DEFAULT_BASELINE
 
     return current_baseline
 
-def process_row(df, index, row, baseline_dict, previous_baselines):
+def record_relay_state_at_4am(relay_on_4am_by_date, timestamp, relay_state):
+    """Mark the date in the per-date index if the relay is ON during the 04:00-05:00 UTC slot."""
+    if relay_state == 'ON' and timestamp.hour == 4:
+        relay_on_4am_by_date[timestamp.date()] = True
+
+def slide_duration_window(seconds, pm25_value):
+    """Add a reading at epoch seconds to the 'duration' window in pm25_values, dropping those older than WINDOW_DURATION_MINUTES.
+
+    The window is emptied after a gap of more than MAX_GAP_MINUTES (or a
+    reading older than the one before). Returns whether it covers a whole
+    duration since then. The list version of DurationWindow, for the
+    reference engine.
+    """
+    global window_start
+    if (window_start is None or seconds < pm25_times[-1]
+            or (MAX_GAP_MINUTES is not None and seconds - pm25_times[-1] > MAX_GAP_MINUTES * 60)):
+        pm25_values.clear()
+        pm25_times.clear()
+        window_start = seconds
+    pm25_values.append(pm25_value)
+    pm25_times.append(seconds)
+    while pm25_times[0] <= seconds - WINDOW_DURATION_MINUTES * 60:
+        pm25_values.pop(0)
+        pm25_times.pop(0)
+    return seconds - window_start >= WINDOW_DURATION_MINUTES * 60
+
+def process_row(df, index, row, baseline_dict, previous_baselines, relay_on_4am_by_date):
     """Process a single row of PM2.5 data."""
     global current_relay_state
 
@@ -73,19 +178,23 @@ def process_row(df, index, row, baseline_dict, previous_baselines):
     date = timestamp.date()
     previous_date = (timestamp - timedelta(days=1)).date()
 
-    if was_relay_on_between_4am_and_5am(df, date):
+    if relay_on_4am_by_date.get(date, False):
         baseline_pm25 = get_baseline_pm25(baseline_dict, previous_date, previous_baselines)
     else:
         baseline_pm25 = get_baseline_pm25(baseline_dict, date, previous_baselines)
 
     pm25_value = row['PM2.5_CF1_ug/m3']
-    pm25_values.append(pm25_value)
+    if WINDOW_MODE == 'duration':
+        window_full = slide_duration_window(timestamp.value / 1e9, pm25_value)
+    else:
+        pm25_values.append(pm25_value)
 
-    if len(pm25_values) > WINDOW_SIZE:
-        pm25_values.pop(0)
+        if len(pm25_values) > WINDOW_SIZE:
+            pm25_values.pop(0)
+        window_full = len(pm25_values) >= WINDOW_SIZE
 
-    if len(pm25_values) >= WINDOW_SIZE:
-        threshold = 1.25
+    if window_full:
+        threshold = RISE_THRESHOLD
         # Rising edge logic
         if current_relay_state == 'OFF' and all(data_point > threshold * baseline_pm25 for data_point in pm25_values):
             current_relay_state = 'ON'
@@ -98,48 +207,449 @@ def process_row(df, index, row, baseline_dict, previous_baselines):
         previous_baselines.pop(0)
     previous_baselines.append(baseline_pm25)
 
-    return baseline_pm25, current_relay_state
-
-def process_csv(df, filename):
-    # Load the CSV file
-    df['created_at'] = pd.to_datetime(df['created_at'])
-
-    # Extract date and hour from the 'created_at' column
-    df['date'] = df['created_at'].dt.date
-    df['hour'] = df['created_at'].dt.hour
-
-    # Filter for readings between 5am and 6am
-    df_filtered = df[(df['hour'] >= 5) & (df['hour'] < 6)]
-
-    # Calculate the average PM2.5_CF1_ug/m3 for each day
-    daily_avg = df_filtered.groupby('date')['PM2.5_CF1_ug/m3'].mean().reset_index()
-    daily_avg.rename(columns={'PM2.5_CF1_ug/m3': 'average_PM2_5_CF1_ug_m3'}, inplace=True)
+    record_relay_state_at_4am(relay_on_4am_by_date, timestamp, current_relay_state)
 
-    # Convert the daily_avg to a dictionary for quick lookup
-    baseline_dict = dict(zip(daily_avg['date'], daily_avg['average_PM2_5_CF1_ug_m3']))
+    return baseline_pm25, current_relay_state
 
+def to_utc(created_at):
+    """Parse a 'created_at' column and return it as UTC timestamps."""
+    created_at = pd.to_datetime(created_at)
+    if created_at.dt.tz is None:
+        return created_at.dt.tz_localize('UTC')
+    return created_at.dt.tz_convert('UTC')
+
+def lookup_daily_baselines(days, baseline_dict):
+    """Map an array of UTC day numbers to baseline_dict values (DEFAULT_BASELINE when missing)."""
+    unique_days, inverse = np.unique(days, return_inverse=True)
+    dates = unique_days.astype('datetime64[D]').astype(object)
+    values = np.array([baseline_dict.get(date, DEFAULT_BASELINE) for date in dates], dtype=float)
+    return values[inverse]
+
+class DurationWindow:
+    """The readings of the last duration_minutes, for WINDOW_MODE = 'duration'.
+
+    Their minimum and maximum are kept in monotonic deques of (time, value),
+    so each reading is pushed and popped at most once: amortized O(1) per
+    reading however dense the data. NaN readings only have their times kept,
+    since one anywhere in the window fails both relay checks. A gap of more
+    than max_gap_minutes (or a reading older than the one before) empties
+    the window, which must then cover a whole duration again before the
+    relay can switch.
+    """
+
+    def __init__(self, duration_minutes=WINDOW_DURATION_MINUTES, max_gap_minutes=MAX_GAP_MINUTES):
+        self.duration = duration_minutes * 60
+        self.max_gap = None if max_gap_minutes is None else max_gap_minutes * 60
+        self.start = None  # Time of the first reading since the window was last emptied
+        self.last = None
+        self.nan_times = deque()
+        self.low = deque()  # (time, value), values increasing
+        self.high = deque()  # (time, value), values decreasing
+
+    def update(self, seconds, pm25):
+        """Add a reading at UTC epoch seconds and return the window's (min, max).
+
+        Both are NaN until the window covers a whole duration, and while it
+        holds a NaN reading, so the relay comparisons are False as with
+        rolling windows.
+        """
+        if (self.last is None or seconds < self.last
+                or (self.max_gap is not None and seconds - self.last > self.max_gap)):
+            self.start = seconds
+            self.nan_times.clear()
+            self.low.clear()
+            self.high.clear()
+        self.last = seconds
+
+        # Readings at or before this time have left the window
+        oldest = seconds - self.duration
+        while self.nan_times and self.nan_times[0] <= oldest:
+            self.nan_times.popleft()
+        while self.low and self.low[0][0] <= oldest:
+            self.low.popleft()
+        while self.high and self.high[0][0] <= oldest:
+            self.high.popleft()
+        if pm25 != pm25:
+            self.nan_times.append(seconds)
+        else:
+            while self.low and self.low[-1][1] >= pm25:
+                self.low.pop()
+            self.low.append((seconds, pm25))
+            while self.high and self.high[-1][1] <= pm25:
+                self.high.pop()
+            self.high.append((seconds, pm25))
+
+        if seconds - self.start < self.duration or self.nan_times:
+            return np.nan, np.nan
+        return self.low[0][1], self.high[0][1]
+
+    def to_dict(self):
+        return {'duration': self.duration, 'max_gap': self.max_gap, 'start': self.start, 'last': self.last,
+                'nan_times': list(self.nan_times), 'low': list(self.low), 'high': list(self.high)}
+
+    @classmethod
+    def from_dict(cls, values):
+        window = cls()
+        window.duration = values['duration']
+        window.max_gap = values['max_gap']
+        window.start = values['start']
+        window.last = values['last']
+        window.nan_times = deque(values['nan_times'])
+        window.low = deque(tuple(pair) for pair in values['low'])
+        window.high = deque(tuple(pair) for pair in values['high'])
+        return window
+
+def duration_window_extremes(seconds, pm25, window):
+    """Window minimum and maximum at each reading, from a DurationWindow carried across chunks."""
+    window_min = np.empty(len(pm25))
+    window_max = np.empty(len(pm25))
+    update = window.update
+    for i, (time, value) in enumerate(zip(seconds.tolist(), pm25.tolist())):
+        window_min[i], window_max[i] = update(time, value)
+    return window_min, window_max
+
+class RelayState:
+    """Everything simulate_relay needs to pick up where the previous chunk of a file left off."""
+
+    def __init__(self, window_size=WINDOW_SIZE):
+        self.pm25_tail = np.empty(0)  # Last window_size - 1 readings, for windows spanning the boundary
+        self.previous = [0.0] * window_size  # Ring buffer of the last window_size row baselines
+        self.previous_sum = 0.0
+        self.previous_count = 0
+        self.previous_nan_count = 0
+        self.ring_index = 0
+        self.days_on_at_4am = set()
+        self.relay_on = False
+        self.window = None  # DurationWindow, in 'duration' window mode
+
+    def to_dict(self):
+        """The state as plain JSON-able values, for a checkpoint."""
+        return {
+            'pm25_tail': self.pm25_tail.tolist(),
+            'previous': list(self.previous),
+            'previous_sum': self.previous_sum,
+            'previous_count': self.previous_count,
+            'previous_nan_count': self.previous_nan_count,
+            'ring_index': self.ring_index,
+            'days_on_at_4am': sorted(self.days_on_at_4am),
+            'relay_on': self.relay_on,
+            'window': self.window.to_dict() if self.window is not None else None,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        state = cls(len(values['previous']))
+        state.pm25_tail = np.array(values['pm25_tail'], dtype=float)
+        state.previous = list(values['previous'])
+        state.previous_sum = values['previous_sum']
+        state.previous_count = values['previous_count']
+        state.previous_nan_count = values['previous_nan_count']
+        state.ring_index = values['ring_index']
+        state.days_on_at_4am = set(values['days_on_at_4am'])
+        state.relay_on = values['relay_on']
+        if values.get('window') is not None:
+            state.window = DurationWindow.from_dict(values['window'])
+        return state
+
+def simulate_relay(created_at, pm25, baseline_dict, window_size=WINDOW_SIZE,
+                   rise_threshold=RISE_THRESHOLD, baseline_multiplier=BASELINE_THRESHOLD_MULTIPLIER, state=None,
+                   window_mode=WINDOW_MODE, window_duration_minutes=WINDOW_DURATION_MINUTES,
+                   max_gap_minutes=MAX_GAP_MINUTES):
+    """Array version of the process_row loop.
+
+    The window checks become rolling min/max comparisons (over the last
+    window_size readings, or a DurationWindow in 'duration' window mode), so
+    only the relay hysteresis and the previous-baseline average are left for
+    a single pass over plain arrays. Returns (baseline_pm25, relay_on) as NumPy arrays.
+    Pass the same RelayState for consecutive chunks of a file to get the
+    same result as one call on the whole file.
+    """
+    timestamps = to_utc(created_at)
+    minutes = timestamps.values.astype('datetime64[m]').astype(np.int64)
+    days = minutes // (24 * 60)
+    in_4am_slot = (minutes % (24 * 60)) // 60 == 4
+
+    today_baseline = lookup_daily_baselines(days, baseline_dict)
+    yesterday_baseline = lookup_daily_baselines(days - 1, baseline_dict)
+
+    if state is None:
+        state = RelayState(window_size)
+
+    n = len(pm25)
+    if window_mode == 'duration':
+        if state.window is None:
+            state.window = DurationWindow(window_duration_minutes, max_gap_minutes)
+        seconds = timestamps.to_numpy(dtype='datetime64[ns]').astype(np.int64) / 1e9
+        window_min, window_max = duration_window_extremes(seconds, np.asarray(pm25, dtype=float), state.window)
+    elif window_mode == 'readings':
+        # A window containing NaN fails both all(...) checks, and rolling min/max
+        # with the default min_periods returns NaN for it, so comparisons stay False.
+        # The tail of the previous chunk is put back in front so windows span the boundary.
+        pm25 = pd.Series(np.concatenate([state.pm25_tail, np.asarray(pm25, dtype=float)]))
+        tail_length = len(state.pm25_tail)
+        window_min = pm25.rolling(window_size).min().to_numpy()[tail_length:]
+        window_max = pm25.rolling(window_size).max().to_numpy()[tail_length:]
+        state.pm25_tail = pm25.to_numpy()[-(window_size - 1):] if window_size > 1 else pm25.to_numpy()[:0]
+    else:
+        raise ValueError(f"Unknown window mode: {window_mode}")
+
+    baseline_out = np.empty(n)
+    relay_on_out = np.zeros(n, dtype=bool)
+
+    # Ring buffer with a running sum replaces sum(previous_baselines) / len(...).
+    # NaN baselines (days whose 5am-6am readings are all NaN) are counted
+    # instead of summed so the average is NaN only while one is in the window.
+    previous = state.previous
+    previous_sum = state.previous_sum
+    previous_count = state.previous_count
+    previous_nan_count = state.previous_nan_count
+    ring_index = state.ring_index
+
+    # Same per-date "relay ON in the 04:00-05:00 UTC slot" index as process_row, keyed by day number
+    days_on_at_4am = state.days_on_at_4am
+    relay_on = state.relay_on
+    rows = zip(days.tolist(), in_4am_slot.tolist(), today_baseline.tolist(), yesterday_baseline.tolist(),
+               window_min.tolist(), window_max.tolist())
+    for i, (day, in_slot, today, yesterday, low, high) in enumerate(rows):
+        candidate = yesterday if day in days_on_at_4am else today
+        if previous_nan_count:
+            average_previous_baseline = np.nan
+        elif previous_count:
+            average_previous_baseline = previous_sum / previous_count
+        else:
+            average_previous_baseline = DEFAULT_BASELINE
+        if candidate < DEFAULT_BASELINE or candidate > baseline_multiplier * average_previous_baseline:
+            baseline = DEFAULT_BASELINE
+        else:
+            baseline = candidate
+
+        if relay_on:
+            if high <= baseline:
+                relay_on = False
+        elif low > rise_threshold * baseline:
+            relay_on = True
+        if relay_on and in_slot:
+            days_on_at_4am.add(day)
+
+        baseline_out[i] = baseline
+        relay_on_out[i] = relay_on
+
+        if previous_count == window_size:
+            oldest = previous[ring_index]
+            if oldest != oldest:
+                previous_nan_count -= 1
+            else:
+                previous_sum -= oldest
+        else:
+            previous_count += 1
+        previous[ring_index] = baseline
+        if baseline != baseline:
+            previous_nan_count += 1
+        else:
+            previous_sum += baseline
+        ring_index = (ring_index + 1) % window_size
+
+    state.previous_sum = previous_sum
+    state.previous_count = previous_count
+    state.previous_nan_count = previous_nan_count
+    state.ring_index = ring_index
+    state.relay_on = relay_on
+    return baseline_out, relay_on_out
+
+def simulate_relay_checkpointed(created_at, pm25, baseline_dict, state, checkpoint, first_row=0):
+    """simulate_relay for the rows of a file from first_row on, stopping at checkpoint['row'] to save the state.
+
+    checkpoint['state'] gets the RelayState as it was just before that row,
+    for a later run to resume from. Nothing is saved if the row isn't
+    among these.
+    """
+    split = checkpoint['row'] - first_row
+    if not 0 <= split < len(pm25):
+        return simulate_relay(created_at, pm25, baseline_dict, state=state)
+    pm25 = np.asarray(pm25, dtype=float)
+    baseline_before, relay_on_before = simulate_relay(created_at.iloc[:split], pm25[:split], baseline_dict,
+                                                      state=state)
+    checkpoint['state'] = state.to_dict()
+    baseline_after, relay_on_after = simulate_relay(created_at.iloc[split:], pm25[split:], baseline_dict,
+                                                    state=state)
+    return np.concatenate([baseline_before, baseline_after]), np.concatenate([relay_on_before, relay_on_after])
+
+def simulate_reference(df, baseline_dict, check_4am_index=False):
+    """Run the original row-by-row process_row loop over df in place.
+
+    With check_4am_index=True every per-date index lookup is also compared
+    against the old was_relay_on_between_4am_and_5am scan (O(n²), for
+    validation only). Returns the number of rows where the two disagree.
+    """
     # Initialize data storage for PM2.5 values and previous baselines
-    global pm25_values
+    global pm25_values, pm25_times, window_start, current_relay_state
     pm25_values = []
+    pm25_times = []
+    window_start = None
+    current_relay_state = 'OFF'
     previous_baselines = []
+    relay_on_4am_by_date = {}
+    disagreements = 0
 
     # Process each row and add new columns for baseline and relay state
-    df['baseline_pm25'] = 0
+    df['baseline_pm25'] = 0.0
     df['relay_state'] = 'OFF'
 
-    print("Starting row processing...")
+    note("Starting row processing...")
     for index, row in tqdm(df.iterrows(), total=len(df), desc="Processing rows"):
-        baseline_pm25, relay_state = process_row(df, index, row, baseline_dict, previous_baselines)
+        if check_4am_index:
+            date = to_utc(pd.Series([row['created_at']])).iloc[0].date()
+            if relay_on_4am_by_date.get(date, False) != was_relay_on_between_4am_and_5am(df, date):
+                disagreements += 1
+        baseline_pm25, relay_state = process_row(df, index, row, baseline_dict, previous_baselines,
+                                                 relay_on_4am_by_date)
         df.at[index, 'baseline_pm25'] = baseline_pm25
         df.at[index, 'relay_state'] = relay_state
 
+    return disagreements
+
+def add_date_columns(df):
+    """Parse 'created_at' and add the day (int32 day number) and hour (int8) columns.
+
+    They are written out as the legacy date and hour columns by compactcolumns.write_legacy_csv.
+    """
+    df['created_at'] = pd.to_datetime(df['created_at'])
+
+    # Extract day and hour from the 'created_at' column
+    df['day'] = day_numbers(df['created_at'])
+    df['hour'] = hours(df['created_at'])
+
+def add_relay_columns(df, engine=ENGINE, baseline_dict=None, checkpoint=None):
+    """Add day, hour, baseline_pm25 and relay_on (bool) columns to df using the chosen engine.
+
+    baseline_dict is the file's daily baseline from baseline.daily_baselines;
+    without it the baseline is computed from df. With a checkpoint (df being
+    the whole file), the vectorized engine saves its state at
+    checkpoint['row'] (see simulate_relay_checkpointed).
+    """
+    with stage('parse', rows=len(df)):
+        add_date_columns(df)
+    if baseline_dict is None:
+        with stage('baseline', rows=len(df)):
+            baseline_dict = build_baseline_dict(df)
+
+    with stage('simulate', rows=len(df)):
+        if engine == 'reference':
+            simulate_reference(df, baseline_dict)
+            # The reference loop works in 'ON'/'OFF' strings; keep the same compact columns as the vectorized engine
+            df['relay_on'] = df.pop('relay_state').to_numpy() == 'ON'
+        elif engine == 'vectorized' and checkpoint is not None:
+            baseline_pm25, relay_on = simulate_relay_checkpointed(df['created_at'], df['PM2.5_CF1_ug/m3'],
+                                                                  baseline_dict, RelayState(), checkpoint)
+            df['baseline_pm25'] = baseline_pm25
+            df['relay_on'] = relay_on
+        elif engine == 'vectorized':
+            baseline_pm25, relay_on = simulate_relay(df['created_at'], df['PM2.5_CF1_ug/m3'], baseline_dict)
+            df['baseline_pm25'] = baseline_pm25
+            df['relay_on'] = relay_on
+        else:
+            raise ValueError(f"Unknown engine: {engine}")
+    return df
+
+def compare_engines(df):
+    """Run both engines on copies of df and return the rows where their outputs differ."""
+    reference = add_relay_columns(df.copy(), engine='reference')
+    vectorized = add_relay_columns(df.copy(), engine='vectorized')
+    baseline_differs = ~np.isclose(reference['baseline_pm25'], vectorized['baseline_pm25'], equal_nan=True)
+    relay_differs = reference['relay_on'] != vectorized['relay_on']
+    mismatched = reference[baseline_differs | relay_differs][['created_at', 'baseline_pm25', 'relay_on']]
+    return mismatched.join(vectorized[['baseline_pm25', 'relay_on']], rsuffix='_vectorized')
+
+def check_relay_on_4am_index(file_path):
+    """Replay a sensor file and count rows where the 4am index disagrees with the full-frame scan."""
+    df = load_sensor_csv(file_path)
+    add_date_columns(df)
+    return simulate_reference(df, daily_baselines(file_path), check_4am_index=True)
+
+def check_relay_on_4am_index_for_folder():
+    """Run check_relay_on_4am_index on every CSV in the input directory."""
+    results = {}
+    for filename in os.listdir(directory):
+        if filename.endswith('.csv'):
+            disagreements = check_relay_on_4am_index(os.path.join(directory, filename))
+            print(f"{filename}: {disagreements} rows where the 4am index disagrees with the scan")
+            results[filename] = disagreements
+    return results
+
+def process_csv(df, filename, engine=ENGINE, baseline_dict=None, checkpoint=None):
+    # Add baseline and relay state columns
+    add_relay_columns(df, engine, baseline_dict, checkpoint)
+
     # Save the updated DataFrame to a new CSV file in the specified processed folder
-    output_csv_file_path = os.path.join(PROCESSED_FOLDER, filename.replace('.csv', '_processed.csv'))
-    df.to_csv(output_csv_file_path, index=False)
-    print(f"Processing completed. Output saved to {output_csv_file_path}")
+    output_csv_file_path = output_path(filename)
+    with stage('write_output', rows=len(df)):
+        if checkpoint is None:
+            written = write_outputs(df, output_csv_file_path, OUTPUT_FORMATS, DERIVED_COLUMNS)
+        else:
+            write_csv_parts(df, output_csv_file_path, checkpoint['row'], header=True, checkpoint=checkpoint)
+            written = [output_csv_file_path]
+    note(f"Processing completed. Output saved to {', '.join(written)}")
 
     # Generate plots
-    plot_data(df, output_csv_file_path)
+    with stage('plot', rows=len(df)):
+        plot_data(df, output_csv_file_path)
+    return output_csv_file_path
+
+def stream_csv(file_path, filename, chunksize=CHUNK_SIZE, checkpoint=None, resume=None):
+    """process_csv for files too big to hold in memory, or for resuming a run.
+
+    The daily baselines come from baseline.daily_baselines (itself one
+    chunked pass the first time a file is seen), then a second pass runs the
+    relay simulation chunk by chunk, carrying the window, previous baselines
+    and relay state across chunks, and appends each chunk to the outputs in
+    OUTPUT_FORMATS.
+    The output matches process_csv with the vectorized engine. No plots are
+    made, since those need the whole file.
+
+    With a checkpoint, the state and output size at checkpoint['row'] are
+    saved in it. resume is the checkpoint of an earlier run: the output is
+    cut back to that run's checkpoint row and only the rows from there on
+    are simulated, starting from its saved state.
+    """
+    with stage('baseline'):
+        baseline_dict = daily_baselines(file_path)
+
+    output_csv_file_path = output_path(filename)
+    if resume is None:
+        state = RelayState()
+        first_row = 0
+    else:
+        state = RelayState.from_dict(resume['state'])
+        first_row = resume['row']
+        truncate_output(output_csv_file_path, resume['output_bytes'])
+    # A checkpoint at the first row of a file is taken before its header is written
+    header = resume is None or os.path.getsize(output_csv_file_path) == 0
+    writer = OutputWriter(output_csv_file_path, OUTPUT_FORMATS, DERIVED_COLUMNS)
+    # Reading, simulating and writing are interleaved chunk by chunk, so they are timed as one stage
+    with stage('stream', rows=0) as timer:
+        row = first_row
+        for chunk in iter_sensor_chunks(file_path, chunksize=chunksize, first_row=first_row):
+            add_date_columns(chunk)
+            if checkpoint is None:
+                baseline_pm25, relay_on = simulate_relay(chunk['created_at'], chunk['PM2.5_CF1_ug/m3'],
+                                                         baseline_dict, state=state)
+            else:
+                baseline_pm25, relay_on = simulate_relay_checkpointed(chunk['created_at'], chunk['PM2.5_CF1_ug/m3'],
+                                                                      baseline_dict, state, checkpoint, row)
+            chunk['baseline_pm25'] = baseline_pm25
+            chunk['relay_on'] = relay_on
+            if 'csv' in OUTPUT_FORMATS:
+                split = checkpoint['row'] - row if checkpoint is not None else None
+                write_csv_parts(chunk, output_csv_file_path, split, header, checkpoint)
+                header = False
+            writer.write(chunk)
+            row += len(chunk)
+            timer.rows += len(chunk)
+        written = writer.close()
+    if 'csv' in OUTPUT_FORMATS:
+        written.insert(0, output_csv_file_path)
+    note(f"Processing completed. Output saved to {', '.join(written)}")
+    return output_csv_file_path
 
 # Plotting function remains unchanged
 def plot_data(df, file_path):
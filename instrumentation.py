@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+from datetime import datetime, timezone
+import pandas as pd
+
+from fileutils import side_path
+
+try:
+    import resource  # Not available on Windows; peak RSS is then left out
+except ImportError:
+    resource = None
+
+STAGE_LOG_FOLDER = 'stage_logs'
+TOTAL_STAGE = 'total'  # Record written for each file's whole run
+PEAK_RSS_RESETS = os.path.exists('/proc/self/clear_refs')  # Whether a process's peak RSS can be reset between files
+
+# Set by instrumented() for the file being processed in this process
+_log_path = None
+_current_file = None
+_file_peak = True  # Whether the process's peak RSS is the current file's alone
+_files_started = 0
+
+
+def reset_peak_rss():
+    """Reset this process's peak resident memory to its current size.
+
+    Only Linux can (through /proc/self/clear_refs); returns whether it did.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process since reset_peak_rss (or since it started), in MB.
+
+    None where it can't be read.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def write_record(record):
+    """Append one record to the stage log, if a file is being instrumented."""
+    if _log_path is None:
+        return
+    record = {'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'), 'pid': os.getpid(),
+              'file': _current_file, **record}
+    with open(_log_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def note(message):
+    """Progress message about the file being processed: logged with its stages, or printed if none are logged."""
+    if _log_path is None:
+        print(message)
+    else:
+        write_record({'message': message})
+
+
+class stage:
+    """Context manager timing one stage of a file's processing.
+
+        with stage('read') as timer:
+            df = load_sensor_csv(file_path)
+            timer.rows = len(df)
+
+    Writes wall time, rows, rows/sec and peak RSS to the stage log when the
+    file is run through instrumented(); otherwise it only times the block.
+    Peak RSS is the file's own peak so far, or None when it can't be told
+    apart from an earlier file's (see instrumented).
+    """
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.seconds = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.started
+        write_record({
+            'stage': self.name,
+            'seconds': self.seconds,
+            'rows': self.rows,
+            'rows_per_second': self.rows / self.seconds if self.rows and self.seconds else None,
+            'peak_rss_mb': peak_rss_mb() if _file_peak else None,
+            'failed': exc_type is not None,
+        })
+        return False
+
+
+def instrumented(function, log_path, file_path):
+    """Call function(file_path), logging its stages and a TOTAL_STAGE record under file_path.
+
+    Used by parallelrunner.run_files, so it has to be picklable: bind
+    function and log_path with functools.partial.
+
+    The peak RSS is reset at the start of each file, so a worker that runs
+    several files logs each one's own peak. Where it can't be reset (see
+    PEAK_RSS_RESETS) only the first file a process runs gets a peak.
+    """
+    global _log_path, _current_file, _file_peak, _files_started
+    previous = _log_path, _current_file, _file_peak
+    _file_peak = reset_peak_rss() or _files_started == 0
+    _files_started += 1
+    _log_path, _current_file = log_path, file_path
+    try:
+        with stage(TOTAL_STAGE):
+            return function(file_path)
+    finally:
+        _log_path, _current_file, _file_peak = previous
+
+
+def stage_log_path(folder, run_name):
+    """Where a run of run_name (e.g. the script's name) logs its stages for files written to folder."""
+    return side_path(folder, STAGE_LOG_FOLDER, f'{run_name}.jsonl')
+
+
+def start_log(log_path):
+    """Start a fresh stage log at log_path and return the path."""
+    os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    return log_path
+
+
+def read_log(log_path):
+    with open(log_path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+def summarize_log(log_path):
+    """Per-stage and per-file summaries of a stage log.
+
+    The stage table has each stage's total time across files, its share of
+    all stage time, rows, rows/sec and the largest peak RSS seen. The file
+    table has each file's seconds per stage, its total, rows and peak RSS,
+    slowest file first.
+    """
+    log = read_log(log_path)
+    if 'message' in log.columns:
+        log = log[log['message'].isna()]
+    stages = log[log['stage'] != TOTAL_STAGE]
+    totals = log[log['stage'] == TOTAL_STAGE]
+
+    by_stage = stages.groupby('stage').agg(files=('file', 'nunique'), seconds=('seconds', 'sum'),
+                                           rows=('rows', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'))
+    by_stage['share'] = by_stage['seconds'] / by_stage['seconds'].sum()
+    # Stages that don't report rows (e.g. a cached baseline lookup) get no throughput
+    by_stage['rows_per_second'] = (by_stage['rows'] / by_stage['seconds']).where(by_stage['rows'] > 0)
+    by_stage = by_stage.sort_values('seconds', ascending=False)
+
+    by_file = stages.pivot_table(index='file', columns='stage', values='seconds', aggfunc='sum')
+    by_file['rows'] = stages.groupby('file')['rows'].max()
+    by_file['total_seconds'] = totals.groupby('file')['seconds'].sum()
+    by_file['peak_rss_mb'] = log.groupby('file')['peak_rss_mb'].max()
+    by_file['failed'] = totals.groupby('file')['failed'].any()
+    by_file = by_file.sort_values('total_seconds', ascending=False)
+    return by_stage, by_file
+
+
+def write_summary(log_path):
+    """Write <log>_stages.csv and <log>_files.csv next to the log and print the stage table."""
+    if not os.path.exists(log_path):
+        print(f"No stage log at {log_path}")
+        return None, None
+    by_stage, by_file = summarize_log(log_path)
+    prefix = os.path.splitext(log_path)[0]
+    by_stage.to_csv(f'{prefix}_stages.csv')
+    by_file.to_csv(f'{prefix}_files.csv')
+    print(by_stage.to_string(float_format='{:.2f}'.format))
+    print(f"Stage summaries saved to {prefix}_stages.csv and {prefix}_files.csv")
+    return by_stage, by_file
@@ -2,60 +2,299 @@ import pandas as pd
 import numpy as np
 from scipy.integrate import solve_ivp
 import os
+from functools import partial
+
+from fileutils import side_path
+from instrumentation import note, stage, stage_log_path, start_log, write_summary
+from parallelrunner import WORKERS, list_csv_files, run_files
+from relayevents import relay_on_array
+from sensorcache import load_sensor_csv
 
 # Define the directory containing the CSV files
 input_directory = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/Newestalgosim'  # Replace with your directory path
 output_directory = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/Mixing files'  # Replace with your desired output directory
-
-# Ensure the output directory exists
-os.makedirs(output_directory, exist_ok=True)
+ensemble_output = side_path(output_directory, 'home_ensemble', 'home_ensemble.csv')  # One row per sensor and home
 
 # Room-specific parameters
 V = 100    # Room volume (m³)
 Q = 1    # Airflow rate (m³/h, corresponding to 1.0 ACH)
 k = 0.05  # Removal rate constant (no HEPA filtration)
 
+SOLVER = 'exact'  # 'exact' closed-form update at every reading, or 'rk45' for the original solve_ivp run
+RK45_SAMPLES = 2000  # Points the 'rk45' solver samples before interpolating back
+MAX_BLOCK_DECAY = 50  # Largest decay exponent summed in one block of solve_exact (e^50 stays well inside float64)
+BLOCK_VALUES = 4_000_000  # Most homes x readings held at once by iter_exact_blocks
+
+# Home population for the ensemble mode: uniform ranges for each parameter
+ENSEMBLE_HOMES = 1000
+HOME_VOLUME_RANGE = (50, 500)  # Volume (m³)
+HOME_ACH_RANGE = (0.2, 2.0)  # Air changes per hour, Q = ACH * V
+HOME_K_OFF_RANGE = (0.0, 0.2)  # Removal rate while the relay is OFF (1/h)
+HOME_K_ON_RANGE = (1.0, 5.0)  # Removal rate while the relay is ON and the filter runs (1/h)
+INDOOR_THRESHOLD = 35  # Indoor PM2.5 (µg/m³) counted by fraction_above_threshold
+
+# Columns read from each processed file and carried into the Updated_ output (created_at is always included)
+MIXING_COLUMNS = ['PM2.5_CF1_ug/m3', 'baseline_pm25', 'relay_state']
+
 # Differential equation model
-def model(t, C, V, Q, k, pm_concentration_in):
+def model(t, C, V, Q, k, time_points, pm_in):
     C_in = np.interp(t, time_points, pm_in)  # Interpolate outdoor concentration
     dCdt = (Q/V) * (C_in - C) - k * C        # Calculate rate of change
     return dCdt
 
-# Cycle through all CSV files in the directory
-for file_name in os.listdir(input_directory):
-    if file_name.endswith('.csv'):
-        file_path = os.path.join(input_directory, file_name)
-        print(f"Processing: {file_name}")
+def solve_rk45(time_points, pm_in, V=V, Q=Q, k=k):
+    """Original solver: RK45 on RK45_SAMPLES evenly spaced points, interpolated back to time_points."""
+    time_sim = np.linspace(time_points[0], time_points[-1], RK45_SAMPLES)
+    solution = solve_ivp(
+        model,
+        [time_points[0], time_points[-1]],
+        [0],  # Initial condition C0 = 0
+        t_eval=time_sim,
+        args=(V, Q, k, time_points, pm_in),
+        method='RK45'  # Runge-Kutta solver
+    )
+
+    # Interpolate simulated indoor values for the original timestamps
+    return np.interp(time_points, time_sim, solution.y[0])
+
+def fill_missing_outdoor(time_points, pm_in):
+    """Missing outdoor readings taken from the straight line through their neighbours."""
+    valid = ~np.isnan(pm_in)
+    if not valid.all() and valid.any():
+        pm_in = np.interp(time_points, time_points[valid], pm_in[valid])
+    return pm_in
+
+def iter_exact_blocks(time_points, pm_in, air_exchange, removal_off, removal_on=None, relay_on=None, C0=0.0):
+    """Exact solution for one or more homes, yielded as (readings slice, C[homes, readings]) blocks.
+
+    air_exchange is Q/V and removal_off/removal_on the removal rate k while
+    the relay is OFF/ON, each a scalar or one value per home. relay_on is
+    one bool per reading; the rate in force over an interval is the one at
+    its first reading. Blocks are sized so no home decays by more than
+    MAX_BLOCK_DECAY within one, and so a block holds at most BLOCK_VALUES
+    numbers, which keeps memory flat for long files and many homes. An
+    interval that decays by more than that on its own (a long gap between
+    readings) is a block by itself, updated directly without the scaling.
+    """
+    time_points = np.asarray(time_points, dtype=float)
+    pm_in = fill_missing_outdoor(time_points, np.asarray(pm_in, dtype=float))
+    air_exchange = np.atleast_1d(np.asarray(air_exchange, dtype=float))[:, None]
+    removal_off = np.atleast_1d(np.asarray(removal_off, dtype=float))[:, None]
+    removal_on = removal_off if removal_on is None else np.atleast_1d(np.asarray(removal_on, dtype=float))[:, None]
+    homes = max(len(air_exchange), len(removal_off), len(removal_on))
+    n = len(time_points)
+    relay_on = np.zeros(n, dtype=bool) if relay_on is None else np.asarray(relay_on, dtype=bool)
+    if n == 0:
+        return
+
+    C = np.broadcast_to(np.asarray(C0, dtype=float), (homes,)).astype(float)
+    yield slice(0, 1), C[:, None]
+
+    # Block boundaries follow the fastest-decaying home
+    h = np.diff(time_points)
+    fastest = np.where(relay_on[:-1], np.max(air_exchange + removal_on), np.max(air_exchange + removal_off))
+    cumulative_decay = np.concatenate([[0.0], np.cumsum(fastest * h)])
+    max_readings = max(BLOCK_VALUES // homes, 1)
+    start = 0
+    while start < n - 1:
+        end = int(np.searchsorted(cumulative_decay, cumulative_decay[start] + MAX_BLOCK_DECAY, side='right'))
+        end = min(max(end, start + 2), start + 1 + max_readings, n)
+        intervals = slice(start, end - 1)
+
+        a = air_exchange + np.where(relay_on[intervals], removal_on, removal_off)
+        decay = a * h[intervals]
+        one_minus_e = -np.expm1(-decay)
+        # Weights of the interval's start and end readings in the input integral; a repeated timestamp adds nothing
+        if (decay > 0).all():
+            w1 = (decay - one_minus_e) / (a * decay)
+            w0 = one_minus_e / a - w1
+        else:
+            safe_decay = np.where(decay > 0, decay, 1.0)
+            w1 = np.where(decay > 0, (safe_decay - one_minus_e) / (a * safe_decay), 0.0)
+            w0 = np.where(decay > 0, one_minus_e / a - w1, 0.0)
+        forcing = air_exchange * (w0 * pm_in[start:end - 1] + w1 * pm_in[start + 1:end])
+
+        if end - start == 2:
+            # One interval: the plain update, which can't overflow however long the interval
+            block = np.exp(-decay) * C[:, None] + forcing
+        else:
+            # C[j] = exp(-L[j]) * (C[start] + sum_{i<j} forcing[i] * exp(L[i+1])), L = decay since the block start
+            growth = np.exp(np.cumsum(decay, axis=1))
+            block = (C[:, None] + np.cumsum(forcing * growth, axis=1)) / growth
+        yield slice(start + 1, end), block
+        C = block[:, -1]
+        start = end - 1
+
+def solve_exact(time_points, pm_in, V=V, Q=Q, k=k, C0=0.0):
+    """Exact solution of the model at every time point (hours), starting from C0.
+
+    Between two readings the outdoor concentration is a straight line (as
+    np.interp assumes in model), and for a linear input the equation has a
+    closed-form solution, so each interval is one update
+        C[i+1] = E*C[i] + (Q/V)*(w0*pm_in[i] + w1*pm_in[i+1]),  E = exp(-a*h),  a = Q/V + k
+    with no step size or resampling error. The recurrence is evaluated as
+    cumulative sums scaled by exp(decay so far), a block at a time so the
+    scale factors stay within float64 (see iter_exact_blocks).
+    """
+    C = np.empty(len(time_points))
+    for readings, block in iter_exact_blocks(time_points, pm_in, Q / V, k, C0=C0):
+        C[readings] = block[0]
+    return C
+
+def sample_homes(n_homes, seed=0):
+    """Random population of homes: one row per home with V, Q, k_off and k_on."""
+    rng = np.random.default_rng(seed)
+    volume = rng.uniform(*HOME_VOLUME_RANGE, n_homes)
+    air_changes = rng.uniform(*HOME_ACH_RANGE, n_homes)
+    return pd.DataFrame({
+        'V': volume,
+        'Q': air_changes * volume,
+        'k_off': rng.uniform(*HOME_K_OFF_RANGE, n_homes),
+        'k_on': rng.uniform(*HOME_K_ON_RANGE, n_homes),
+    })
+
+def simulate_ensemble(time_points, pm_in, relay_on, homes, series_path=None):
+    """Simulate every home in homes against one outdoor series.
+
+    homes has one row per home with V, Q, k_off and k_on (removal rate
+    while the relay is OFF and ON). Returns one summary row per home: mean
+    and max indoor PM2.5, the indoor/outdoor ratio of the means and the
+    fraction of readings above INDOOR_THRESHOLD. The full series are only
+    kept if series_path is given, as a float32 .npy of shape (readings, homes).
+    """
+    n_homes = len(homes)
+    n = len(time_points)
+    total = np.zeros(n_homes)
+    maximum = np.zeros(n_homes)
+    above = np.zeros(n_homes, dtype=np.int64)
+    series = None
+    if series_path is not None:
+        series = np.lib.format.open_memmap(series_path, mode='w+', dtype=np.float32, shape=(n, n_homes))
 
-        # Load the CSV file
-        data = pd.read_csv(file_path)
+    blocks = iter_exact_blocks(time_points, pm_in, homes['Q'].to_numpy() / homes['V'].to_numpy(),
+                               homes['k_off'].to_numpy(), homes['k_on'].to_numpy(), relay_on)
+    for readings, block in blocks:
+        block = np.maximum(0, block)
+        total += block.sum(axis=1)
+        maximum = np.maximum(maximum, block.max(axis=1))
+        above += (block > INDOOR_THRESHOLD).sum(axis=1)
+        if series is not None:
+            series[readings] = block.T
+    if series is not None:
+        series.flush()
 
-        # Ensure 'created_at' is parsed and 't_numeric' is created
+    summary = homes.reset_index(drop=True).copy()
+    summary.insert(0, 'home', np.arange(n_homes))
+    summary['mean_indoor'] = total / n if n else np.nan
+    summary['max_indoor'] = maximum
+    summary['indoor_outdoor_ratio'] = summary['mean_indoor'] / np.nanmean(pm_in) if n else np.nan
+    summary['fraction_above_threshold'] = above / n if n else np.nan
+    return summary
+
+def ensemble_file(file_path, homes, series_directory=None):
+    """simulate_ensemble for one processed sensor file, using its relay_state column."""
+    file_name = os.path.basename(file_path)
+    data = load_sensor_csv(file_path, columns=['PM2.5_CF1_ug/m3', 'relay_state'], keep_categories=True)
+    time_points = (data['created_at'] - data['created_at'].iloc[0]).dt.total_seconds().values / 3600
+    pm_in = data['PM2.5_CF1_ug/m3'].values.astype(float)
+    relay_on = relay_on_array(data['relay_state'])[0] if 'relay_state' in data else None
+
+    series_path = None
+    if series_directory is not None:
+        series_path = os.path.join(series_directory, file_name.replace('.csv', '.npy'))
+    summary = simulate_ensemble(time_points, pm_in, relay_on, homes, series_path)
+    summary.insert(0, 'sensor', file_name.replace('.csv', ''))
+    return summary
+
+def run_ensemble(homes=None, workers=WORKERS, series_directory=None):
+    """Run the home ensemble over every file in the input directory and write one summary CSV."""
+    if homes is None:
+        homes = sample_homes(ENSEMBLE_HOMES)
+    os.makedirs(os.path.dirname(ensemble_output), exist_ok=True)
+    if series_directory is not None:
+        os.makedirs(series_directory, exist_ok=True)
+    results, failures = run_files(partial(ensemble_file, homes=homes, series_directory=series_directory),
+                                  list_csv_files(input_directory), workers, desc="Simulating homes")
+    if results:
+        ensemble = pd.concat(results.values(), ignore_index=True)
+        ensemble.to_csv(ensemble_output, index=False)
+        print(f"Saved: {ensemble_output}")
+        return ensemble
+
+def hours_since_start(created_at):
+    """Time of each reading in hours since the first one, the time axis of the model."""
+    return (created_at - created_at.iloc[0]).dt.total_seconds() / 3600
+
+def estimate_indoor(time_points, pm_in, solver=SOLVER):
+    """Indoor PM2.5 at each time point, clipped at zero, using the chosen solver."""
+    if solver == 'exact':
+        C = solve_exact(time_points, pm_in)
+    elif solver == 'rk45':
+        C = solve_rk45(time_points, pm_in)
+    else:
+        raise ValueError(f"Unknown solver: {solver}")
+    return np.maximum(0, C)
+
+def compare_solvers(file_path, rtol=1e-8, atol=1e-8):
+    """Check solve_exact against RK45 on one file.
+
+    Returns the largest absolute difference between solve_exact and a tight
+    RK45 run evaluated at every reading, and between solve_exact and the
+    original 2000-sample RK45 output. The tight run steps no further than
+    one typical reading interval, so keep to sample-sized files.
+    """
+    data = load_sensor_csv(file_path, columns=['PM2.5_CF1_ug/m3'])
+    time_points = (data['created_at'] - data['created_at'].iloc[0]).dt.total_seconds().values / 3600
+    # solve_exact fills missing readings itself; give the RK45 runs the same input
+    pm_in = fill_missing_outdoor(time_points, data['PM2.5_CF1_ug/m3'].values.astype(float))
+
+    exact = solve_exact(time_points, pm_in)
+    tight = solve_ivp(model, [time_points[0], time_points[-1]], [0], t_eval=time_points,
+                      args=(V, Q, k, time_points, pm_in), method='RK45', rtol=rtol, atol=atol,
+                      max_step=np.median(np.diff(time_points))).y[0]
+    sampled = solve_rk45(time_points, pm_in)
+    return np.max(np.abs(exact - tight)), np.max(np.abs(exact - sampled))
+
+def process_file(file_path):
+    """Estimate indoor PM2.5 for one processed sensor file and save it to the output directory."""
+    file_name = os.path.basename(file_path)
+    note(f"Processing: {file_name}")
+
+    # Load only the columns the model and later scripts use
+    with stage('read') as timer:
+        # relay_state stays a Categorical: one byte per reading, written back out as 'ON'/'OFF'
+        data = load_sensor_csv(file_path, columns=MIXING_COLUMNS, keep_categories=True)
+        timer.rows = len(data)
+
+    # Ensure 'created_at' is parsed and 't_numeric' is created
+    with stage('parse', rows=len(data)):
         data['created_at'] = pd.to_datetime(data['created_at'])
-        data['t_numeric'] = (data['created_at'] - data['created_at'].iloc[0]).dt.total_seconds() / 3600
-
-        # Extract numeric time points and PM2.5 concentration
-        time_points = data['t_numeric'].values
-        pm_in = data['PM2.5_CF1_ug/m3'].values
-
-        # Solve the differential equation using solve_ivp
-        time_sim = np.linspace(time_points[0], time_points[-1], 2000)
-        solution = solve_ivp(
-            model,
-            [time_points[0], time_points[-1]],
-            [0],  # Initial condition C0 = 0
-            t_eval=time_sim,
-            args=(V, Q, k, pm_in),
-            method='RK45'  # Runge-Kutta solver
-        )
-
-        # Extract the simulated concentrations
-        C_sim = solution.y[0]
-
-        # Interpolate simulated indoor values for the original timestamps
-        data['Estimated_Indoor_PM2.5'] = np.maximum(0, np.interp(data['t_numeric'], time_sim, C_sim))
-
-        # Save the updated data with indoor estimates
-        output_path = os.path.join(output_directory, f"Updated_{file_name}")
+        data['t_numeric'] = hours_since_start(data['created_at'])
+
+    # Extract numeric time points and PM2.5 concentration
+    time_points = data['t_numeric'].values
+    pm_in = data['PM2.5_CF1_ug/m3'].values
+
+    # Estimated indoor values at the original timestamps
+    with stage('simulate', rows=len(data)):
+        data['Estimated_Indoor_PM2.5'] = estimate_indoor(time_points, pm_in).astype(np.float32)
+
+    # Save the updated data with indoor estimates
+    output_path = os.path.join(output_directory, f"Updated_{file_name}")
+    with stage('write_csv', rows=len(data)):
         data.to_csv(output_path, index=False)
-        print(f"Saved: {output_path}")
\ No newline at end of file
+    note(f"Saved: {output_path}")
+    return output_path
+
+def main(workers=WORKERS):
+    # Ensure the output directory exists
+    os.makedirs(output_directory, exist_ok=True)
+
+    # Cycle through all CSV files in the directory, one file per worker
+    log_path = start_log(stage_log_path(output_directory, 'mixing'))
+    results = run_files(process_file, list_csv_files(input_directory), workers, log_path=log_path)
+    write_summary(log_path)
+    return results
+
+if __name__ == '__main__':
+    main()
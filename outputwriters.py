@@ -0,0 +1,250 @@
+import io
+import os
+import json
+import shutil
+import zipfile
+import tempfile
+import numpy as np
+import pandas as pd
+
+from compactcolumns import write_legacy_csv
+from fileutils import atomic_write, side_path
+
+# Output formats for processed sensor files, besides the legacy CSV:
+#   'columnar'  every column, compressed, in <name>.npz (one array per column, read with read_columnar)
+#   'sidecar'   only created_at and the columns the simulator adds, in <name>_derived.npz,
+#               to be joined back onto the raw file by timestamp (attach_sidecar)
+#   'intervals' the relay's ON intervals, one row each, in relay_intervals/<name>.csv
+OUTPUT_FORMATS = ['csv', 'columnar', 'sidecar', 'intervals']
+INTERVAL_FOLDER = 'relay_intervals'
+TIMESTAMP_COLUMN = 'created_at'
+INTERVAL_COLUMNS = ['start', 'end', 'duration_s']
+
+
+def output_paths(csv_path):
+    """Where each format is written for a processed file whose legacy CSV would be csv_path."""
+    folder, filename = os.path.split(csv_path)
+    stem = os.path.splitext(filename)[0]
+    return {
+        'csv': csv_path,
+        'columnar': os.path.join(folder, f'{stem}.npz'),
+        'sidecar': os.path.join(folder, f'{stem}_derived.npz'),
+        'intervals': side_path(folder, INTERVAL_FOLDER, filename),
+    }
+
+
+class ColumnarWriter:
+    """Write a frame, one chunk at a time, to a compressed .npz with one array per column.
+
+    Chunks are appended to raw column files in a temporary folder and only
+    packed (deflated) into the .npz on close, so memory stays at one chunk
+    however long the file. Timestamps are stored as int64 nanoseconds and
+    text columns as int32 codes plus their categories.
+    """
+
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.columns = columns
+        self.entries = None
+        self.rows = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.temporary_folder = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.columnar')
+
+    def start(self, df):
+        self.entries = []
+        for index, name in enumerate(name for name in df.columns if self.columns is None or name in self.columns
+                                     or name == TIMESTAMP_COLUMN):
+            column = df[name]
+            entry = {'name': name, 'file': f'column_{index}'}
+            if pd.api.types.is_datetime64_any_dtype(column):
+                entry['kind'] = 'timestamp'
+                entry['tz'] = str(column.dt.tz) if column.dt.tz is not None else None
+                entry['dtype'] = 'int64'
+            elif pd.api.types.is_bool_dtype(column) or pd.api.types.is_numeric_dtype(column):
+                entry['kind'] = 'values'
+                entry['dtype'] = np.asarray(column).dtype.str
+            else:
+                entry['kind'] = 'category'
+                entry['dtype'] = 'int32'
+                entry['categories'] = []
+                entry['codes'] = {}
+            self.entries.append(entry)
+
+    def write(self, df):
+        if self.entries is None:
+            self.start(df)
+        for entry in self.entries:
+            column = df[entry['name']]
+            if entry['kind'] == 'timestamp':
+                values = column.to_numpy(dtype='datetime64[ns]').view(np.int64)
+            elif entry['kind'] == 'values':
+                values = np.asarray(column, dtype=entry['dtype'])
+            else:
+                for value in pd.unique(column.dropna().astype(str)):
+                    if value not in entry['codes']:
+                        entry['codes'][value] = len(entry['categories'])
+                        entry['categories'].append(value)
+                values = column.astype(object).map(entry['codes']).fillna(-1).to_numpy(dtype=np.int32)
+            with open(os.path.join(self.temporary_folder, entry['file']), 'ab') as f:
+                values.tofile(f)
+        self.rows += len(df)
+
+    def close(self):
+        """Pack the columns into the .npz."""
+        entries = self.entries or []
+        meta = {'rows': self.rows, 'columns': [{key: value for key, value in entry.items() if key != 'codes'}
+                                                for entry in entries]}
+        with atomic_write(self.path, 'wb') as f, zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('meta.npy', npy_bytes(np.array(json.dumps(meta))))
+            for entry in entries:
+                with archive.open(f"{entry['file']}.npy", 'w', force_zip64=True) as f:
+                    np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(
+                        np.dtype(entry['dtype'])), 'fortran_order': False, 'shape': (self.rows,)})
+                    with open(os.path.join(self.temporary_folder, entry['file']), 'rb') as column_file:
+                        shutil.copyfileobj(column_file, f)
+        shutil.rmtree(self.temporary_folder, ignore_errors=True)
+        return self.path
+
+
+def npy_bytes(array):
+    """An array in .npy format, as bytes."""
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+def read_columnar(path, columns=None):
+    """Frame written by ColumnarWriter, with only the given columns (created_at is always included).
+
+    Text columns come back as Categoricals.
+    """
+    with np.load(path) as archive:
+        meta = json.loads(str(archive['meta']))
+        data = {}
+        for entry in meta['columns']:
+            name = entry['name']
+            if columns is not None and name not in columns and name != TIMESTAMP_COLUMN:
+                continue
+            values = archive[entry['file']]
+            if entry['kind'] == 'timestamp':
+                series = pd.Series(pd.to_datetime(values.view('datetime64[ns]')))
+                data[name] = series.dt.tz_localize('UTC').dt.tz_convert(entry['tz']) if entry['tz'] else series
+            elif entry['kind'] == 'category':
+                data[name] = pd.Categorical.from_codes(values, entry['categories'])
+            else:
+                data[name] = values
+    return pd.DataFrame(data)
+
+
+def attach_sidecar(df, sidecar_path):
+    """Join a sidecar's derived columns onto the rows of df (its raw file) by created_at."""
+    sidecar = read_columnar(sidecar_path)
+    created_at = pd.Series(df[TIMESTAMP_COLUMN])
+    if len(sidecar) == len(df) and (sidecar[TIMESTAMP_COLUMN].to_numpy() == created_at.to_numpy()).all():
+        # The usual case: the sidecar was written from these very rows
+        for name in sidecar.columns.drop(TIMESTAMP_COLUMN):
+            df[name] = sidecar[name].to_numpy()
+        return df
+    return df.merge(sidecar, on=TIMESTAMP_COLUMN, how='left')
+
+
+class IntervalWriter:
+    """Write the relay's ON intervals to a CSV, one chunk of readings at a time.
+
+    An interval runs from the first ON reading to the next OFF reading
+    (end is blank if the relay is still ON at the last reading), so
+    duration_s matches relayevents.extract_relay_events.
+    """
+
+    def __init__(self, path, relay_column='relay_on'):
+        self.path = path
+        self.relay_column = relay_column
+        self.open_start = None  # Start of the interval still ON at the end of the last chunk
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        pd.DataFrame(columns=INTERVAL_COLUMNS).to_csv(path, index=False)
+
+    def write(self, df):
+        relay_on = df[self.relay_column].to_numpy(dtype=bool)
+        created_at = df[TIMESTAMP_COLUMN].reset_index(drop=True)
+        previous = np.int8(self.open_start is not None)
+        changes = np.diff(relay_on.astype(np.int8), prepend=previous)
+        starts = list(created_at.iloc[np.flatnonzero(changes == 1)])
+        ends = list(created_at.iloc[np.flatnonzero(changes == -1)])
+        if self.open_start is not None:
+            starts.insert(0, self.open_start)
+        self.open_start = starts.pop() if len(starts) > len(ends) else None
+        self.append(starts, ends)
+
+    def append(self, starts, ends):
+        if not starts:
+            return
+        intervals = pd.DataFrame({'start': starts, 'end': ends})
+        intervals['duration_s'] = (pd.to_datetime(intervals['end']) - pd.to_datetime(intervals['start'])).dt.total_seconds()
+        intervals.to_csv(self.path, mode='a', header=False, index=False)
+
+    def close(self):
+        if self.open_start is not None:
+            pd.DataFrame({'start': [self.open_start], 'end': [pd.NaT], 'duration_s': [np.nan]}).to_csv(
+                self.path, mode='a', header=False, index=False)
+            self.open_start = None
+        return self.path
+
+
+def read_relay_intervals(path):
+    """ON intervals written by IntervalWriter, with start and end parsed."""
+    intervals = pd.read_csv(path)
+    for column in ('start', 'end'):
+        intervals[column] = pd.to_datetime(intervals[column], utc=True, format='ISO8601')
+    return intervals
+
+
+def relay_on_from_intervals(created_at, intervals):
+    """Relay ON flag of each reading (in time order) from its file's ON intervals."""
+    timestamps = pd.to_datetime(pd.Series(created_at), utc=True).to_numpy(dtype='datetime64[ns]').view(np.int64)
+    if intervals.empty:
+        return np.zeros(len(timestamps), dtype=bool)
+    starts = intervals['start'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+    # An interval still open at the end of the file has no end
+    ends = intervals['end'].fillna(pd.Timestamp.max.tz_localize('UTC')).to_numpy(dtype='datetime64[ns]').view(np.int64)
+    position = np.searchsorted(starts, timestamps, side='right') - 1
+    return (position >= 0) & (timestamps < ends[np.maximum(position, 0)])
+
+
+class OutputWriter:
+    """The binary and interval outputs chosen in formats, for a processed file written whole or in chunks.
+
+    csv_path names the outputs (see output_paths); the legacy CSV itself is
+    left to the caller, which may append it with a checkpoint. derived
+    lists the columns the simulator added, for the sidecar.
+    """
+
+    def __init__(self, csv_path, formats, derived):
+        paths = output_paths(csv_path)
+        unknown = set(formats) - set(OUTPUT_FORMATS)
+        if unknown:
+            raise ValueError(f"Unknown output formats: {sorted(unknown)}")
+        self.writers = []
+        if 'columnar' in formats:
+            self.writers.append(ColumnarWriter(paths['columnar']))
+        if 'sidecar' in formats:
+            self.writers.append(ColumnarWriter(paths['sidecar'], columns=derived))
+        if 'intervals' in formats:
+            self.writers.append(IntervalWriter(paths['intervals']))
+
+    def write(self, df):
+        for writer in self.writers:
+            writer.write(df)
+
+    def close(self):
+        return [writer.close() for writer in self.writers]
+
+
+def write_outputs(df, csv_path, formats, derived):
+    """Write a whole processed frame in every format in formats. Returns the paths written."""
+    written = []
+    if 'csv' in formats:
+        write_legacy_csv(df, csv_path)
+        written.append(csv_path)
+    writer = OutputWriter(csv_path, formats, derived)
+    writer.write(df)
+    return written + writer.close()
@@ -0,0 +1,76 @@
+import os
+import traceback
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+from instrumentation import PEAK_RSS_RESETS, instrumented
+
+WORKERS = os.cpu_count() or 1  # Default number of worker processes
+
+
+def list_csv_files(directory):
+    """Sorted full paths of the CSV files in a directory."""
+    return [os.path.join(directory, filename) for filename in sorted(os.listdir(directory))
+            if filename.endswith('.csv')]
+
+
+def run_files(function, file_paths, workers=WORKERS, desc="Processing CSV files", log_path=None):
+    """Call function(file_path) for every file, one file per worker process.
+
+    Each file runs in a worker process, so module-level state in one file's
+    run can't leak into another file that is running at the same time.
+    Results are returned in the order of file_paths, whichever worker
+    finishes first. A file that raises is reported and the rest of the batch
+    carries on. With workers=1 everything runs in this process, which is
+    easier to debug.
+
+    Returns (results, failures): results maps each successful file path to
+    function's return value, failures maps each failed path to its traceback.
+
+    With log_path, every file's stages (see instrumentation.stage) are
+    appended to that JSON-lines log. Where a process's peak RSS can't be
+    reset between files, each file then gets a fresh worker, so its peak
+    is its own.
+    """
+    file_paths = list(file_paths)
+    pool_options = {}
+    if log_path is not None:
+        function = partial(instrumented, function, log_path)
+        if not PEAK_RSS_RESETS:
+            pool_options['max_tasks_per_child'] = 1
+    outcomes = {}
+
+    with tqdm(total=len(file_paths), desc=desc, unit="file") as progress_bar:
+        if workers <= 1 or len(file_paths) <= 1:
+            for file_path in file_paths:
+                try:
+                    outcomes[file_path] = (True, function(file_path))
+                except Exception as e:
+                    outcomes[file_path] = (False, ''.join(traceback.format_exception(e)))
+                progress_bar.update(1)
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(file_paths)), **pool_options) as executor:
+                futures = {executor.submit(function, file_path): file_path for file_path in file_paths}
+                for future in as_completed(futures):
+                    file_path = futures[future]
+                    try:
+                        outcomes[file_path] = (True, future.result())
+                    except Exception as e:
+                        outcomes[file_path] = (False, ''.join(traceback.format_exception(e)))
+                    progress_bar.update(1)
+
+    results = {}
+    failures = {}
+    for file_path in file_paths:
+        succeeded, value = outcomes[file_path]
+        if succeeded:
+            results[file_path] = value
+        else:
+            failures[file_path] = value
+
+    if failures:
+        print(f"{len(failures)} of {len(file_paths)} files failed:")
+        for file_path, error in failures.items():
+            print(f"--- {os.path.basename(file_path)}\n{error}")
+    return results, failures
@@ -0,0 +1,343 @@
+import os
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import historicalsimulation
+import areaundersim
+from baseline import daily_baselines
+from sensorcache import load_sensor_csv
+
+# Default grid, centred on the constants in historicalsimulation.py and areaundersim.py
+WINDOW_SIZES = [10, 20, 30]
+RISE_THRESHOLDS = [1.1, 1.25, 1.5, 2.0]
+BASELINE_THRESHOLD_MULTIPLIERS = [1.25, 1.5, 2.0]
+AREA_THRESHOLDS = [100, 250, 500, 1000, 2000]
+
+SWEEP_FOLDER = historicalsimulation.directory
+SWEEP_OUTPUT = os.path.join(historicalsimulation.PROCESSED_FOLDER, 'parameter_sweep.csv')
+
+
+def epoch_seconds(created_at):
+    """UTC epoch seconds for a parsed 'created_at' column."""
+    return historicalsimulation.to_utc(created_at).values.astype('datetime64[s]').astype(np.int64)
+
+
+class WindowSweep:
+    """State of historicalsimulation.simulate_relay for a grid of parameter combinations.
+
+    Every attribute holds one entry per combination. step() advances all of
+    them by one reading; advance_stable() jumps over a run of readings whose
+    baseline cannot change, finding relay transitions on a (params x time)
+    block instead of reading by reading.
+    """
+
+    def __init__(self, created_at, pm25, baseline_dict, window, rise, multiplier):
+        self.window = window
+        self.rise = rise
+        self.multiplier = multiplier
+        n_params = len(window)
+        self.params = np.arange(n_params)
+
+        timestamps = historicalsimulation.to_utc(created_at)
+        self.seconds = timestamps.values.astype('datetime64[s]').astype(np.int64)
+        minutes = self.seconds // 60
+        days = minutes // (24 * 60)
+        self.in_4am_slot = (minutes % (24 * 60)) // 60 == 4
+        self.day_change = np.r_[True, days[1:] != days[:-1]]
+        self.day_index = np.unique(days, return_inverse=True)[1]
+        self.today_baseline = historicalsimulation.lookup_daily_baselines(days, baseline_dict)
+        self.yesterday_baseline = historicalsimulation.lookup_daily_baselines(days - 1, baseline_dict)
+
+        # Rolling min/max once per distinct window size, stored time-major so a step reads one row
+        pm25 = pd.Series(np.asarray(pm25, dtype=float))
+        unique_windows, self.window_index = np.unique(window, return_inverse=True)
+        self.window_min = np.column_stack([pm25.rolling(size).min().to_numpy() for size in unique_windows])
+        self.window_max = np.column_stack([pm25.rolling(size).max().to_numpy() for size in unique_windows])
+
+        # Previous-baseline ring buffers, flattened to (params x max window). NaN
+        # baselines are stored as 0 plus a flag, so slots that are empty, NaN or
+        # finite can all be subtracted from the running sum the same way.
+        self.default = float(historicalsimulation.DEFAULT_BASELINE)
+        self.ring_start = self.params * window.max()
+        self.previous = np.zeros(n_params * window.max())
+        self.previous_nan = np.zeros(n_params * window.max(), dtype=bool)
+        self.previous_sum = np.zeros(n_params)
+        self.previous_nan_count = np.zeros(n_params, dtype=np.int64)
+        self.days_on_at_4am = np.zeros((self.day_index.max(initial=0) + 1, n_params), dtype=bool)
+
+        self.relay_on = np.zeros(n_params, dtype=bool)
+        self.on_since = np.zeros(n_params, dtype=np.int64)
+        self.on_rows = np.zeros(n_params, dtype=np.int64)
+        self.event_count = np.zeros(n_params, dtype=np.int64)
+        self.duration_sum = np.zeros(n_params)
+
+    def stable_rows(self):
+        """Mask of readings whose baseline equals the one before them for every combination.
+
+        The candidate baseline only changes at a new day or after a reading in
+        the 04:00-05:00 slot. Once a full window of readings has passed since
+        then, get_baseline_pm25's accept/reject decision can no longer flip
+        (accepting raises the average, rejecting lowers it). That only holds
+        for multipliers of at least 1, so with any below 1 no reading is stable.
+        """
+        if (self.multiplier < 1).any():
+            return np.zeros(len(self.seconds), dtype=bool)
+        trigger = self.day_change | self.in_4am_slot
+        rows = np.arange(len(trigger))
+        last_trigger = np.maximum.accumulate(np.where(trigger, rows, -1))
+        return rows - last_trigger > self.window.max()
+
+    def baseline_at(self, i):
+        """get_baseline_pm25 for reading i, using the previous-baseline ring buffers."""
+        candidate = np.where(self.days_on_at_4am[self.day_index[i]], self.yesterday_baseline[i],
+                             self.today_baseline[i])
+        if i:
+            average = self.previous_sum / np.minimum(i, self.window)
+            average[self.previous_nan_count > 0] = np.nan
+        else:
+            average = np.full(len(self.window), self.default)
+        return np.where((candidate < self.default) | (candidate > self.multiplier * average), self.default,
+                        candidate)
+
+    def push_baseline(self, i, baseline):
+        """Store reading i's baseline in the ring buffers, mirroring simulate_relay's running sum."""
+        slot = self.ring_start + i % self.window
+        self.previous_sum -= self.previous[slot]
+        self.previous_nan_count -= self.previous_nan[slot]
+        baseline_nan = np.isnan(baseline)
+        value = np.where(baseline_nan, 0, baseline)
+        self.previous[slot] = value
+        self.previous_nan[slot] = baseline_nan
+        self.previous_sum += value
+        self.previous_nan_count += baseline_nan
+
+    def step(self, i):
+        """Advance every combination by reading i."""
+        baseline = self.baseline_at(i)
+        low = self.window_min[i][self.window_index]
+        high = self.window_max[i][self.window_index]
+        turn_on = ~self.relay_on & (low > self.rise * baseline)
+        turn_off = self.relay_on & (high <= baseline)
+        if turn_on.any():
+            self.on_since[turn_on] = self.seconds[i]
+        if turn_off.any():
+            self.duration_sum[turn_off] += self.seconds[i] - self.on_since[turn_off]
+            self.event_count[turn_off] += 1
+        self.relay_on = (self.relay_on | turn_on) & ~turn_off
+        self.on_rows += self.relay_on
+        if self.in_4am_slot[i]:
+            self.days_on_at_4am[self.day_index[i]] |= self.relay_on
+        self.push_baseline(i, baseline)
+
+    def advance_stable(self, start, end):
+        """Advance every combination over readings start..end-1, all inside stable_rows()."""
+        baseline = self.baseline_at(start)
+        length = end - start
+        rise_ok = self.window_min[start:end][:, self.window_index].T > (self.rise * baseline)[:, None]
+        fall_ok = self.window_max[start:end][:, self.window_index].T <= baseline[:, None]
+        columns = np.arange(length)
+
+        # Each pass moves every unfinished combination to its next relay transition
+        position = np.zeros(len(self.window), dtype=np.int64)
+        active = self.params
+        while len(active):
+            hits = np.where(self.relay_on[active][:, None], fall_ok[active], rise_ok[active])
+            hits &= columns >= position[active][:, None]
+            found = hits.any(axis=1)
+
+            finished = active[~found]
+            self.on_rows[finished] += np.where(self.relay_on[finished], length - position[finished], 0)
+
+            active = active[found]
+            hit = hits[found].argmax(axis=1)
+            turning_off = self.relay_on[active]
+            off, on = active[turning_off], active[~turning_off]
+            self.on_rows[off] += hit[turning_off] - position[off]
+            self.duration_sum[off] += self.seconds[start + hit[turning_off]] - self.on_since[off]
+            self.event_count[off] += 1
+            self.on_since[on] = self.seconds[start + hit[~turning_off]]
+            self.on_rows[on] += 1
+            self.relay_on[active] = ~turning_off
+            position[active] = hit + 1
+            active = active[position[active] < length]
+
+        # Only the last window of readings is still in the ring buffers. When the
+        # run fills it, the sum is recomputed rather than replayed reading by
+        # reading, so it can differ from simulate_relay's in the last bit.
+        if length < self.window.max():
+            for i in range(start, end):
+                self.push_baseline(i, baseline)
+            return
+        baseline_nan = np.isnan(baseline)
+        in_window = np.arange(self.window.max()) < self.window[:, None]
+        self.previous[:] = np.where(in_window & ~baseline_nan[:, None], baseline[:, None], 0).ravel()
+        self.previous_nan[:] = (in_window & baseline_nan[:, None]).ravel()
+        self.previous_sum = np.where(baseline_nan, 0, baseline) * self.window
+        self.previous_nan_count = np.where(baseline_nan, self.window, 0)
+
+
+def sweep_window_algorithm(created_at, pm25, baseline_dict, window_sizes=WINDOW_SIZES,
+                           rise_thresholds=RISE_THRESHOLDS, baseline_multipliers=BASELINE_THRESHOLD_MULTIPLIERS):
+    """Evaluate historicalsimulation.simulate_relay for every parameter combination at once.
+
+    Readings near a change of candidate baseline are stepped one at a time
+    for the whole grid; the long stretches in between are handled as
+    (params x time) blocks. Combinations with a baseline multiplier below 1
+    have no such stretches (see WindowSweep.stable_rows), so they are swept
+    separately, a reading at a time. Returns one row of summary statistics
+    per combination.
+    """
+    grid = list(itertools.product(window_sizes, rise_thresholds, baseline_multipliers))
+    results = pd.DataFrame(grid, columns=['window_size', 'rise_threshold', 'baseline_multiplier'])
+    on_rows = np.zeros(len(grid), dtype=np.int64)
+    event_count = np.zeros(len(grid), dtype=np.int64)
+    duration_sum = np.zeros(len(grid))
+    below_one = results['baseline_multiplier'].to_numpy() < 1
+    for selected in (np.flatnonzero(~below_one), np.flatnonzero(below_one)):
+        if len(selected) == 0:
+            continue
+        sweep = run_window_sweep(created_at, pm25, baseline_dict, results.iloc[selected])
+        on_rows[selected] = sweep.on_rows
+        event_count[selected] = sweep.event_count
+        duration_sum[selected] = sweep.duration_sum
+    return summarize_sweep(results, len(pm25), on_rows, event_count, duration_sum)
+
+
+def run_window_sweep(created_at, pm25, baseline_dict, grid):
+    """Run a WindowSweep over every reading for the combinations in grid, one per row."""
+    sweep = WindowSweep(created_at, pm25, baseline_dict, grid['window_size'].to_numpy(),
+                        grid['rise_threshold'].to_numpy(dtype=float), grid['baseline_multiplier'].to_numpy(dtype=float))
+
+    stable = sweep.stable_rows()
+    boundaries = np.flatnonzero(np.diff(np.r_[False, stable, False]))
+    stable_runs = boundaries.reshape(-1, 2)
+    i = 0
+    for start, end in stable_runs:
+        while i < start:
+            sweep.step(i)
+            i += 1
+        sweep.advance_stable(start, end)
+        i = end
+    while i < len(stable):
+        sweep.step(i)
+        i += 1
+    return sweep
+
+
+def sweep_area_algorithm(created_at, pm25, baseline, area_thresholds=AREA_THRESHOLDS):
+    """Evaluate areaundersim.simulate_area_vectorized for every area threshold at once.
+
+    The cumulative area is shared, and each iteration advances every
+    threshold by one relay event with a vectorized searchsorted, so the loop
+    runs as many times as the busiest threshold has events.
+    """
+    thresholds = np.asarray(area_thresholds, dtype=float)
+    n_params = len(thresholds)
+    seconds = epoch_seconds(created_at)
+    pm25 = np.asarray(pm25, dtype=float)
+    baseline = np.asarray(baseline, dtype=float)
+    n = len(pm25)
+
+    excess = areaundersim.excess_above_baseline(pm25, baseline)
+    cumulative_area = np.concatenate(([0.0], np.cumsum((excess[1:] + excess[:-1]) / 2)))
+    below_baseline = np.flatnonzero(pm25 <= baseline)
+
+    reset_index = np.zeros(n_params, dtype=np.int64)
+    check_from = np.zeros(n_params, dtype=np.int64)
+    on_rows = np.zeros(n_params, dtype=np.int64)
+    event_count = np.zeros(n_params, dtype=np.int64)
+    duration_sum = np.zeros(n_params)
+    active = np.flatnonzero(check_from < n) if n else np.array([], dtype=np.int64)
+
+    while len(active):
+        on_index = np.searchsorted(cumulative_area, cumulative_area[reset_index[active]] + thresholds[active],
+                                   side='right')
+        on_index = np.maximum(on_index, check_from[active])
+        started = on_index < n
+        active, on_index = active[started], on_index[started]
+
+        position = np.searchsorted(below_baseline, on_index, side='right')
+        still_on = position == len(below_baseline)
+        on_rows[active[still_on]] += n - on_index[still_on]
+
+        active, on_index, position = active[~still_on], on_index[~still_on], position[~still_on]
+        off_index = below_baseline[position]
+        on_rows[active] += off_index - on_index
+        event_count[active] += 1
+        duration_sum[active] += seconds[off_index] - seconds[on_index]
+        reset_index[active] = off_index
+        check_from[active] = off_index + 1
+        active = active[check_from[active] < n]
+
+    results = pd.DataFrame({'area_threshold': thresholds})
+    return summarize_sweep(results, n, on_rows, event_count, duration_sum)
+
+
+def summarize_sweep(results, n, on_rows, event_count, duration_sum):
+    """Add relay-ON %, completed event count and mean event duration columns to a grid table."""
+    results['relay_on_percent'] = on_rows / n * 100 if n else 0.0
+    results['event_count'] = event_count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        results['mean_event_duration_s'] = np.where(event_count > 0, duration_sum / event_count, np.nan)
+    return results
+
+
+def sweep_file(file_path, window_sizes=WINDOW_SIZES, rise_thresholds=RISE_THRESHOLDS,
+               baseline_multipliers=BASELINE_THRESHOLD_MULTIPLIERS, area_thresholds=AREA_THRESHOLDS):
+    """Parse one sensor file once and sweep both detection algorithms over it."""
+    df = load_sensor_csv(file_path, columns=['PM2.5_CF1_ug/m3'])
+    historicalsimulation.add_date_columns(df)
+    baseline_dict = daily_baselines(file_path)
+
+    window_results = sweep_window_algorithm(df['created_at'], df['PM2.5_CF1_ug/m3'], baseline_dict,
+                                            window_sizes, rise_thresholds, baseline_multipliers)
+    window_results.insert(0, 'algorithm', 'window')
+
+    season = areaundersim.filter_season(df[['created_at', 'PM2.5_CF1_ug/m3']].copy())
+    areaundersim.add_baseline_column(season, baseline_dict, [])
+    area_results = sweep_area_algorithm(season['created_at'], season['PM2.5_CF1_ug/m3'],
+                                        season['baseline_pm25'], area_thresholds)
+    area_results.insert(0, 'algorithm', 'area')
+
+    results = pd.concat([window_results, area_results], ignore_index=True)
+    results['window_size'] = results['window_size'].astype('Int64')
+    results.insert(0, 'file', os.path.basename(file_path))
+    return results[['file', 'algorithm', 'window_size', 'rise_threshold', 'baseline_multiplier', 'area_threshold',
+                    'relay_on_percent', 'event_count', 'mean_event_duration_s']]
+
+
+def sweep_folder(folder=SWEEP_FOLDER, output_path=SWEEP_OUTPUT, **grid):
+    """Sweep every CSV in a folder and save one tidy table of results."""
+    csv_files = sorted(f for f in os.listdir(folder) if f.endswith('.csv'))
+    results = []
+    for filename in tqdm(csv_files, desc="Sweeping CSV files", unit="file"):
+        try:
+            results.append(sweep_file(os.path.join(folder, filename), **grid))
+        except Exception as e:
+            print(f"Error sweeping file {filename}: {e}")
+
+    results = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    results.to_csv(output_path, index=False)
+    print(f"Sweep results saved to {output_path}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep relay detection parameters over a folder of sensor files.")
+    parser.add_argument('--folder', default=SWEEP_FOLDER)
+    parser.add_argument('--output', default=SWEEP_OUTPUT)
+    parser.add_argument('--window-sizes', type=int, nargs='+', default=WINDOW_SIZES)
+    parser.add_argument('--rise-thresholds', type=float, nargs='+', default=RISE_THRESHOLDS)
+    parser.add_argument('--baseline-multipliers', type=float, nargs='+', default=BASELINE_THRESHOLD_MULTIPLIERS)
+    parser.add_argument('--area-thresholds', type=float, nargs='+', default=AREA_THRESHOLDS)
+    args = parser.parse_args()
+
+    sweep_folder(args.folder, args.output, window_sizes=args.window_sizes, rise_thresholds=args.rise_thresholds,
+                 baseline_multipliers=args.baseline_multipliers, area_thresholds=args.area_thresholds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import os
+import argparse
+from functools import partial
+import numpy as np
+import pandas as pd
+
+import eventanalysiscameronpeakfire
+import graphsimulations
+import historicalsimulation
+import mixing
+from baseline import daily_baselines
+from compactcolumns import write_legacy_csv
+from instrumentation import stage, stage_log_path, start_log, write_summary
+from parallelrunner import WORKERS, list_csv_files, run_files
+from relayevents import EventSummary, extract_relay_events, write_event_report
+from sensorcache import load_sensor_csv
+
+# Runs simulation -> indoor mixing -> event analysis -> exposure metrics -> plots for each
+# sensor file in one process, on the arrays already in memory, instead of each script
+# writing a CSV for the next one to parse. The reports are the same as the scripts'.
+INPUT_FOLDER = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/New files'
+PIPELINE_FOLDER = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/Pipeline'
+# Also write the _processed.csv and Updated_*.csv files, to the folders the scripts use, for tools still reading them
+WRITE_INTERMEDIATE = False
+PM25_COLUMN = 'PM2.5_CF1_ug/m3'
+EVENTS_REPORT = 'Eventanalysis2.csv'
+FIRE_EVENTS_REPORT = 'EventanalysisCameronPeakfire.csv'
+EXPOSURE_REPORT = 'relay_elevated_percentages_by_file.csv'
+EXPOSURE_CURVES_REPORT = 'exposure_curves_by_file.csv'
+FLEET_EXPOSURE_REPORT = 'exposure_curves_fleet.csv'
+PLOT_FOLDER = 'plots2'
+
+
+def write_updated_csv(df, time_points, indoor, path):
+    """The Updated_ file mixing.process_file would have written for this sensor."""
+    updated = df[['created_at', PM25_COLUMN, 'baseline_pm25', 'relay_on']].copy()
+    updated['t_numeric'] = time_points
+    updated['Estimated_Indoor_PM2.5'] = indoor
+    write_legacy_csv(updated, path)
+
+
+def run_sensor(file_path, output_folder=PIPELINE_FOLDER, write_intermediate=WRITE_INTERMEDIATE):
+    """Every stage for one sensor file, with the file read once.
+
+    Returns the file's event summaries (whole file and Cameron Peak fire
+    window) and its graphsimulations result row and exposure curve (None
+    when no reading falls in its time frame), for run_pipeline's reports.
+    """
+    filename = os.path.basename(file_path)
+    processed_name = filename.replace('.csv', '_processed.csv')
+    updated_name = f"Updated_{processed_name}"
+
+    with stage('read') as timer:
+        df = load_sensor_csv(file_path)
+        timer.rows = len(df)
+    with stage('baseline'):
+        baseline_dict = daily_baselines(file_path)
+
+    # Adds day, hour, baseline_pm25 and relay_on, timing its own stages
+    historicalsimulation.add_relay_columns(df, baseline_dict=baseline_dict)
+    if write_intermediate:
+        with stage('write_csv', rows=len(df)):
+            write_legacy_csv(df, os.path.join(historicalsimulation.PROCESSED_FOLDER, processed_name))
+
+    with stage('mixing', rows=len(df)):
+        time_points = mixing.hours_since_start(df['created_at']).to_numpy()
+        pm25 = df[PM25_COLUMN].to_numpy()
+        indoor = mixing.estimate_indoor(time_points, pm25).astype(np.float32)
+    if write_intermediate:
+        with stage('write_csv', rows=len(df)):
+            write_updated_csv(df, time_points, indoor, os.path.join(mixing.output_directory, updated_name))
+
+    relay_on = df['relay_on'].to_numpy()
+    created_at = df['created_at'].dt.tz_convert(None) if df['created_at'].dt.tz is not None else df['created_at']
+    with stage('events', rows=len(df)):
+        events = EventSummary.from_events(extract_relay_events(created_at, relay_on))
+        in_fire = ((created_at >= pd.Timestamp(eventanalysiscameronpeakfire.FIRE_START))
+                   & (created_at <= pd.Timestamp(eventanalysiscameronpeakfire.FIRE_END))).to_numpy()
+        fire_events = EventSummary.from_events(extract_relay_events(created_at[in_fire], relay_on[in_fire]))
+
+    # graphsimulations' time frame, leaving out readings without an outdoor value as it does
+    with stage('metrics', rows=len(df)):
+        in_frame = ((created_at >= pd.Timestamp(graphsimulations.start_time))
+                    & (created_at <= pd.Timestamp(graphsimulations.end_time))).to_numpy() & ~np.isnan(pm25)
+        exposure = None
+        curve = None
+        if in_frame.any():
+            exposure = {
+                'File': updated_name,
+                'Percentage_Elevated_When_Relay_ON':
+                    graphsimulations.elevated_percentage_when_relay_on(indoor[in_frame], relay_on[in_frame]),
+            }
+            curve = graphsimulations.exposure_curve(indoor[in_frame], relay_on[in_frame],
+                                                    graphsimulations.reading_hours(created_at[in_frame]))
+
+    with stage('plot', rows=len(df)):
+        historicalsimulation.plot_data(df, os.path.join(historicalsimulation.PROCESSED_FOLDER, processed_name))
+        if exposure is not None:
+            graphsimulations.plot_indoor_relay(df['created_at'][in_frame], pm25[in_frame], updated_name,
+                                               os.path.join(output_folder, PLOT_FOLDER))
+    return {'events': events, 'fire_events': fire_events, 'exposure': exposure, 'curve': curve}
+
+
+def run_pipeline(input_folder=INPUT_FOLDER, output_folder=PIPELINE_FOLDER, workers=WORKERS,
+                 write_intermediate=WRITE_INTERMEDIATE):
+    """run_sensor for every CSV in input_folder, one file per worker, then the reports.
+
+    Writes the whole-file and fire-window event reports
+    (averagetimebtwnevents, eventanalysiscameronpeakfire) and the
+    graphsimulations percentages and exposure curves to output_folder.
+    Returns the per-file results.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    log_path = start_log(stage_log_path(output_folder, 'pipeline'))
+    results, failures = run_files(partial(run_sensor, output_folder=output_folder,
+                                          write_intermediate=write_intermediate),
+                                  list_csv_files(input_folder), workers, log_path=log_path)
+    write_summary(log_path)
+
+    # Rows are named after the processed files, as in the scripts' reports
+    names = {file_path: os.path.basename(file_path).replace('.csv', '_processed') for file_path in results}
+    write_event_report({names[file_path]: result['events'] for file_path, result in results.items()},
+                       os.path.join(output_folder, EVENTS_REPORT))
+    write_event_report({names[file_path]: result['fire_events'] for file_path, result in results.items()},
+                       os.path.join(output_folder, FIRE_EVENTS_REPORT))
+
+    exposure_path = os.path.join(output_folder, EXPOSURE_REPORT)
+    pd.DataFrame([result['exposure'] for result in results.values()
+                  if result['exposure'] is not None]).to_csv(exposure_path, index=False)
+    print(f"Percentages by file saved to: {exposure_path}")
+    curves = {result['exposure']['File']: result['curve'] for result in results.values()
+              if result['exposure'] is not None}
+    if curves:
+        graphsimulations.write_exposure_curves(curves, os.path.join(output_folder, EXPOSURE_CURVES_REPORT),
+                                               os.path.join(output_folder, FLEET_EXPOSURE_REPORT))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run every stage on each sensor file without intermediate CSVs.")
+    parser.add_argument('input_folder', nargs='?', default=INPUT_FOLDER, help="Folder of raw sensor CSVs")
+    parser.add_argument('--output', default=PIPELINE_FOLDER, help="Folder for the reports and plots")
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--write-intermediate', action='store_true',
+                        help="Also write the _processed.csv and Updated_*.csv files the scripts exchange")
+    args = parser.parse_args()
+    run_pipeline(args.input_folder, args.output, args.workers, args.write_intermediate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+PLOT_BUCKETS = 1200  # Horizontal buckets per series, about one per pixel of a 12-inch figure at 100 dpi
+
+
+def to_plot_numbers(x):
+    """x values as float64 for bucketing: nanoseconds for datetimes, unchanged otherwise."""
+    x = pd.Series(x)
+    if pd.api.types.is_datetime64_any_dtype(x):
+        values = x.to_numpy(dtype='datetime64[ns]').astype(np.int64).astype(float)
+        values[x.isna().to_numpy()] = np.nan
+        return values
+    return x.to_numpy(dtype=float)
+
+
+def decimate_indices(x, y, buckets=PLOT_BUCKETS):
+    """Positions of the readings to draw so a line plot looks the same as with all of them.
+
+    The x range is cut into equal-width buckets and the lowest and highest
+    reading of each bucket are kept, so every peak survives and at most
+    2 * buckets points are drawn however long the series is. Readings with
+    NaN x or y are dropped. Positions come back in their original order.
+    """
+    x = to_plot_numbers(x)
+    y = np.asarray(y, dtype=float)
+    valid = np.flatnonzero(~np.isnan(x) & ~np.isnan(y))
+    if len(valid) <= 2 * buckets:
+        return valid
+
+    x_valid = x[valid]
+    low, high = x_valid.min(), x_valid.max()
+    bucket = np.minimum(((x_valid - low) / (high - low) * buckets).astype(np.int64), buckets - 1)
+
+    y_valid = y[valid]
+    if np.any(bucket[1:] < bucket[:-1]):
+        # Unsorted x: sort by bucket, then by value, so each bucket's first entry is its minimum and its last its maximum
+        order = np.lexsort((y_valid, bucket))
+        sorted_buckets = bucket[order]
+        firsts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+        lasts = np.r_[firsts[1:] - 1, len(order) - 1]
+        return np.unique(valid[np.r_[order[firsts], order[lasts]]])
+
+    # Time-ordered x: buckets are contiguous runs, so the extremes come from reduceat in one pass
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    run = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(bucket)]))
+    is_min = y_valid == np.minimum.reduceat(y_valid, starts)[run]
+    is_max = y_valid == np.maximum.reduceat(y_valid, starts)[run]
+    # First minimum and first maximum of each run
+    first_min = np.unique(run[is_min], return_index=True)[1]
+    first_max = np.unique(run[is_max], return_index=True)[1]
+    return np.unique(valid[np.r_[np.flatnonzero(is_min)[first_min], np.flatnonzero(is_max)[first_max]]])
+
+
+def decimated_line(x, y, buckets=PLOT_BUCKETS):
+    """(x, y) to pass to plot: the decimated readings, with a NaN break wherever a bucket has no data."""
+    keep = decimate_indices(x, y, buckets)
+    x_numbers = to_plot_numbers(x)
+    x_kept = pd.Series(x).iloc[keep].to_numpy()
+    y_kept = np.asarray(y, dtype=float)[keep]
+    if len(keep) < 2:
+        return x_kept, y_kept
+
+    # A jump of more than two bucket widths means a stretch with no readings; break the line there
+    bucket_width = (x_numbers[keep[-1]] - x_numbers[keep[0]]) / buckets
+    gaps = np.flatnonzero(np.diff(x_numbers[keep]) > 2 * bucket_width)
+    x_kept = np.insert(x_kept, gaps + 1, x_kept[gaps])
+    y_kept = np.insert(y_kept, gaps + 1, np.nan)
+    return x_kept, y_kept
+
+
+def plot_decimated(ax, x, y, buckets=PLOT_BUCKETS, **kwargs):
+    """ax.plot of a long series through decimated_line."""
+    x_kept, y_kept = decimated_line(x, y, buckets)
+    return ax.plot(x_kept, y_kept, **kwargs)
+
+
+def scatter_decimated(ax, x, y, mask, buckets=PLOT_BUCKETS, **kwargs):
+    """ax.scatter of the readings where mask is True (e.g. relay ON), decimated like plot_decimated."""
+    y = np.where(np.asarray(mask, dtype=bool), np.asarray(y, dtype=float), np.nan)
+    keep = decimate_indices(x, y, buckets)
+    return ax.scatter(pd.Series(x).iloc[keep], y[keep], **kwargs)
@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+
+EVENT_COLUMNS = ['start', 'end', 'duration_s', 'gap_since_previous_s']
+SKETCH_RELATIVE_ACCURACY = 0.01  # Quantiles from the sketch are within 1% of the exact value
+
+
+def relay_on_array(relay_state):
+    """Boolean ON array and a mask of the rows that hold a relay state at all.
+
+    relay_state can be the 'ON'/'OFF' strings written by the simulators or
+    booleans. Rows that are neither (blank cells) are left out of the mask.
+    """
+    relay_state = pd.Series(relay_state)
+    if pd.api.types.is_bool_dtype(relay_state):
+        return relay_state.to_numpy(), np.ones(len(relay_state), dtype=bool)
+    if isinstance(relay_state.dtype, pd.CategoricalDtype):
+        # Compare the small integer codes rather than millions of strings
+        codes = relay_state.cat.codes.to_numpy()
+        categories = list(relay_state.cat.categories)
+        on_code = categories.index('ON') if 'ON' in categories else -2
+        off_code = categories.index('OFF') if 'OFF' in categories else -2
+        relay_on = codes == on_code
+        return relay_on, relay_on | (codes == off_code)
+    relay_on = (relay_state == 'ON').to_numpy()
+    return relay_on, relay_on | (relay_state == 'OFF').to_numpy()
+
+
+def extract_relay_events(created_at, relay_state):
+    """Table of relay events, one row per ON -> OFF cycle.
+
+    An event starts at the first ON reading and ends at the first OFF
+    reading after it, so duration_s is the time from that ON to that OFF.
+    gap_since_previous_s is the time from the previous event's end to this
+    event's start (NaN for the first event). An event still ON at the end
+    of the data has no end and is left out. Rows without a relay state are
+    skipped, the same as the row loops this replaces.
+    """
+    relay_on, has_state = relay_on_array(relay_state)
+    timestamps = pd.Series(created_at).reset_index(drop=True)
+    if not has_state.all():
+        relay_on = relay_on[has_state]
+        timestamps = timestamps[has_state].reset_index(drop=True)
+
+    # +1 where the relay switches ON, -1 where it switches OFF
+    changes = np.diff(relay_on.astype(np.int8), prepend=np.int8(0))
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    # Every OFF switch follows an ON switch, so only the last start can be unmatched
+    starts = starts[:len(ends)]
+
+    # Only the timestamps at the switches are ever looked at
+    start = pd.to_datetime(timestamps.iloc[starts]).reset_index(drop=True)
+    end = pd.to_datetime(timestamps.iloc[ends]).reset_index(drop=True)
+    duration_s = (end - start).dt.total_seconds().to_numpy()
+    gap_since_previous_s = np.full(len(starts), np.nan)
+    gap_since_previous_s[1:] = (start.iloc[1:].to_numpy() - end.iloc[:-1].to_numpy()) / np.timedelta64(1, 's')
+    return pd.DataFrame({'start': start, 'end': end, 'duration_s': duration_s,
+                         'gap_since_previous_s': gap_since_previous_s}, columns=EVENT_COLUMNS)
+
+
+class QuantileSketch:
+    """Mergeable quantile estimate for non-negative values, within a relative error.
+
+    Values are counted in logarithmic buckets, so a few hundred counters
+    cover everything from two-minute gaps to months-long events and two
+    sketches merge by adding their counts.
+    """
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.log_gamma = np.log1p(2 * relative_accuracy / (1 - relative_accuracy))
+        self.zero_count = 0
+        self.bucket_counts = {}
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        buckets, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64),
+                                    return_counts=True)
+        for bucket, count in zip(buckets.tolist(), counts.tolist()):
+            self.bucket_counts[bucket] = self.bucket_counts.get(bucket, 0) + count
+
+    def merge(self, other):
+        self.zero_count += other.zero_count
+        for bucket, count in other.bucket_counts.items():
+            self.bucket_counts[bucket] = self.bucket_counts.get(bucket, 0) + count
+        return self
+
+    def quantile(self, q):
+        """Value at quantile q (0-1), or NaN if the sketch is empty."""
+        total = self.zero_count + sum(self.bucket_counts.values())
+        if total == 0:
+            return np.nan
+        rank = q * (total - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for bucket in sorted(self.bucket_counts):
+            seen += self.bucket_counts[bucket]
+            if rank < seen:
+                break
+        # Middle of the bucket (gamma^(i-1), gamma^i], in relative terms
+        return 2 * np.exp(bucket * self.log_gamma) / (1 + np.exp(self.log_gamma))
+
+
+class StatSummary:
+    """Count, exact sum, sum of squares, min/max and a quantile sketch of a set of values.
+
+    Summaries of separate files (or separate workers) merge into the
+    summary of all of them without going back to the data.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.sketch = QuantileSketch()
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.total += values.sum()
+        self.total_squares += np.square(values).sum()
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        self.sketch.add(values)
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def mean(self):
+        return self.total / self.count if self.count else np.nan
+
+    def std(self):
+        if not self.count:
+            return np.nan
+        return np.sqrt(max(self.total_squares / self.count - self.mean() ** 2, 0.0))
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+
+
+class EventSummary:
+    """Mergeable summary of the relay events of one or more files."""
+
+    def __init__(self):
+        self.files = 0
+        self.durations = StatSummary()
+        self.gaps = StatSummary()
+
+    @classmethod
+    def from_events(cls, events):
+        """Summary of one file's extract_relay_events table."""
+        summary = cls()
+        summary.files = 1
+        summary.durations.add(events['duration_s'])
+        summary.gaps.add(events['gap_since_previous_s'])
+        return summary
+
+    @property
+    def events(self):
+        return self.durations.count
+
+    def merge(self, other):
+        self.files += other.files
+        self.durations.merge(other.durations)
+        self.gaps.merge(other.gaps)
+        return self
+
+    @classmethod
+    def merge_all(cls, summaries):
+        merged = cls()
+        for summary in summaries:
+            merged.merge(summary)
+        return merged
+
+
+def seconds_to_days_hours(seconds):
+    """Convert seconds to days:hours format."""
+    days = seconds // (24 * 3600)
+    hours = (seconds % (24 * 3600)) // 3600
+    return f"{int(days)}:{int(hours)}"
+
+
+def days_hours(seconds):
+    """seconds_to_days_hours, with "0:0" when there is nothing to average."""
+    return seconds_to_days_hours(seconds) if seconds == seconds else "0:0"
+
+
+def report_row(summary):
+    """One row of the folder report from an EventSummary."""
+    return {
+        "Total Events": summary.events,
+        "Average Event Duration (days:hours)": days_hours(summary.durations.mean()),
+        "Average Time Between Events (days:hours)": days_hours(summary.gaps.mean()),
+        "Median Event Duration (days:hours)": days_hours(summary.durations.quantile(0.5)),
+        "P90 Event Duration (days:hours)": days_hours(summary.durations.quantile(0.9)),
+        "Median Time Between Events (days:hours)": days_hours(summary.gaps.quantile(0.5)),
+        "P90 Time Between Events (days:hours)": days_hours(summary.gaps.quantile(0.9)),
+    }
+
+
+def write_event_report(summaries, output_file_path):
+    """Write the per-file (or per-sensor) report of EventSummaries with the fleet averages, keyed like summaries."""
+    # One row per file
+    all_results = pd.DataFrame.from_dict(
+        {name: report_row(summary) for name, summary in summaries.items()}, orient='index')
+
+    # Merge the per-file summaries for the overall averages, medians and p90s
+    if summaries:
+        fleet = EventSummary.merge_all(summaries.values())
+        averages = report_row(fleet)
+        averages["Total Events"] = fleet.events / fleet.files
+        all_results.loc['Averages'] = averages
+
+    # Save the DataFrame to a CSV file
+    all_results.to_csv(output_file_path, index=True)
+    print(f"Results saved to {output_file_path}")
+    return all_results
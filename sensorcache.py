@@ -0,0 +1,434 @@
+"""Columnar cache of sensor CSVs: each column parsed once and kept as a typed binary file.
+
+A column's kind (timestamp, float, integer number or text category) is
+decided from the first chunk it appears in. If a later chunk of a float or
+integer column holds text, the cache is rebuilt with that column read as
+text from the start, so the values are never lost to NaN. A column that is
+blank in its first chunk is taken as float until then.
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+from fileutils import write_json
+
+CACHE_DIRNAME = '.columnar_cache'  # Cache folder created next to each source CSV
+TIMESTAMP_COLUMN = 'created_at'
+HASH_BLOCK_SIZE = 1 << 20
+CHUNK_SIZE = 500_000  # Rows parsed or decoded at a time
+CACHE_VERSION = 4  # Bumped whenever the on-disk layout changes
+STORAGE_DTYPES = {'timestamp': 'int64', 'float': 'float64', 'number': 'float64', 'category': 'int32'}
+
+
+class ColumnKindChanged(ValueError):
+    """A float or integer column holds text in a later chunk, so it has to be stored as text."""
+
+    def __init__(self, name):
+        super().__init__(f"Column {name} holds text after chunks of numbers")
+        self.name = name
+
+
+def cache_path(file_path):
+    """Folder holding the columnar copy of a CSV."""
+    folder, filename = os.path.split(os.path.abspath(file_path))
+    return os.path.join(folder, CACHE_DIRNAME, filename)
+
+
+def file_hash(file_path):
+    """SHA-1 of a file's contents."""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def prefix_and_file_hash(file_path, prefix_size):
+    """(SHA-1 of the first prefix_size bytes, SHA-1 of the whole file, the byte just before prefix_size).
+
+    One pass over the file, so checking whether a file only grew at the end
+    costs no more than hashing it.
+    """
+    digest = hashlib.sha1()
+    prefix_digest = None
+    last_prefix_byte = b''
+    position = 0
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            if prefix_digest is None and position + len(block) >= prefix_size:
+                digest.update(block[:prefix_size - position])
+                prefix_digest = digest.copy()
+                last_prefix_byte = block[prefix_size - position - 1:prefix_size - position] if prefix_size else b''
+                digest.update(block[prefix_size - position:])
+            else:
+                digest.update(block)
+            position += len(block)
+    if prefix_digest is None:
+        prefix_digest = digest.copy()
+    return prefix_digest.hexdigest(), digest.hexdigest(), last_prefix_byte
+
+
+def read_manifest(cache_folder):
+    try:
+        with open(os.path.join(cache_folder, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(cache_folder, manifest):
+    write_json(os.path.join(cache_folder, 'manifest.json'), manifest, indent=1)
+
+
+def cache_status(file_path, manifest):
+    """Compare a manifest with the source file.
+
+    Returns ('current', None), ('appended', sha1) when the file is the cached
+    contents plus new lines at the end, or ('stale', None). Size and mtime
+    are checked first; the file is only hashed when they differ.
+    """
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return 'stale', None
+    stat = os.stat(file_path)
+    if manifest['source_size'] == stat.st_size and manifest['source_mtime'] == stat.st_mtime:
+        return 'current', None
+    if stat.st_size < manifest['source_size']:
+        return 'stale', None
+    prefix_sha1, source_sha1, last_prefix_byte = prefix_and_file_hash(file_path, manifest['source_size'])
+    if source_sha1 == manifest['source_sha1']:
+        # Touched but unchanged: remember the new mtime so the hash isn't recomputed next time
+        manifest['source_mtime'] = stat.st_mtime
+        write_manifest(cache_path(file_path), manifest)
+        return 'current', None
+    if prefix_sha1 == manifest['source_sha1'] and last_prefix_byte == b'\n':
+        return 'appended', source_sha1
+    return 'stale', None
+
+
+def is_cache_current(file_path, manifest):
+    """Check a manifest against the source file: size and mtime first, then the content hash."""
+    return cache_status(file_path, manifest)[0] == 'current'
+
+
+def column_kind(column):
+    """Storage kind for a column, decided from the first chunk it appears in."""
+    if column.name == TIMESTAMP_COLUMN:
+        return 'timestamp'
+    if pd.api.types.is_float_dtype(column):
+        return 'float'
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.is_integer_dtype(column):
+        return 'number'
+    return 'category'
+
+
+def encode_chunk(column, entry, manifest, category_codes):
+    """Convert one chunk of a column to the stored dtype, updating the manifest as needed."""
+    kind = entry['kind']
+    if kind == 'timestamp':
+        parsed = pd.to_datetime(column, errors='coerce', utc=True)
+        if manifest['tz_aware'] is None and column.notna().any():
+            manifest['tz_aware'] = bool(pd.to_datetime(column.dropna().head(1)).dt.tz is not None)
+        values = parsed.values.astype('datetime64[ns]').astype(np.int64)
+        valid = values[~parsed.isna().to_numpy()]
+        if parsed.isna().any() or np.any(valid[1:] < valid[:-1]) or (
+                len(valid) and manifest['last_timestamp'] is not None and valid[0] < manifest['last_timestamp']):
+            manifest['sorted'] = False
+        if len(valid):
+            manifest['last_timestamp'] = int(valid[-1])
+        return values
+    if kind in ('float', 'number'):
+        numbers = pd.to_numeric(column, errors='coerce')
+        if numbers.isna().sum() > column.isna().sum():
+            raise ColumnKindChanged(column.name)
+        values = numbers.to_numpy(dtype=np.float64)
+    if kind == 'float':
+        return values
+    if kind == 'number':
+        # Integer columns are restored as int64 unless a chunk turns out to hold NaN or fractions
+        if entry['integer'] and not np.all(np.mod(values, 1) == 0):
+            entry['integer'] = False
+        return values
+    new = [value for value in pd.unique(column.dropna().astype(object)) if value not in category_codes]
+    for value in new:
+        category_codes[value] = len(entry['categories'])
+        entry['categories'].append(str(value))
+    return column.map(category_codes).fillna(-1).to_numpy(dtype=np.int32)
+
+
+def build_cache(file_path, chunksize=CHUNK_SIZE, text_columns=()):
+    """Parse a CSV once, in chunks, and store each column as a typed binary file.
+
+    Timestamps become int64 nanoseconds since the epoch (UTC), float and
+    integer columns float64 (integers restored as int64 when they have no
+    gaps), and text columns integer codes plus a list of categories.
+    Concentrations keep full precision, so baselines and threshold
+    comparisons see the same values as a plain read_csv.
+    Memory use is bounded by the chunk size, not the file size. text_columns
+    are read as text whatever their first chunk looks like; a numeric column
+    that turns out to hold text restarts the build with it added there.
+    """
+    stat = os.stat(file_path)
+    cache_folder = cache_path(file_path)
+    temporary_folder = cache_folder + '.tmp'
+    shutil.rmtree(temporary_folder, ignore_errors=True)
+    os.makedirs(temporary_folder)
+
+    manifest = {
+        'version': CACHE_VERSION,
+        'source_size': stat.st_size,
+        'source_mtime': stat.st_mtime,
+        'source_sha1': file_hash(file_path),
+        'rows': 0,
+        'tz_aware': None,
+        'sorted': True,
+        'last_timestamp': None,
+        'columns': [],
+    }
+    entries = {}
+    category_codes = {}
+    files = {}
+
+    try:
+        for chunk in pd.read_csv(file_path, chunksize=chunksize, dtype={name: str for name in text_columns}):
+            for name in chunk.columns:
+                if name not in entries:
+                    index = len(entries)
+                    kind = 'category' if name in text_columns else column_kind(chunk[name])
+                    entry = {'name': name, 'file': f'column_{index}.bin', 'kind': kind}
+                    entry['dtype'] = STORAGE_DTYPES[entry['kind']]
+                    if entry['kind'] == 'number':
+                        entry['integer'] = True
+                        entry['boolean'] = pd.api.types.is_bool_dtype(chunk[name])
+                    elif entry['kind'] == 'category':
+                        entry['categories'] = []
+                    entries[name] = entry
+                    category_codes[name] = {}
+                    files[name] = open(os.path.join(temporary_folder, entry['file']), 'wb')
+                values = encode_chunk(chunk[name], entries[name], manifest, category_codes[name])
+                values.astype(entries[name]['dtype']).tofile(files[name])
+            manifest['rows'] += len(chunk)
+    except ColumnKindChanged as e:
+        # Start over with the column read as text, so its earlier chunks are stored as text too
+        text_column = e.name
+    else:
+        text_column = None
+    finally:
+        for f in files.values():
+            f.close()
+    if text_column is not None:
+        return build_cache(file_path, chunksize, (*text_columns, text_column))
+
+    manifest['tz_aware'] = bool(manifest['tz_aware'])
+    manifest['columns'] = list(entries.values())
+    write_manifest(temporary_folder, manifest)
+    shutil.rmtree(cache_folder, ignore_errors=True)
+    os.rename(temporary_folder, cache_folder)
+    return manifest
+
+
+def extend_cache(file_path, manifest, source_sha1, chunksize=CHUNK_SIZE):
+    """Add the lines appended to a CSV since its cache was built, parsing only those.
+
+    The previous (rows, source_sha1) is kept in the manifest's history, so
+    results computed from the shorter file (baselines, simulator
+    checkpoints) can tell which rows are new. Falls back to build_cache if
+    the new lines don't parse as the same columns.
+    """
+    stat = os.stat(file_path)
+    cache_folder = cache_path(file_path)
+    entries = manifest['columns']
+    category_codes = {entry['name']: {value: code for code, value in enumerate(entry.get('categories', []))}
+                      for entry in entries}
+    previous = {'rows': manifest['rows'], 'source_sha1': manifest['source_sha1']}
+
+    files = {}
+    parsed = True
+    try:
+        for entry in entries:
+            path = os.path.join(cache_folder, entry['file'])
+            # Drop anything past the recorded rows, e.g. from an interrupted extend
+            with open(path, 'r+b') as f:
+                f.truncate(manifest['rows'] * np.dtype(entry['dtype']).itemsize)
+            files[entry['name']] = open(path, 'ab')
+        with open(file_path, 'rb') as source:
+            source.seek(manifest['source_size'])
+            for chunk in pd.read_csv(source, header=None, names=[entry['name'] for entry in entries],
+                                     chunksize=chunksize):
+                for entry in entries:
+                    values = encode_chunk(chunk[entry['name']], entry, manifest, category_codes[entry['name']])
+                    values.astype(entry['dtype']).tofile(files[entry['name']])
+                manifest['rows'] += len(chunk)
+    except (ValueError, pd.errors.ParserError):
+        parsed = False
+    finally:
+        for f in files.values():
+            f.close()
+    if not parsed:
+        return build_cache(file_path, chunksize)
+
+    manifest['history'] = manifest.get('history', []) + [previous]
+    manifest['source_size'] = stat.st_size
+    manifest['source_mtime'] = stat.st_mtime
+    manifest['source_sha1'] = source_sha1
+    write_manifest(cache_folder, manifest)
+    return manifest
+
+
+def appended_rows_since(manifest, source_sha1):
+    """Number of cached rows the file had when its hash was source_sha1, or None if it wasn't a prefix."""
+    if source_sha1 == manifest['source_sha1']:
+        return manifest['rows']
+    for previous in manifest.get('history', []):
+        if previous['source_sha1'] == source_sha1:
+            return previous['rows']
+    return None
+
+
+def open_cache(file_path):
+    """Build, extend or reuse the cache for a CSV. Returns (cache_folder, manifest, entries by column name)."""
+    cache_folder = cache_path(file_path)
+    manifest = read_manifest(cache_folder)
+    status, source_sha1 = cache_status(file_path, manifest)
+    if status == 'appended':
+        manifest = extend_cache(file_path, manifest, source_sha1)
+    elif status == 'stale':
+        manifest = build_cache(file_path)
+
+    entries = {entry['name']: entry for entry in manifest['columns']}
+    if TIMESTAMP_COLUMN not in entries:
+        raise KeyError(f"{file_path} has no '{TIMESTAMP_COLUMN}' column")
+    return cache_folder, manifest, entries
+
+
+def column_values(cache_folder, manifest, entry):
+    """Memory-mapped stored values of one column."""
+    if manifest['rows'] == 0:
+        return np.empty(0, dtype=entry['dtype'])
+    return np.memmap(os.path.join(cache_folder, entry['file']), dtype=entry['dtype'], mode='r',
+                     shape=(manifest['rows'],))
+
+
+def decode_column(values, entry, manifest, keep_categories=False):
+    """Turn stored values back into what pd.read_csv + pd.to_datetime would give.
+
+    With keep_categories, text columns stay pandas Categoricals instead of
+    object strings, which is much cheaper for columns like relay_state.
+    """
+    if entry['kind'] == 'timestamp':
+        series = pd.Series(pd.to_datetime(np.asarray(values, dtype='datetime64[ns]')).tz_localize('UTC'))
+        return series if manifest['tz_aware'] else series.dt.tz_localize(None)
+    if entry['kind'] == 'category':
+        series = pd.Series(pd.Categorical.from_codes(np.asarray(values), entry['categories']))
+        return series if keep_categories else series.astype(object)
+    if entry['kind'] == 'number' and entry['integer']:
+        return np.asarray(values, dtype=bool if entry['boolean'] else np.int64)
+    return np.array(values)
+
+
+def row_selection(timestamps, manifest, start, end, months):
+    """Slice or mask of rows inside [start, end] and the given months, from the timestamp column alone."""
+    selection = slice(None)
+    if start is not None or end is not None:
+        start_ns = to_epoch_ns(start) if start is not None else None
+        end_ns = to_epoch_ns(end) if end is not None else None
+        if manifest['sorted']:
+            # Sorted timestamps: the range is a contiguous block, no need to scan
+            first = np.searchsorted(timestamps, start_ns, side='left') if start_ns is not None else 0
+            last = np.searchsorted(timestamps, end_ns, side='right') if end_ns is not None else len(timestamps)
+            selection = slice(first, last)
+        else:
+            in_range = timestamps != np.iinfo(np.int64).min
+            if start_ns is not None:
+                in_range &= timestamps >= start_ns
+            if end_ns is not None:
+                in_range &= timestamps <= end_ns
+            selection = in_range
+
+    if months is not None:
+        positions = np.arange(len(timestamps))[selection]
+        selected = timestamps[positions]
+        month = selected.view('datetime64[ns]').astype('datetime64[M]').astype(np.int64) % 12 + 1
+        keep = np.isin(month, months) & (selected != np.iinfo(np.int64).min)
+        selection = positions[keep]
+    return selection
+
+
+def to_epoch_ns(value):
+    """Epoch nanoseconds for a bound, read as UTC unless it carries its own timezone."""
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.value
+
+
+def load_sensor_csv(file_path, columns=None, start=None, end=None, months=None, use_cache=True,
+                    keep_categories=False, first_row=0):
+    """Read a PurpleAir CSV through its columnar cache.
+
+    The CSV is parsed once and the cache is rebuilt only when the source
+    changes. columns limits which columns are read (created_at is always
+    included; names the file doesn't have are left out), start/end keep
+    readings in an inclusive time range and months keeps readings from
+    those calendar months. Only the timestamp column is read to pick the
+    rows. created_at comes back already parsed, in UTC for timezone-aware
+    sources. keep_categories returns text columns as Categoricals.
+    first_row skips the file's earlier rows, e.g. those already processed
+    before new data was appended. iter_sensor_chunks reads the same rows a
+    block at a time.
+    """
+    if not use_cache:
+        df = pd.read_csv(file_path, usecols=lambda name: columns is None or name in columns
+                         or name == TIMESTAMP_COLUMN)
+        tz_aware = pd.to_datetime(df[TIMESTAMP_COLUMN].dropna().head(1)).dt.tz is not None
+        df[TIMESTAMP_COLUMN] = pd.to_datetime(df[TIMESTAMP_COLUMN], errors='coerce', utc=True)
+        if not tz_aware:
+            df[TIMESTAMP_COLUMN] = df[TIMESTAMP_COLUMN].dt.tz_localize(None)
+        df = df.iloc[first_row:]
+        timestamps = df[TIMESTAMP_COLUMN].values.astype('datetime64[ns]').astype(np.int64)
+        selection = row_selection(timestamps, {'sorted': False}, start, end, months)
+        df = df.iloc[selection].reset_index(drop=True)
+        if keep_categories:
+            text_columns = [name for name in df.columns if name != TIMESTAMP_COLUMN
+                            and not pd.api.types.is_numeric_dtype(df[name])]
+            df[text_columns] = df[text_columns].astype('category')
+        return df
+
+    cache_folder, manifest, entries = open_cache(file_path)
+    timestamps = column_values(cache_folder, manifest, entries[TIMESTAMP_COLUMN])[first_row:]
+    selection = row_selection(timestamps, manifest, start, end, months)
+
+    data = {}
+    for name, entry in entries.items():
+        if columns is not None and name not in columns and name != TIMESTAMP_COLUMN:
+            continue
+        data[name] = decode_column(column_values(cache_folder, manifest, entry)[first_row:][selection], entry, manifest,
+                                   keep_categories)
+    return pd.DataFrame(data)
+
+
+def iter_sensor_chunks(file_path, columns=None, start=None, end=None, months=None, chunksize=CHUNK_SIZE,
+                       keep_categories=False, first_row=0):
+    """Like load_sensor_csv, but yields the rows in DataFrames of at most chunksize readings.
+
+    Columns are memory-mapped and only one chunk is decoded at a time, so
+    memory stays flat however long the sensor history is.
+    """
+    cache_folder, manifest, entries = open_cache(file_path)
+    names = [name for name in entries if columns is None or name in columns or name == TIMESTAMP_COLUMN]
+    stored = {name: column_values(cache_folder, manifest, entries[name]) for name in names}
+
+    yielded = 0
+    for first in range(first_row, manifest['rows'], chunksize):
+        rows = slice(first, first + chunksize)
+        selection = row_selection(stored[TIMESTAMP_COLUMN][rows], manifest, start, end, months)
+        chunk = pd.DataFrame({name: decode_column(stored[name][rows][selection], entries[name], manifest,
+                                                  keep_categories)
+                              for name in names})
+        if len(chunk):
+            # Number rows continuously across chunks, as if the whole selection had been loaded
+            chunk.index += yielded
+            yielded += len(chunk)
+            yield chunk
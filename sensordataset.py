@@ -0,0 +1,427 @@
+import os
+import re
+import json
+import time
+import shutil
+import argparse
+from functools import partial
+import numpy as np
+import pandas as pd
+
+from fileutils import write_json
+from parallelrunner import WORKERS, list_csv_files, run_files
+from sensorcache import TIMESTAMP_COLUMN, column_values, decode_column, open_cache, to_epoch_ns
+
+# One dataset holds every sensor of a city. It is partitioned by sensor and calendar month
+# (UTC), each partition sorted by time and stored like the columnar cache: one typed
+# binary file per column. index.json lists the sensors and every partition's row count and
+# time range, so a query only opens the partitions it needs.
+DATASET_FOLDER = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/Dataset'
+INPUT_FOLDER = '/Users/carsenhobson/Downloads/sapphires_potential_cities/fort_collins/New files'
+DATASET_VERSION = 1  # Bumped whenever the on-disk layout changes
+SENSOR_FOLDER = 'sensors'
+MISSING_TIMESTAMP = np.iinfo(np.int64).min
+# PurpleAir export names look like "Name (outside) (40.5853 -105.0844) Primary Real Time 01_01_2020 12_31_2020.csv"
+COORDINATES_PATTERN = re.compile(r'^(?P<name>.*?)\s*\(\s*(?P<lat>-?\d+(?:\.\d+)?)[\s,]+(?P<lon>-?\d+(?:\.\d+)?)\s*\)')
+# Added to the sensor's file name by the simulators and mixing; stripped so every stage of a sensor is merged into one
+STAGE_PREFIXES = ('Updated_', 'processed_')
+STAGE_SUFFIXES = ('_processed',)
+
+# Indexes already read in this process, keyed by (path, mtime)
+_index_cache = {}
+
+
+def slug(text):
+    """Lowercase text with runs of anything but letters and digits replaced by '_'."""
+    return re.sub(r'[^0-9a-z]+', '_', text.lower()).strip('_')
+
+
+def parse_sensor_file_name(file_path):
+    """Sensor id, name and coordinates from a PurpleAir file name.
+
+    The id is the slugged sensor name plus its latitude and longitude as
+    written in the name, e.g. 'csu_outside_40.5853_-105.0844', so two
+    sensors with the same name in different places stay apart, and the
+    yearly files of one sensor share an id. Files without coordinates are
+    keyed by their slugged name alone.
+    """
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    for prefix in STAGE_PREFIXES:
+        if stem.startswith(prefix):
+            stem = stem[len(prefix):]
+    for suffix in STAGE_SUFFIXES:
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+
+    match = COORDINATES_PATTERN.match(stem)
+    if match is None:
+        return {'sensor_id': slug(stem), 'name': stem, 'lat': None, 'lon': None}
+    name = match.group('name').strip()
+    return {'sensor_id': f"{slug(name)}_{match.group('lat')}_{match.group('lon')}", 'name': name,
+            'lat': float(match.group('lat')), 'lon': float(match.group('lon'))}
+
+
+def group_sensor_files(file_paths):
+    """File paths grouped by sensor id, in sorted order within each sensor."""
+    groups = {}
+    for file_path in sorted(file_paths):
+        groups.setdefault(parse_sensor_file_name(file_path)['sensor_id'], []).append(file_path)
+    return groups
+
+
+def partition_folder(dataset_folder, sensor_id, month):
+    return os.path.join(dataset_folder, SENSOR_FOLDER, sensor_id, month)
+
+
+def merge_columns(caches):
+    """One column layout for several cached files of a sensor.
+
+    Returns the merged entries and, per file, a code remapping for each of
+    its text columns into the merged categories. A column that is float in
+    one file and integer in another is merged as float. Raises ValueError
+    when the files store a column in otherwise different ways.
+    """
+    merged = {}
+    for _, manifest, _ in caches:
+        for entry in manifest['columns']:
+            name = entry['name']
+            if name not in merged:
+                merged[name] = {key: (list(value) if key == 'categories' else value) for key, value in entry.items()}
+                merged[name]['file'] = f'column_{len(merged) - 1}.bin'
+            elif {merged[name]['kind'], entry['kind']} == {'float', 'number'}:
+                # Both are stored as float64: an integer column that is blank in a file's first chunk reads as float
+                merged[name]['kind'] = 'float'
+                merged[name].pop('integer', None)
+                merged[name].pop('boolean', None)
+            elif merged[name]['kind'] != entry['kind']:
+                raise ValueError(f"Column {name} is stored as {merged[name]['kind']} in one file "
+                                 f"and {entry['kind']} in another")
+            elif entry['kind'] == 'number':
+                merged[name]['integer'] = merged[name]['integer'] and entry['integer']
+                merged[name]['boolean'] = merged[name]['boolean'] and entry['boolean']
+            elif entry['kind'] == 'category':
+                known = set(merged[name]['categories'])
+                merged[name]['categories'] += [value for value in entry['categories'] if value not in known]
+
+    remaps = []
+    for _, manifest, entries in caches:
+        remap = {}
+        for name, entry in entries.items():
+            if entry['kind'] == 'category':
+                codes = {value: code for code, value in enumerate(merged[name]['categories'])}
+                remap[name] = np.array([codes[value] for value in entry['categories']], dtype=np.int32)
+        remaps.append(remap)
+        # Integer columns that are missing from a file get gaps, so they can't come back as integers
+        for name, entry in merged.items():
+            if name not in entries and entry['kind'] == 'number':
+                entry['integer'] = False
+    return list(merged.values()), remaps
+
+
+def blank_value(entry):
+    """The stored value of a blank cell in a column."""
+    if entry['kind'] == 'category':
+        return -1
+    if entry['kind'] == 'timestamp':
+        return MISSING_TIMESTAMP
+    return np.nan
+
+
+def is_blank(values, entry):
+    if entry['kind'] in ('number', 'float'):
+        return np.isnan(values)
+    return values == blank_value(entry)
+
+
+def first_present(values, entry, row_starts):
+    """For each run of rows starting at row_starts, the first value that isn't blank (blank if all are)."""
+    blank = is_blank(values, entry)
+    if not blank.any():
+        return values[row_starts]
+    positions = np.where(blank, len(values), np.arange(len(values)))
+    return np.append(values, np.array(blank_value(entry), dtype=values.dtype))[np.minimum.reduceat(positions, row_starts)]
+
+
+def stored_column(caches, remaps, entry):
+    """A column's stored values from every file of a sensor, one after the other."""
+    parts = []
+    for (cache_folder, manifest, entries), remap in zip(caches, remaps):
+        if entry['name'] not in entries:
+            # Blank in a file without the column
+            parts.append(np.full(manifest['rows'], blank_value(entry), dtype=entry['dtype']))
+            continue
+        values = column_values(cache_folder, manifest, entries[entry['name']])
+        if entry['name'] in remap and len(remap[entry['name']]):
+            values = np.where(values >= 0, remap[entry['name']][np.maximum(values, 0)], -1)
+        parts.append(np.asarray(values, dtype=entry['dtype']))
+    return np.concatenate(parts) if parts else np.empty(0, dtype=entry['dtype'])
+
+
+def ingest_sensor(dataset_folder, groups, sensor_id):
+    """Write the partitions of one sensor from its files' columnar caches, and return its index entry.
+
+    The files are read through sensorcache, so nothing is parsed twice.
+    Rows from all files are put in time order and split by calendar month
+    (UTC); rows without a timestamp are left out, and so are files without
+    a created_at column. Rows with the same timestamp (the raw, processed
+    and mixing files of a sensor, or overlapping exports) are merged into
+    one, each column taking the first non-blank value. The sensor is
+    written to a temporary folder first and swapped in at the end.
+    """
+    file_paths = []
+    caches = []
+    for file_path in groups[sensor_id]:
+        try:
+            caches.append(open_cache(file_path))
+        except KeyError:
+            print(f"Skipping file {file_path}: it has no '{TIMESTAMP_COLUMN}' column")
+            continue
+        file_paths.append(file_path)
+    if not caches:
+        raise ValueError(f"No file of sensor {sensor_id} has a '{TIMESTAMP_COLUMN}' column")
+    entries, remaps = merge_columns(caches)
+    timestamp_entry = next(entry for entry in entries if entry['name'] == TIMESTAMP_COLUMN)
+
+    timestamps = stored_column(caches, remaps, timestamp_entry)
+    valid = np.flatnonzero(timestamps != MISSING_TIMESTAMP)
+    if len(caches) == 1 and caches[0][1]['sorted']:
+        order = valid
+    else:
+        order = valid[np.argsort(timestamps[valid], kind='stable')]
+    timestamps = timestamps[order]
+    row_starts = np.flatnonzero(np.diff(timestamps, prepend=MISSING_TIMESTAMP))
+    repeated = len(row_starts) < len(timestamps)
+    if repeated:
+        timestamps = timestamps[row_starts]
+    months = timestamps.view('datetime64[ns]').astype('datetime64[M]')
+    starts = np.concatenate(([0], np.flatnonzero(months[1:] != months[:-1]) + 1)) if len(months) else np.empty(0, int)
+    ends = np.append(starts[1:], len(months))
+
+    sensor_folder = os.path.join(dataset_folder, SENSOR_FOLDER, sensor_id)
+    temporary_folder = sensor_folder + '.tmp'
+    shutil.rmtree(temporary_folder, ignore_errors=True)
+    partitions = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        month = str(months[start])
+        os.makedirs(os.path.join(temporary_folder, month))
+        partitions.append({'sensor': sensor_id, 'month': month, 'rows': end - start,
+                           'first': int(timestamps[start]), 'last': int(timestamps[end - 1])})
+    os.makedirs(temporary_folder, exist_ok=True)
+
+    # One column in memory at a time
+    for entry in entries:
+        if entry is timestamp_entry:
+            values = timestamps
+        else:
+            values = stored_column(caches, remaps, entry)[order]
+            if repeated:
+                values = first_present(values, entry, row_starts)
+        for partition, start, end in zip(partitions, starts.tolist(), ends.tolist()):
+            values[start:end].tofile(os.path.join(temporary_folder, partition['month'], entry['file']))
+
+    shutil.rmtree(sensor_folder, ignore_errors=True)
+    os.rename(temporary_folder, sensor_folder)
+
+    details = parse_sensor_file_name(file_paths[0])
+    return {
+        'sensor_id': sensor_id,
+        'name': details['name'],
+        'lat': details['lat'],
+        'lon': details['lon'],
+        'sources': [{'file': os.path.abspath(file_path), 'source_sha1': manifest['source_sha1']}
+                    for file_path, (_, manifest, _) in zip(file_paths, caches)],
+        'rows': len(timestamps),
+        'first': partitions[0]['first'] if partitions else None,
+        'last': partitions[-1]['last'] if partitions else None,
+        'columns': entries,
+        'partitions': partitions,
+    }
+
+
+def is_sensor_current(sensor, file_paths):
+    """Whether a sensor's stored partitions came from exactly these files, unchanged.
+
+    Files skipped for having no created_at column are left out of both sides.
+    """
+    if sensor is None:
+        return False
+    source_sha1 = {}
+    for file_path in file_paths:
+        try:
+            source_sha1[os.path.abspath(file_path)] = open_cache(file_path)[1]['source_sha1']
+        except KeyError:
+            continue
+    return {source['file']: source['source_sha1'] for source in sensor['sources']} == source_sha1
+
+
+def index_path(dataset_folder):
+    return os.path.join(dataset_folder, 'index.json')
+
+
+def read_index(dataset_folder):
+    """The dataset's index, read once per process until the file changes."""
+    path = index_path(dataset_folder)
+    try:
+        key = (os.path.abspath(path), os.path.getmtime(path))
+    except OSError:
+        return None
+    if key not in _index_cache:
+        with open(path) as f:
+            index = json.load(f)
+        if index.get('version') != DATASET_VERSION:
+            return None
+        _index_cache[key] = index
+    return _index_cache[key]
+
+
+def write_index(dataset_folder, index):
+    write_json(index_path(dataset_folder), index)
+
+
+def ingest_folders(folders, dataset_folder=DATASET_FOLDER, workers=WORKERS):
+    """Consolidate every sensor CSV in folders into the dataset, one sensor per worker.
+
+    Sensors whose files haven't changed since the last ingest are kept as
+    they are; sensors whose files are gone are dropped. Returns the index.
+    """
+    os.makedirs(dataset_folder, exist_ok=True)
+    groups = group_sensor_files(file_path for folder in folders for file_path in list_csv_files(folder))
+    previous = (read_index(dataset_folder) or {}).get('sensors', {})
+
+    sensors = {sensor_id: previous[sensor_id] for sensor_id in groups
+               if is_sensor_current(previous.get(sensor_id), groups[sensor_id])}
+    changed = [sensor_id for sensor_id in groups if sensor_id not in sensors]
+    print(f"{len(groups)} sensors: {len(changed)} to ingest, {len(sensors)} unchanged")
+    results, failures = run_files(partial(ingest_sensor, dataset_folder, groups), changed, workers,
+                                  desc="Ingesting sensors")
+    sensors.update(results)
+
+    for sensor_id in set(previous) - set(groups):
+        shutil.rmtree(os.path.join(dataset_folder, SENSOR_FOLDER, sensor_id), ignore_errors=True)
+    index = {'version': DATASET_VERSION, 'sensors': {sensor_id: sensors[sensor_id] for sensor_id in sorted(sensors)}}
+    write_index(dataset_folder, index)
+    return index
+
+
+def sensor_table(dataset_folder=DATASET_FOLDER):
+    """One row per sensor: name, coordinates, rows and the time range covered."""
+    sensors = read_index(dataset_folder)['sensors']
+    table = pd.DataFrame([{key: sensor[key] for key in ('sensor_id', 'name', 'lat', 'lon', 'rows', 'first', 'last')}
+                          for sensor in sensors.values()], columns=['sensor_id', 'name', 'lat', 'lon', 'rows',
+                                                                     'first', 'last'])
+    for column in ('first', 'last'):
+        table[column] = pd.to_datetime(table[column], unit='ns', utc=True)
+    return table.set_index('sensor_id')
+
+
+def select_partitions(index, sensors=None, start=None, end=None, months=None):
+    """Partitions that can hold rows of the given sensors inside [start, end] and the given calendar months.
+
+    Only the index is looked at; no partition is opened.
+    """
+    start_ns = to_epoch_ns(start) if start is not None else None
+    end_ns = to_epoch_ns(end) if end is not None else None
+    sensor_ids = index['sensors'] if sensors is None else [sensor_id for sensor_id in sensors
+                                                          if sensor_id in index['sensors']]
+    selected = []
+    for sensor_id in sensor_ids:
+        for partition in index['sensors'][sensor_id]['partitions']:
+            if start_ns is not None and partition['last'] < start_ns:
+                continue
+            if end_ns is not None and partition['first'] > end_ns:
+                continue
+            if months is not None and int(partition['month'][5:]) not in months:
+                continue
+            selected.append(partition)
+    return selected
+
+
+def read_partition(dataset_folder, index, partition, columns=None, start=None, end=None, keep_categories=False):
+    """Rows of one partition inside [start, end], with only the given columns (created_at is always included).
+
+    The partition is sorted by time, so the range is two binary searches on
+    its memory-mapped timestamps. created_at comes back in UTC.
+    """
+    folder = partition_folder(dataset_folder, partition['sensor'], partition['month'])
+    entries = {entry['name']: entry for entry in index['sensors'][partition['sensor']]['columns']}
+    rows = {'rows': partition['rows']}
+    timestamps = column_values(folder, rows, entries[TIMESTAMP_COLUMN])
+    first = np.searchsorted(timestamps, to_epoch_ns(start), side='left') if start is not None else 0
+    last = np.searchsorted(timestamps, to_epoch_ns(end), side='right') if end is not None else len(timestamps)
+
+    data = {}
+    for name, entry in entries.items():
+        if columns is not None and name not in columns and name != TIMESTAMP_COLUMN:
+            continue
+        # Every sensor's timestamps are read as UTC, so sensors can be put side by side
+        data[name] = decode_column(column_values(folder, rows, entry)[first:last], entry, {'tz_aware': True},
+                                   keep_categories)
+    return pd.DataFrame(data)
+
+
+def iter_sensors(dataset_folder=DATASET_FOLDER, columns=None, sensors=None, start=None, end=None, months=None,
+                 keep_categories=False):
+    """Yield (sensor_id, rows) for every sensor with rows in the query, in time order.
+
+    Takes the same filters as read_dataset, one sensor in memory at a time.
+    """
+    index = read_index(dataset_folder)
+    partitions = select_partitions(index, sensors, start, end, months)
+    by_sensor = {}
+    for partition in partitions:
+        by_sensor.setdefault(partition['sensor'], []).append(partition)
+    for sensor_id, sensor_partitions in by_sensor.items():
+        frames = [read_partition(dataset_folder, index, partition, columns, start, end, keep_categories)
+                  for partition in sensor_partitions]
+        df = pd.concat(frames, ignore_index=True)
+        if len(df):
+            yield sensor_id, df
+
+
+def read_dataset(dataset_folder=DATASET_FOLDER, columns=None, sensors=None, start=None, end=None, months=None,
+                 keep_categories=False):
+    """Rows of many sensors in one frame, with a sensor_id column, sorted by sensor then time.
+
+    sensors limits the query to those ids (see sensor_table), start/end to a
+    time range and months to calendar months, e.g. every sensor during the
+    Cameron Peak fire:
+
+        read_dataset(columns=['PM2.5_CF1_ug/m3'], start='2020-08-13', end='2020-12-02')
+
+    or every sensor's October-March season:
+
+        read_dataset(months=[10, 11, 12, 1, 2, 3])
+
+    Only the partitions that overlap the query are opened.
+    """
+    frames = []
+    sensor_ids = []
+    for sensor_id, df in iter_sensors(dataset_folder, columns, sensors, start, end, months, keep_categories):
+        frames.append(df)
+        sensor_ids.append(sensor_id)
+    if not frames:
+        return pd.DataFrame(columns=['sensor_id', TIMESTAMP_COLUMN])
+    lengths = [len(df) for df in frames]
+    df = pd.concat(frames, ignore_index=True)
+    df.insert(0, 'sensor_id', pd.Categorical.from_codes(np.repeat(np.arange(len(frames)), lengths), sensor_ids))
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consolidate sensor CSV folders into one partitioned dataset.")
+    parser.add_argument('folders', nargs='*', default=[INPUT_FOLDER], help="Folders of sensor CSVs")
+    parser.add_argument('--dataset', default=DATASET_FOLDER, help="Dataset folder")
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    index = ingest_folders(args.folders, args.dataset, args.workers)
+    partitions = sum(len(sensor['partitions']) for sensor in index['sensors'].values())
+    rows = sum(sensor['rows'] for sensor in index['sensors'].values())
+    print(f"{len(index['sensors'])} sensors, {partitions} partitions, {rows} rows "
+          f"in {time.perf_counter() - started:.1f}s")
+    print(sensor_table(args.dataset).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+import time
+import argparse
+from collections import deque
+import numpy as np
+
+import areaundersim
+import historicalsimulation
+from baseline import BASELINE_END_HOUR, BASELINE_START_HOUR
+from detectiondb import read_table
+from relayevents import QuantileSketch
+from sensorcache import CHUNK_SIZE, iter_sensor_chunks
+
+SECONDS_PER_DAY = 24 * 3600
+LATENCY_PERCENTILES = [50, 90, 99, 99.9]
+LATENCY_BATCH = 10_000  # Latencies buffered before they are added to the sketch
+
+
+class DailyBaseline:
+    """Daily 5am-6am baseline for a streaming detector.
+
+    Replaying history, pass the file's baseline_dict (baseline.daily_baselines)
+    and the detector makes the same decisions as the batch simulators. Live,
+    leave it out: the average is built from the readings as they arrive and a
+    day's baseline is DEFAULT_BASELINE until its 5am-6am hour has passed.
+    Only the current and previous day are kept, so memory stays constant.
+    """
+
+    def __init__(self, baseline_dict=None, default=historicalsimulation.DEFAULT_BASELINE,
+                 start_hour=BASELINE_START_HOUR, end_hour=BASELINE_END_HOUR):
+        self.baseline_dict = baseline_dict
+        self.default = default
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+        self.values = {}  # Day number -> baseline, for the days in use
+        self.totals = {}  # Day number -> [sum, count], live mode only
+
+    def observe(self, day, hour, pm25):
+        """Record one reading. Only needed in live mode.
+
+        Returns True when the reading ends the day's 5am-6am hour, so its
+        baseline has just been published.
+        """
+        if self.baseline_dict is not None:
+            return False
+        if self.start_hour <= hour < self.end_hour:
+            totals = self.totals.setdefault(day, [0.0, 0])
+            if pm25 == pm25:
+                totals[0] += pm25
+                totals[1] += 1
+        elif hour >= self.end_hour and day in self.totals:
+            # The hour is over: publish the day's baseline (NaN if every reading was NaN)
+            total, count = self.totals.pop(day)
+            self.values[day] = total / count if count else np.nan
+            return True
+        return False
+
+    def get(self, day):
+        if day not in self.values:
+            if self.baseline_dict is None:
+                return self.default
+            date = np.datetime64(day, 'D').astype(object)
+            self.values[day] = self.baseline_dict.get(date, self.default)
+        return self.values[day]
+
+    def forget_before(self, day):
+        """Drop days older than day - 1."""
+        for old_day in [old_day for old_day in self.values if old_day < day - 1]:
+            del self.values[old_day]
+        for old_day in [old_day for old_day in self.totals if old_day < day - 1]:
+            del self.totals[old_day]
+
+
+class WindowDetector:
+    """historicalsimulation's window algorithm, one reading at a time in O(1).
+
+    The window minimum and maximum come from monotonic deques, the NaN
+    check from a count of NaN readings in the window, and the average of
+    the previous baselines from a ring buffer with a running sum, as in
+    simulate_relay. In 'duration' window mode the window is a
+    historicalsimulation.DurationWindow instead. Fed a whole file with the
+    file's baseline_dict, the decisions equal simulate_relay's.
+    """
+
+    def __init__(self, baseline_dict=None, window_size=historicalsimulation.WINDOW_SIZE,
+                 rise_threshold=historicalsimulation.RISE_THRESHOLD,
+                 baseline_multiplier=historicalsimulation.BASELINE_THRESHOLD_MULTIPLIER,
+                 window_mode=historicalsimulation.WINDOW_MODE,
+                 window_duration_minutes=historicalsimulation.WINDOW_DURATION_MINUTES,
+                 max_gap_minutes=historicalsimulation.MAX_GAP_MINUTES):
+        self.daily_baseline = DailyBaseline(baseline_dict)
+        self.window_size = window_size
+        if window_mode not in ('readings', 'duration'):
+            raise ValueError(f"Unknown window mode: {window_mode}")
+        self.duration_window = None
+        if window_mode == 'duration':
+            self.duration_window = historicalsimulation.DurationWindow(window_duration_minutes, max_gap_minutes)
+        self.rise_threshold = rise_threshold
+        self.baseline_multiplier = baseline_multiplier
+
+        self.index = 0
+        self.window_nan = deque()  # Positions of NaN readings still in the window
+        self.window_min = deque()  # (position, value), values increasing
+        self.window_max = deque()  # (position, value), values decreasing
+
+        self.previous = [0.0] * window_size
+        self.previous_sum = 0.0
+        self.previous_count = 0
+        self.previous_nan_count = 0
+        self.ring_index = 0
+
+        self.day = None
+        self.day_on_at_4am = False  # Relay seen ON in today's 04:00-05:00 UTC slot
+        self.relay_on = False
+        self.baseline = np.nan
+
+    def update(self, epoch_seconds, pm25):
+        """Take one reading (UTC epoch seconds, PM2.5) and return whether the relay is ON."""
+        day, second_of_day = divmod(int(epoch_seconds // 60) * 60, SECONDS_PER_DAY)
+        hour = second_of_day // 3600
+        if day != self.day:
+            self.day_on_at_4am = False
+            self.day = day
+            self.daily_baseline.forget_before(day)
+        self.daily_baseline.observe(day, hour, pm25)
+
+        # Slide the window over this reading
+        if self.duration_window is not None:
+            low, high = self.duration_window.update(epoch_seconds, pm25)
+            window_full = low == low
+        else:
+            i = self.index
+            self.index += 1
+            oldest = i - self.window_size
+            if self.window_nan and self.window_nan[0] <= oldest:
+                self.window_nan.popleft()
+            if self.window_min and self.window_min[0][0] <= oldest:
+                self.window_min.popleft()
+            if self.window_max and self.window_max[0][0] <= oldest:
+                self.window_max.popleft()
+            if pm25 != pm25:
+                self.window_nan.append(i)
+            else:
+                while self.window_min and self.window_min[-1][1] >= pm25:
+                    self.window_min.pop()
+                self.window_min.append((i, pm25))
+                while self.window_max and self.window_max[-1][1] <= pm25:
+                    self.window_max.pop()
+                self.window_max.append((i, pm25))
+            window_full = i >= self.window_size - 1 and not self.window_nan
+            if window_full:
+                low, high = self.window_min[0][1], self.window_max[0][1]
+
+        # Same baseline choice as get_baseline_pm25 / simulate_relay
+        if self.day_on_at_4am:
+            candidate = self.daily_baseline.get(day - 1)
+        else:
+            candidate = self.daily_baseline.get(day)
+        if self.previous_nan_count:
+            average_previous_baseline = np.nan
+        elif self.previous_count:
+            average_previous_baseline = self.previous_sum / self.previous_count
+        else:
+            average_previous_baseline = historicalsimulation.DEFAULT_BASELINE
+        if candidate < historicalsimulation.DEFAULT_BASELINE or \
+                candidate > self.baseline_multiplier * average_previous_baseline:
+            baseline = historicalsimulation.DEFAULT_BASELINE
+        else:
+            baseline = candidate
+
+        if window_full:
+            if self.relay_on:
+                if high <= baseline:
+                    self.relay_on = False
+            elif low > self.rise_threshold * baseline:
+                self.relay_on = True
+        if self.relay_on and hour == 4:
+            self.day_on_at_4am = True
+
+        # Previous-baseline ring buffer
+        if self.previous_count == self.window_size:
+            oldest_baseline = self.previous[self.ring_index]
+            if oldest_baseline != oldest_baseline:
+                self.previous_nan_count -= 1
+            else:
+                self.previous_sum -= oldest_baseline
+        else:
+            self.previous_count += 1
+        self.previous[self.ring_index] = baseline
+        if baseline != baseline:
+            self.previous_nan_count += 1
+        else:
+            self.previous_sum += baseline
+        self.ring_index = (self.ring_index + 1) % self.window_size
+
+        self.baseline = baseline
+        return self.relay_on
+
+
+class AreaDetector:
+    """areaundersim's area-under-curve algorithm, one reading at a time in O(1).
+
+    The area since the last reset is a running trapezoid total. A day's
+    baseline is chosen when the day starts, with areaundersim's
+    get_baseline_pm25 rules over the last BASELINE_HISTORY_DAYS days. Live,
+    it is chosen again once the day's 5am-6am baseline is published.
+    """
+
+    def __init__(self, baseline_dict=None, area_threshold=areaundersim.AREA_THRESHOLD):
+        self.daily_baseline = DailyBaseline(baseline_dict, default=areaundersim.DEFAULT_BASELINE)
+        self.area_threshold = area_threshold
+        self.history = deque(maxlen=areaundersim.BASELINE_HISTORY_DAYS)  # Baselines of the days before this one
+        self.day = None
+        self.baseline = np.nan
+        self.previous_excess = None
+        self.total_area = 0.0
+        self.area_at_reset = 0.0
+        self.relay_on = False
+
+    def update(self, epoch_seconds, pm25):
+        """Take one reading (UTC epoch seconds, PM2.5) and return whether the relay is ON."""
+        day, second_of_day = divmod(int(epoch_seconds // 60) * 60, SECONDS_PER_DAY)
+        if day != self.day:
+            if self.day is not None:
+                self.history.append(self.baseline)
+            self.day = day
+            self.daily_baseline.forget_before(day)
+            self.choose_baseline()
+        if self.daily_baseline.observe(day, second_of_day // 3600, pm25):
+            self.choose_baseline()
+
+        excess = max(pm25 - self.baseline, 0.0) if pm25 == pm25 else 0.0
+        if self.previous_excess is not None:
+            self.total_area += (self.previous_excess + excess) / 2
+        self.previous_excess = excess
+
+        if not self.relay_on:
+            if self.total_area > self.area_at_reset + self.area_threshold:
+                self.relay_on = True
+        elif pm25 <= self.baseline:
+            self.relay_on = False
+            self.area_at_reset = self.total_area
+        return self.relay_on
+
+    def choose_baseline(self):
+        """The current day's baseline from its daily baseline and the previous days'."""
+        date = np.datetime64(self.day, 'D').astype(object)
+        self.baseline = areaundersim.get_baseline_pm25({date: self.daily_baseline.get(self.day)}, date, self.history)
+
+
+def to_epoch_seconds(created_at):
+    """UTC epoch seconds of a timestamp column (naive timestamps are taken as UTC)."""
+    created_at = historicalsimulation.to_utc(created_at)
+    return created_at.to_numpy(dtype='datetime64[ns]').astype(np.int64) / 1e9
+
+
+def csv_readings(file_path, chunksize=CHUNK_SIZE):
+    """(epoch seconds, PM2.5) pairs of a sensor CSV, read a chunk at a time."""
+    for chunk in iter_sensor_chunks(file_path, columns=['PM2.5_CF1_ug/m3'], chunksize=chunksize):
+        yield from zip(to_epoch_seconds(chunk['created_at']).tolist(),
+                       chunk['PM2.5_CF1_ug/m3'].astype(float).tolist())
+
+
+def sqlite_readings(conn, table='detectiontestV2', start=None):
+    """(epoch seconds, PM2.5) pairs of a detector table, oldest first."""
+    df = read_table(conn, table, ['pm25'], start=start, parse_dates=False)
+    return zip(df['timestamp'].astype(float).tolist(), df['pm25'].astype(float).tolist())
+
+
+def decisions(detector, readings):
+    """Yield the detector's relay decision for each (epoch seconds, PM2.5) reading."""
+    for epoch_seconds, pm25 in readings:
+        yield detector.update(epoch_seconds, pm25)
+
+
+def replay(detector, readings):
+    """Feed readings through detector as fast as it takes them, in constant memory.
+
+    Returns the number of readings, how many turned the relay ON and the
+    decision latency percentiles (from a QuantileSketch, so within 1%) and
+    maximum, in microseconds.
+    """
+    count = 0
+    relay_on = 0
+    slowest = 0
+    sketch = QuantileSketch()
+    batch = np.empty(LATENCY_BATCH, dtype=np.int64)
+    clock = time.perf_counter_ns
+    for epoch_seconds, pm25 in readings:
+        started = clock()
+        relay_on += detector.update(epoch_seconds, pm25)
+        batch[count % LATENCY_BATCH] = clock() - started
+        count += 1
+        if count % LATENCY_BATCH == 0:
+            sketch.add(batch)
+            slowest = max(slowest, int(batch.max()))
+    if count % LATENCY_BATCH:
+        sketch.add(batch[:count % LATENCY_BATCH])
+        slowest = max(slowest, int(batch[:count % LATENCY_BATCH].max()))
+
+    report = {'readings': count, 'relay_on': relay_on}
+    if count:
+        report.update({f'p{percentile:g}_us': sketch.quantile(percentile / 100) / 1000
+                       for percentile in LATENCY_PERCENTILES})
+        report['max_us'] = slowest / 1000
+    return report
+
+
+def make_detector(algorithm, baseline_dict=None):
+    if algorithm == 'window':
+        return WindowDetector(baseline_dict)
+    if algorithm == 'area':
+        return AreaDetector(baseline_dict)
+    raise ValueError(f"Unknown algorithm: {algorithm}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a sensor CSV or detector table through a streaming detector.")
+    parser.add_argument('source', help="Sensor CSV, or SQLite database with --table")
+    parser.add_argument('--algorithm', choices=['window', 'area'], default='window')
+    parser.add_argument('--table', help="Detector table to read from the SQLite database")
+    parser.add_argument('--live-baseline', action='store_true',
+                        help="Build the daily baseline from the stream instead of the file's cached baseline")
+    args = parser.parse_args()
+
+    if args.table:
+        import sqlite3
+        from contextlib import closing
+        with closing(sqlite3.connect(args.source)) as conn:
+            report = replay(make_detector(args.algorithm), sqlite_readings(conn, args.table))
+    else:
+        from baseline import daily_baselines
+        detector = make_detector(args.algorithm, None if args.live_baseline else daily_baselines(args.source))
+        report = replay(detector, csv_readings(args.source))
+
+    count = report.pop('readings')
+    relay_on = report.pop('relay_on')
+    print(f"Relay ON {relay_on / count * 100 if count else 0:.2f}% of {count} readings")
+    for name, value in report.items():
+        print(f"{name}: {value:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The scripts are flat top-level modules, so the tests import them from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def sample_frame():
+    """Three days of 2-minute readings at 5 µg/m³, with a smoke spike over the second day's 04:00-05:00 slot."""
+    created_at = pd.date_range('2021-01-01', periods=3 * 24 * 30, freq='2min', tz='UTC')
+    pm25 = np.full(len(created_at), 5.0)
+    pm25[(created_at >= '2021-01-02 02:00') & (created_at < '2021-01-02 07:00')] = 100.0
+    return pd.DataFrame({
+        'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S UTC'),
+        'PM2.5_CF1_ug/m3': pm25,
+    })
+
+
+@pytest.fixture
+def sample_file(tmp_path, sample_frame):
+    """Write a frame (the sample frame by default) to a CSV under tmp_path and return its path."""
+    def write(name='sample.csv', frame=None):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        (sample_frame if frame is None else frame).to_csv(path, index=False)
+        return str(path)
+    return write
@@ -0,0 +1,69 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy.integrate import solve_ivp
+
+import mixing
+
+
+def gap_series():
+    """Two days of 10-minute readings, a 400-hour outage, then two more days."""
+    before = np.arange(0, 48, 1 / 6)
+    after = before[-1] + 400 + np.arange(0, 48, 1 / 6)
+    time_points = np.concatenate([before, after])
+    pm_in = 20 + 15 * np.sin(time_points / 3)
+    return time_points, pm_in
+
+
+def step_by_step(time_points, pm_in, air_exchange, removal):
+    """The closed-form update applied one interval at a time, in plain Python."""
+    a = air_exchange + removal
+    C = [0.0]
+    for i in range(len(time_points) - 1):
+        decay = a * (time_points[i + 1] - time_points[i])
+        one_minus_e = -np.expm1(-decay)
+        w1 = (decay - one_minus_e) / (a * decay)
+        w0 = one_minus_e / a - w1
+        C.append(np.exp(-decay) * C[-1] + air_exchange * (w0 * pm_in[i] + w1 * pm_in[i + 1]))
+    return np.array(C)
+
+
+def test_long_gap_stays_finite():
+    time_points, pm_in = gap_series()
+    air_exchange, removal = 2.0, 0.2
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        C = mixing.solve_exact(time_points, pm_in, V=1, Q=air_exchange, k=removal)
+
+    assert np.isfinite(C).all()
+    np.testing.assert_allclose(C, step_by_step(time_points, pm_in, air_exchange, removal), rtol=1e-9)
+
+
+def test_ensemble_after_long_gap_stays_finite():
+    time_points, pm_in = gap_series()
+    relay_on = np.zeros(len(time_points), dtype=bool)
+    homes = pd.DataFrame({'V': [1.0, 100.0], 'Q': [2.0, 50.0], 'k_off': [0.2, 0.0], 'k_on': [5.0, 1.0]})
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        summary = mixing.simulate_ensemble(time_points, pm_in, relay_on, homes)
+
+    assert np.isfinite(summary[['mean_indoor', 'max_indoor']].to_numpy()).all()
+
+
+def test_exact_matches_tight_rk45():
+    # A day of readings, then a gap long enough that exp(decay) over it overflows float64
+    before = np.arange(0, 24, 1 / 6)
+    time_points = np.concatenate([before, before[-1] + 1100 + before])
+    pm_in = 20 + 15 * np.sin(time_points / 3)
+    V, Q, k = 100, 50, 0.2
+
+    exact = mixing.solve_exact(time_points, pm_in, V=V, Q=Q, k=k)
+    tight = solve_ivp(mixing.model, [time_points[0], time_points[-1]], [0], t_eval=time_points,
+                      args=(V, Q, k, time_points, pm_in), method='RK45', rtol=1e-10, atol=1e-10,
+                      max_step=np.median(np.diff(time_points))).y[0]
+
+    # Relative to the size of the indoor series, so the near-zero start doesn't dominate
+    assert np.max(np.abs(exact - tight)) / np.max(np.abs(tight)) < 1e-6
@@ -0,0 +1,12 @@
+import historicalsimulation
+
+
+def test_4am_index_matches_frame_scan(sample_file):
+    assert historicalsimulation.check_relay_on_4am_index(sample_file()) == 0
+
+
+def test_sample_turns_relay_on_in_4am_slot(sample_file):
+    # Without an ON reading in a 04:00-05:00 slot the index would have nothing to disagree about
+    df = historicalsimulation.load_sensor_csv(sample_file())
+    historicalsimulation.add_relay_columns(df, engine='reference')
+    assert (df['relay_on'] & (df['hour'] == 4)).any()
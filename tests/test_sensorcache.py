@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import sensorcache
+
+
+def write_notes_file(path, notes):
+    created_at = pd.date_range('2021-01-01', periods=len(notes), freq='h', tz='UTC')
+    pd.DataFrame({
+        'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S UTC'),
+        'PM2.5_CF1_ug/m3': np.arange(len(notes), dtype=float),
+        'note': notes,
+    }).to_csv(path, index=False)
+
+
+def test_text_after_blank_first_chunk_is_kept(tmp_path):
+    # The first chunk of 'note' is all blank, so it starts out as a float column
+    file_path = tmp_path / 'sample.csv'
+    write_notes_file(file_path, [np.nan] * 5 + ['a', 'b', np.nan, '3', 'c'])
+
+    manifest = sensorcache.build_cache(str(file_path), chunksize=3)
+
+    assert {entry['name']: entry['kind'] for entry in manifest['columns']}['note'] == 'category'
+    loaded = sensorcache.load_sensor_csv(str(file_path))
+    expected = pd.read_csv(file_path)['note']
+    assert loaded['note'].isna().equals(expected.isna())
+    assert loaded['note'].dropna().tolist() == expected.dropna().tolist()
+
+
+def test_text_appended_to_numeric_column_is_kept(tmp_path):
+    file_path = tmp_path / 'sample.csv'
+    write_notes_file(file_path, [1, 2, 3])
+    sensorcache.open_cache(str(file_path))
+    with open(file_path, 'a') as f:
+        f.write('2021-01-01 03:00:00 UTC,3.0,x\n')
+
+    loaded = sensorcache.load_sensor_csv(str(file_path))
+
+    assert loaded['note'].tolist() == ['1', '2', '3', 'x']
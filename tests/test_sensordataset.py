@@ -0,0 +1,83 @@
+import numpy as np
+
+import sensordataset
+
+SENSOR = 'S0 (40.0 -105.1)'
+SENSOR_ID = 's0_40.0_-105.1'
+OTHER_SENSOR = 'S1 (40.1 -105.1)'
+
+
+def write_stage_files(sample_file, sample_frame):
+    """The raw, processed and mixing files of one sensor, each stage adding columns to the last."""
+    processed = sample_frame.assign(baseline_pm25=5.0,
+                                    relay_state=np.where(sample_frame['PM2.5_CF1_ug/m3'] > 50, 'ON', 'OFF'))
+    mixing = processed.assign(**{'Estimated_Indoor_PM2.5': processed['PM2.5_CF1_ug/m3'] / 2})
+    sample_file(f'raw/{SENSOR}.csv')
+    sample_file(f'processed/{SENSOR}_processed.csv', processed)
+    sample_file(f'mixing/Updated_{SENSOR}_processed.csv', mixing)
+    return mixing
+
+
+def stage_folders(tmp_path):
+    return [str(tmp_path / stage) for stage in ('raw', 'processed', 'mixing')]
+
+
+def test_stage_files_merge_to_one_row_per_timestamp(tmp_path, sample_file, sample_frame):
+    mixing = write_stage_files(sample_file, sample_frame)
+
+    sensordataset.ingest_folders(stage_folders(tmp_path), str(tmp_path / 'dataset'), workers=1)
+    df = sensordataset.read_dataset(str(tmp_path / 'dataset'))
+
+    assert len(df) == len(sample_frame)
+    assert not df['created_at'].duplicated().any()
+    assert df['relay_state'].tolist() == mixing['relay_state'].tolist()
+    np.testing.assert_array_equal(df['Estimated_Indoor_PM2.5'], mixing['Estimated_Indoor_PM2.5'])
+
+
+def test_file_without_created_at_is_skipped(tmp_path, sample_file, sample_frame):
+    sample_file(f'raw/{SENSOR}.csv')
+    sample_file(f'raw/{SENSOR}_notes.csv', sample_frame.drop(columns='created_at'))
+
+    index = sensordataset.ingest_folders([str(tmp_path / 'raw')], str(tmp_path / 'dataset'), workers=1)
+
+    sensor = index['sensors'][SENSOR_ID]
+    assert sensor['rows'] == len(sample_frame)
+    assert [source['file'] for source in sensor['sources']] == [str(tmp_path / 'raw' / f'{SENSOR}.csv')]
+
+
+def test_reingest_rebuilds_only_the_changed_sensor(tmp_path, sample_file, sample_frame, monkeypatch):
+    write_stage_files(sample_file, sample_frame)
+    sample_file(f'raw/{OTHER_SENSOR}.csv')
+    dataset = str(tmp_path / 'dataset')
+    sensordataset.ingest_folders(stage_folders(tmp_path), dataset, workers=1)
+
+    ingested = []
+    ingest_sensor = sensordataset.ingest_sensor
+
+    def recording_ingest_sensor(dataset_folder, groups, sensor_id):
+        ingested.append(sensor_id)
+        return ingest_sensor(dataset_folder, groups, sensor_id)
+
+    monkeypatch.setattr(sensordataset, 'ingest_sensor', recording_ingest_sensor)
+    with open(tmp_path / 'raw' / f'{SENSOR}.csv', 'a') as f:
+        f.write('2021-01-04 00:00:00 UTC,5.0\n')
+    index = sensordataset.ingest_folders(stage_folders(tmp_path), dataset, workers=1)
+
+    assert ingested == [SENSOR_ID]
+    assert index['sensors'][SENSOR_ID]['rows'] == len(sample_frame) + 1
+    assert index['sensors']['s1_40.1_-105.1']['rows'] == len(sample_frame)
+
+
+def test_integer_column_blank_in_one_file_merges(tmp_path, sample_file, sample_frame):
+    # Two exports of one sensor; UptimeMinutes is integer in the first and blank in the second
+    first = sample_frame.iloc[:1000].assign(UptimeMinutes=np.arange(1000))
+    second = sample_frame.iloc[1000:].assign(UptimeMinutes=np.nan)
+    sample_file(f'raw/{SENSOR} 2021a.csv', first)
+    sample_file(f'raw/{SENSOR} 2021b.csv', second)
+
+    sensordataset.ingest_folders([str(tmp_path / 'raw')], str(tmp_path / 'dataset'), workers=1)
+    df = sensordataset.read_dataset(str(tmp_path / 'dataset'))
+
+    assert len(df) == len(sample_frame)
+    np.testing.assert_array_equal(df['UptimeMinutes'][:1000], np.arange(1000))
+    assert df['UptimeMinutes'][1000:].isna().all()
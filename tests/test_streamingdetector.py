@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+
+import streamingdetector
+
+
+def constant_readings(pm25, days=2):
+    created_at = pd.Series(pd.date_range('2021-01-01', periods=days * 24 * 30, freq='2min', tz='UTC'))
+    return list(zip(streamingdetector.to_epoch_seconds(created_at).tolist(), [pm25] * len(created_at)))
+
+
+def test_replay_counts_match_decisions():
+    readings = constant_readings(12.0) + constant_readings(80.0, days=1)
+    decisions = np.fromiter(streamingdetector.decisions(streamingdetector.WindowDetector(), readings), dtype=bool)
+
+    report = streamingdetector.replay(streamingdetector.WindowDetector(), readings)
+
+    assert report['readings'] == len(readings)
+    assert report['relay_on'] == decisions.sum()
+    assert report['p50_us'] <= report['max_us']
+
+
+def test_live_area_baseline_is_published_after_6am():
+    detector = streamingdetector.AreaDetector()
+    for epoch_seconds, pm25 in constant_readings(12.0, days=1):
+        detector.update(epoch_seconds, pm25)
+
+    assert detector.baseline == 12.0